@@ -82,6 +82,56 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Кэш по умолчанию (LocMemCache) виден только своему процессу. Все, что должны
+# видеть веб-процессы и воркеры, хранится на диске или в БД (или в Redis при переносе).
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # Ответы модели по теме. Кэш на диске общий для веб-процессов и воркера генерации:
+    # тест, сгенерированный воркером, сразу отдается из кэша веб-процессом.
+    "llm": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": config('LLM_CACHE_DIR', default=str(BASE_DIR / 'cache' / 'llm')),
+        "TIMEOUT": config('LLM_CACHE_TIMEOUT', default=60 * 60 * 24 * 7, cast=int),
+        "OPTIONS": {
+            "MAX_ENTRIES": config('LLM_CACHE_MAX_ENTRIES', default=2000, cast=int),
+        },
+    },
+    # Счетчики попаданий в кэши и исправлений ответов модели (/api/cache-stats/), общие для всех процессов
+    "counters": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": config('COUNTER_CACHE_DIR', default=str(BASE_DIR / 'cache' / 'counters')),
+        "TIMEOUT": None,
+    },
+    # Снимки рейтинга (leaderboard_utils), общие для всех процессов. Таблица создается
+    # командой createcachetable; MAX_ENTRIES должен вмещать все страницы всех периодов.
+    "leaderboard": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "leaderboard_cache",
+        "OPTIONS": {
+            "MAX_ENTRIES": config('LEADERBOARD_CACHE_MAX_ENTRIES', default=100_000, cast=int),
+        },
+    },
+    # Текст, извлеченный из загруженных файлов, по SHA-256 их содержимого.
+    # Хранится на диске, чтобы его разделяли все процессы и он переживал перезапуск.
+    "documents": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": config('DOCUMENT_CACHE_DIR', default=str(BASE_DIR / 'cache' / 'documents')),
+        "TIMEOUT": config('DOCUMENT_CACHE_TIMEOUT', default=60 * 60 * 24 * 30, cast=int),
+        "OPTIONS": {
+            "MAX_ENTRIES": config('DOCUMENT_CACHE_MAX_ENTRIES', default=500, cast=int),
+        },
+    },
+}
+
+# Тесты подменяют кэш документов временным каталогом
+TEST_RUNNER = 'quiz.testing_utils.QuizTestRunner'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -132,6 +182,63 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # DeepSeek API Key
 DEEPSEEK_API_KEY = config('DEEPSEEK_API_KEY', default='')
+DEEPSEEK_API_URL = config('DEEPSEEK_API_URL', default='https://api.deepseek.com/v1/chat/completions')
+
+# Провайдеры языковой модели (OpenAI-совместимые API). Порядок задает приоритет,
+# пока не накоплена статистика задержек.
+LLM_PROVIDERS = {
+    'deepseek': {
+        'URL': DEEPSEEK_API_URL,
+        'API_KEY': DEEPSEEK_API_KEY,
+        'MODEL': 'deepseek-chat',
+    },
+}
+
+# Резервный провайдер для страхующих запросов, например OpenRouter
+if config('LLM_FALLBACK_API_KEY', default=''):
+    LLM_PROVIDERS['fallback'] = {
+        'URL': config('LLM_FALLBACK_URL', default='https://openrouter.ai/api/v1/chat/completions'),
+        'API_KEY': config('LLM_FALLBACK_API_KEY'),
+        'MODEL': config('LLM_FALLBACK_MODEL', default='deepseek/deepseek-chat'),
+    }
+
+# Страхующий запрос уходит резервному провайдеру, если основной не ответил за свой p95
+LLM_HEDGING = {
+    'ENABLED': True,
+    'PERCENTILE': 95,
+    'MIN_SAMPLES': 20,  # запросов до включения страховки
+    'MIN_DELAY': 1.0,  # секунд
+}
+
+# HTTP-клиент языковой модели: пул keep-alive соединений, повторы и размыкатель цепи
+LLM_HTTP_POOL_SIZE = config('LLM_HTTP_POOL_SIZE', default=20, cast=int)
+LLM_MAX_RETRIES = config('LLM_MAX_RETRIES', default=2, cast=int)
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5  # ошибок подряд до размыкания цепи
+LLM_CIRCUIT_RESET_TIMEOUT = 30  # секунд до пробного запроса
+
+# Очередь генерации тестов (manage.py run_generation_worker)
+GENERATION_WORKER_CONCURRENCY = config('GENERATION_WORKER_CONCURRENCY', default=4, cast=int)
+GENERATION_JOB_MAX_PER_OWNER = config('GENERATION_JOB_MAX_PER_OWNER', default=2, cast=int)
+GENERATION_JOB_TIMEOUT = 300  # секунд до признания задания зависшим
+GENERATION_JOB_MAX_ATTEMPTS = 3
+
+# Ограничения на разбор загруженных PDF/Word файлов
+FILE_UPLOAD_MAX_BYTES = 20 * 1024 * 1024
+FILE_EXTRACT_MAX_PAGES = 500
+FILE_EXTRACT_MAX_CHARS = 1_000_000  # после стольких символов чтение файла прекращается
+# Страницы PDF разбираются в пуле процессов; 0 - разбирать в текущем процессе
+FILE_EXTRACT_WORKERS = config('FILE_EXTRACT_WORKERS', default=4, cast=int)
+# Всего процессов разбора PDF одновременно в одном веб-процессе или воркере; остальные документы ждут
+FILE_EXTRACT_MAX_PROCESSES = config('FILE_EXTRACT_MAX_PROCESSES', default=8, cast=int)
+# PDF меньше этого размера разбирается в текущем процессе: запуск пула дольше самого разбора
+FILE_EXTRACT_PARALLEL_MIN_BYTES = config('FILE_EXTRACT_PARALLEL_MIN_BYTES', default=1024 * 1024, cast=int)
+FILE_EXTRACT_TIME_BUDGET = 30  # секунд на разбор одного документа
+
+MY_QUIZZES_PAGE_SIZE = 20
+
+# Рейтинги пользователей (manage.py build_leaderboards по расписанию пересобирает их заранее)
+LEADERBOARD_PAGE_SIZE = 50
+LEADERBOARD_TIMEOUT = config('LEADERBOARD_TIMEOUT', default=15 * 60, cast=int)  # сколько секунд живет снимок рейтинга (пересобирается командой build_leaderboards)
 
 # Login/Logout URLs
 LOGIN_URL = '/login/'
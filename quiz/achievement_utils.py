@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.db.models import F
+
+from .models import Achievement, UserAchievement, UserStats, PointsEntry
+
+
+# Условия достижений: {условие: {счетчик статистики: минимальное значение}}, выполняться должны все пороги
+ACHIEVEMENT_RULES = {
+    'first_quiz': {'total_quizzes_created': 1},
+    'quiz_creator': {'total_quizzes_created': 5},
+    'quiz_master': {'total_quizzes_created': 10},
+    'perfectionist': {'average_score': 90, 'total_quizzes_completed': 5},
+    'accuracy_king': {'accuracy': 95, 'total_quizzes_completed': 3},
+    'speed_demon': {'total_quizzes_completed': 20},
+    'dedicated_learner': {'total_quizzes_completed': 50},
+    'scholar': {'total_questions_answered': 100},
+    'question_master': {'total_questions_answered': 500},
+    'genius': {'average_score': 95, 'total_quizzes_completed': 10},
+    'points_collector': {'total_points': 500},
+    'points_master': {'total_points': 1000},
+}
+
+COUNTERS = (
+    'total_quizzes_created',
+    'total_quizzes_completed',
+    'total_questions_answered',
+    'total_correct_answers',
+    'total_points',
+    'average_score',
+    'accuracy',
+)
+
+# Каталог достижений живет в памяти процесса; в других процессах изменения видны через CATALOG_TTL секунд
+CATALOG_TTL = 5 * 60
+
+AchievementRule = namedtuple('AchievementRule', ['id', 'points', 'thresholds'])
+
+_catalog = None
+_catalog_loaded_at = 0.0
+_catalog_lock = threading.Lock()
+
+
+def get_counter(stats, counter):
+    """Значение счетчика статистики; точность вычисляется из числа ответов"""
+    if counter == 'accuracy':
+        return stats.get_accuracy_percentage()
+    return getattr(stats, counter)
+
+
+def snapshot_counters(stats):
+    """Значения всех счетчиков, от которых зависят достижения"""
+    return {counter: get_counter(stats, counter) for counter in COUNTERS}
+
+
+def changed_counters(before, stats):
+    """Счетчики, изменившиеся с момента снимка before"""
+    return {counter for counter, value in before.items() if get_counter(stats, counter) != value}
+
+
+def get_achievement_catalog():
+    """Достижения с известными условиями: [AchievementRule]"""
+    global _catalog, _catalog_loaded_at
+    with _catalog_lock:
+        if _catalog is None or time.monotonic() - _catalog_loaded_at > CATALOG_TTL:
+            _catalog = [
+                AchievementRule(achievement_id, points, ACHIEVEMENT_RULES[condition])
+                for achievement_id, condition, points in Achievement.objects.values_list('id', 'condition', 'points')
+                if condition in ACHIEVEMENT_RULES
+            ]
+            _catalog_loaded_at = time.monotonic()
+        return _catalog
+
+
+def reset_achievement_catalog():
+    """Сбрасывает каталог после изменения достижений"""
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+
+def _is_satisfied(rule, stats):
+    return all(get_counter(stats, counter) >= threshold for counter, threshold in rule.thresholds.items())
+
+
+def check_achievements(user, stats=None, changed=None):
+    """Открывает достижения, условия которых выполнены; возвращает id новых достижений.
+
+    changed - счетчики, изменившиеся с прошлой проверки: проверяются только
+    правила, которые от них зависят (None - все правила). Если ни одно правило
+    не выполнено, запросов к БД нет; иначе открытые достижения читаются одним
+    запросом, новые сохраняются пакетно вместе с одним начислением очков.
+    """
+    if stats is None:
+        stats, created = UserStats.objects.get_or_create(user=user)
+
+    catalog = get_achievement_catalog()
+    unlocked = None
+    new_rules = []
+    while True:
+        candidates = [
+            rule for rule in catalog
+            if (changed is None or changed.intersection(rule.thresholds)) and _is_satisfied(rule, stats)
+        ]
+        if not candidates:
+            break
+        if unlocked is None:
+            unlocked = set(UserAchievement.objects.filter(user=user).values_list('achievement_id', flat=True))
+        fresh = [rule for rule in candidates if rule.id not in unlocked]
+        if not fresh:
+            break
+        new_rules.extend(fresh)
+        unlocked.update(rule.id for rule in fresh)
+
+        # Очки за достижения могут открыть достижения за очки
+        points = sum(rule.points for rule in fresh)
+        if not points:
+            break
+        stats.total_points += points
+        changed = {'total_points'}
+
+    if new_rules:
+        UserAchievement.objects.bulk_create([
+            UserAchievement(user=user, achievement_id=rule.id) for rule in new_rules
+        ])
+        points = sum(rule.points for rule in new_rules)
+        if points:
+            UserStats.objects.filter(pk=stats.pk).update(total_points=F('total_points') + points)
+            PointsEntry.objects.create(user=user, points=points)
+
+    return [rule.id for rule in new_rules]
@@ -1,10 +1,32 @@
 from django.contrib import admin
-from .models import Quiz, Question, Answer, UserAnswer, Achievement, UserAchievement, UserStats
+from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
+from django.contrib.auth.models import User
+from django.db.models import Count
+from .models import Quiz, Question, Answer, UserAnswer, Achievement, UserAchievement, UserStats, QuizAttempt, PointsEntry, GenerationJob
+
+
+class CascadeAttemptsMixin:
+    """Попытки нельзя удалить из админки, но они удаляются вместе со своим тестом или пользователем"""
+
+    def get_deleted_objects(self, objs, request):
+        deleted_objects, model_count, perms_needed, protected = super().get_deleted_objects(objs, request)
+        perms_needed.discard(QuizAttempt._meta.verbose_name)
+        return deleted_objects, model_count, perms_needed, protected
+
+
+admin.site.unregister(User)
+
+
+@admin.register(User)
+class UserAdmin(CascadeAttemptsMixin, BaseUserAdmin):
+    pass
 
 
 @admin.register(Quiz)
-class QuizAdmin(admin.ModelAdmin):
+class QuizAdmin(CascadeAttemptsMixin, admin.ModelAdmin):
     list_display = ['title', 'user', 'created_at', 'score', 'is_public']
+    # Автор может быть пустым, поэтому автоматический select_related его не подтягивает
+    list_select_related = ['user']
     list_filter = ['created_at', 'is_public', 'user']
     search_fields = ['title', 'user__username']
     readonly_fields = ['created_at']
@@ -16,15 +38,21 @@ class QuestionAdmin(admin.ModelAdmin):
     list_filter = ['quiz']
     search_fields = ['text', 'quiz__title']
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(answer_count=Count('answers'))
+    
     def get_answer_count(self, obj):
-        return obj.answers.count()
+        return obj.answer_count
     get_answer_count.short_description = 'Количество ответов'
+    get_answer_count.admin_order_field = 'answer_count'
 
 
 @admin.register(Answer)
 class AnswerAdmin(admin.ModelAdmin):
     list_display = ['text', 'question', 'is_correct']
     list_filter = ['is_correct', 'question__quiz']
+    # Строка вопроса включает название теста
+    list_select_related = ['question__quiz']
     search_fields = ['text', 'question__text']
 
 
@@ -32,6 +60,7 @@ class AnswerAdmin(admin.ModelAdmin):
 class UserAnswerAdmin(admin.ModelAdmin):
     list_display = ['user', 'question', 'answer', 'is_correct']
     list_filter = ['is_correct', 'user']
+    list_select_related = ['user', 'question__quiz', 'answer__question']
     search_fields = ['user__username', 'question__text', 'answer__text']
 
 
@@ -54,4 +83,40 @@ class UserStatsAdmin(admin.ModelAdmin):
     list_display = ['user', 'total_quizzes_created', 'total_quizzes_completed', 'total_points', 'average_score']
     list_filter = ['last_activity']
     search_fields = ['user__username']
-    readonly_fields = ['last_activity']
\ No newline at end of file
+    readonly_fields = ['last_activity']
+
+
+@admin.register(QuizAttempt)
+class QuizAttemptAdmin(admin.ModelAdmin):
+    list_display = ['quiz', 'user', 'score', 'correct_answers', 'question_count', 'created_at']
+    list_select_related = ['quiz', 'user']
+    list_filter = ['created_at']
+    search_fields = ['quiz__title', 'user__username']
+    # Попытки только добавляются при проверке ответов, из админки их можно лишь просматривать
+    readonly_fields = ['quiz', 'user', 'score', 'correct_answers', 'answered_questions', 'question_count', 'created_at']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PointsEntry)
+class PointsEntryAdmin(admin.ModelAdmin):
+    list_display = ['user', 'points', 'created_at']
+    list_filter = ['created_at']
+    search_fields = ['user__username']
+    readonly_fields = ['created_at']
+
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ['topic', 'user', 'question_count', 'status', 'attempts', 'created_at', 'finished_at']
+    list_select_related = ['user']
+    list_filter = ['status', 'created_at']
+    search_fields = ['topic', 'user__username', 'owner_key']
+    readonly_fields = ['created_at', 'started_at', 'finished_at']
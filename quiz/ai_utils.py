@@ -0,0 +1,559 @@
+import asyncio
+import json
+import math
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+
+from .models import Quiz, Question, Answer
+from .stats_utils import record_quiz_creation
+from .cache_utils import get_cached_quiz_data, cache_quiz_data
+from .llm_client import LLMClientError, LLMHTTPError, CircuitOpenError
+from .llm_providers import get_llm_router
+from .file_utils import split_text_into_sections, allocate_questions
+from .quiz_utils import bump_content_version
+from .quiz_parser import QuizParseError, QuizStreamParser, parse_quiz_output, repair_question, record_repairs
+
+
+# Увеличивайте при изменении промптов, чтобы не отдавать из кэша старые ответы
+PROMPT_VERSION = 2
+
+# Большие тесты запрашиваются параллельными частями не больше чем по столько вопросов
+QUESTIONS_PER_REQUEST = 10
+# Сколько частей одного теста запрашивается одновременно
+MAX_PARALLEL_PARTS = 8
+
+_parts_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='quiz-parts')
+
+TOPIC_SYSTEM_PROMPT = "Ты эксперт по созданию образовательных тестов. Создавай качественные вопросы с четкими вариантами ответов."
+FILE_SYSTEM_PROMPT = "Ты эксперт по созданию образовательных тестов. Анализируй предоставленный текст и создавай качественные вопросы с четкими вариантами ответов на основе содержания."
+
+QUIZ_JSON_FORMAT = '''{{
+"title": "{title}",
+"questions": [
+{{
+"question": "Текст вопроса",
+"answers": [
+{{"text": "Вариант ответа 1", "is_correct": true}},
+{{"text": "Вариант ответа 2", "is_correct": false}},
+{{"text": "Вариант ответа 3", "is_correct": false}},
+{{"text": "Вариант ответа 4", "is_correct": false}}
+]
+}}
+]
+}}'''
+
+
+class QuizGenerationError(Exception):
+    """Ошибка генерации теста, текст которой можно показать пользователю"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def ensure_llm_configured():
+    """Проверяет, что хотя бы у одного провайдера языковой модели задан ключ API"""
+    if not get_llm_router().is_configured:
+        raise QuizGenerationError('DeepSeek API ключ не настроен', status=500)
+
+
+def split_question_count(question_count, chunk_size=QUESTIONS_PER_REQUEST):
+    """Делит число вопросов на почти равные части не больше chunk_size"""
+    parts = max(1, math.ceil(question_count / chunk_size))
+    base, extra = divmod(question_count, parts)
+    return [base + 1 if index < extra else base for index in range(parts)]
+
+
+def build_topic_payload(topic, question_count, part=1, parts=1):
+    """Собирает запрос к DeepSeek для генерации теста (или его части) по теме"""
+    quiz_format = QUIZ_JSON_FORMAT.format(title="Название теста")
+    part_hint = ''
+    if parts > 1:
+        part_hint = (
+            f'\n\nЭто часть {part} из {parts} большого теста. Чтобы вопросы разных частей не повторялись, '
+            f'раскрой в этой части свои аспекты темы.'
+        )
+
+    prompt = f'''Создай JSON с викториной по теме "{topic}".
+
+ВАЖНО: Верни ТОЛЬКО валидный JSON без дополнительного текста, комментариев или markdown разметки.
+
+Формат:
+{quiz_format}
+
+Создай ровно {question_count} вопросов с 4 вариантами ответов каждый. Только один ответ должен быть правильным на каждый вопрос.{part_hint}'''
+
+    return {
+        "messages": [
+            {"role": "system", "content": TOPIC_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        # Лимит ответа растет с числом вопросов, чтобы большие части не обрезались
+        "max_tokens": min(4000, 400 + 200 * question_count),
+        "temperature": 0.7
+    }
+
+
+def build_file_payload(text, question_count, section=1, sections=1):
+    """Собирает запрос к DeepSeek для генерации теста по тексту файла (или его фрагменту)"""
+    quiz_format = QUIZ_JSON_FORMAT.format(title="Название теста на основе текста")
+    section_hint = ''
+    if sections > 1:
+        section_hint = (
+            f'\n\nЭто фрагмент {section} из {sections} большого документа. '
+            f'Задавай вопросы только по содержанию этого фрагмента, а название теста давай по теме всего документа.'
+        )
+
+    prompt = f'''Проанализируй следующий текст и создай JSON с викториной на его основе.
+
+ТЕКСТ ДЛЯ АНАЛИЗА:
+{text}
+
+ВАЖНО: Верни ТОЛЬКО валидный JSON без дополнительного текста, комментариев или markdown разметки.
+
+Формат:
+{quiz_format}
+
+Создай ровно {question_count} вопросов с 4 вариантами ответов каждый на основе предоставленного текста. Только один ответ должен быть правильным на каждый вопрос.{section_hint}'''
+
+    return {
+        "messages": [
+            {"role": "system", "content": FILE_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": min(4000, 400 + 200 * question_count),
+        "temperature": 0.7
+    }
+
+
+def _client_error(error):
+    """Переводит ошибку клиента API в сообщение для пользователя"""
+    if isinstance(error, CircuitOpenError):
+        return QuizGenerationError('DeepSeek API временно недоступен, попробуйте позже', status=503)
+    if isinstance(error, LLMHTTPError):
+        return QuizGenerationError(f'Ошибка API DeepSeek: {error.status_code}', status=500)
+    return QuizGenerationError(f'Ошибка сети при обращении к DeepSeek API: {str(error)}', status=500)
+
+
+def request_quiz_content(payload, timeout):
+    """Синхронно запрашивает генерацию у языковой модели и возвращает текст ответа"""
+    try:
+        response_data = get_llm_router().complete(payload, timeout)
+    except LLMClientError as e:
+        raise _client_error(e)
+    return response_data['choices'][0]['message']['content']
+
+
+async def arequest_quiz_content(payload, timeout):
+    """Асинхронно запрашивает генерацию у языковой модели и возвращает текст ответа.
+
+    Отмена корутины (например, при отключении клиента) прерывает и запрос к API.
+    """
+    try:
+        response_data = await get_llm_router().acomplete(payload, timeout)
+    except LLMClientError as e:
+        raise _client_error(e)
+    return response_data['choices'][0]['message']['content']
+
+
+async def astream_quiz_content(payload, timeout):
+    """Запрашивает генерацию в потоковом режиме и отдает фрагменты текста по мере поступления"""
+    payload = dict(payload, stream=True)
+    try:
+        async for line in get_llm_router().astream_lines(payload, timeout):
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                break
+            delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+            if delta:
+                yield delta
+    except LLMClientError as e:
+        raise _client_error(e)
+
+
+def parse_quiz_content(quiz_content):
+    """Извлекает тест из ответа модели, исправляя или отбрасывая некорректные вопросы"""
+    try:
+        return parse_quiz_output(quiz_content)
+    except QuizParseError as e:
+        raise QuizGenerationError(f'Не удалось распарсить JSON от DeepSeek: {str(e)}', status=500)
+
+
+def _is_cacheable(quiz_data):
+    return (
+        isinstance(quiz_data, dict)
+        and quiz_data.get('title')
+        and isinstance(quiz_data.get('questions'), list)
+        and len(quiz_data['questions']) > 0
+    )
+
+
+def get_cached_topic_quiz_data(topic, question_count, record_miss=True):
+    """Возвращает данные теста по теме из кэша ответов модели или None"""
+    return get_cached_quiz_data(topic, question_count, get_llm_router().default_model, PROMPT_VERSION, record_miss=record_miss)
+
+
+def _question_key(question_data):
+    """Ключ для поиска повторов: регистр, пробелы и знаки препинания не важны"""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', question_data['question'].casefold()).split())
+
+
+def merge_quiz_parts(parts_data, question_count):
+    """Объединяет ответы модели на части теста, отбрасывая повторы и неполные вопросы"""
+    title = next((data['title'] for data in parts_data if isinstance(data, dict) and data.get('title')), None)
+    questions = []
+    seen = set()
+    for data in parts_data:
+        if not isinstance(data, dict) or not isinstance(data.get('questions'), list):
+            continue
+        for question_data in data['questions']:
+            question_data = repair_question(question_data)
+            if question_data is None:
+                continue
+            key = _question_key(question_data)
+            if key not in seen:
+                seen.add(key)
+                questions.append(question_data)
+    return {'title': title, 'questions': questions[:question_count]}
+
+
+def _request_part(payload, timeout):
+    return parse_quiz_content(request_quiz_content(payload, timeout=timeout))
+
+
+async def _arequest_part(payload, timeout):
+    return parse_quiz_content(await arequest_quiz_content(payload, timeout=timeout))
+
+
+def _request_parts(payloads, timeout):
+    """Параллельно выполняет запросы частей теста; возвращает разобранные ответы и ошибки"""
+    futures = [_parts_executor.submit(_request_part, payload, timeout) for payload in payloads]
+    parts_data, errors = [], []
+    for future in futures:
+        try:
+            parts_data.append(future.result())
+        except QuizGenerationError as e:
+            errors.append(e)
+    return parts_data, errors
+
+
+async def _arequest_parts(payloads, timeout):
+    """Асинхронный вариант _request_parts"""
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_PARTS)
+
+    async def request_part(payload):
+        async with semaphore:
+            return await _arequest_part(payload, timeout)
+
+    results = await asyncio.gather(*(request_part(payload) for payload in payloads), return_exceptions=True)
+    parts_data, errors = [], []
+    for result in results:
+        if isinstance(result, QuizGenerationError):
+            errors.append(result)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            parts_data.append(result)
+    return parts_data, errors
+
+
+def _shortfall(parts_data, question_count):
+    """Сколько вопросов не хватает после объединения частей, если их стоит дозапросить"""
+    if not parts_data:
+        return 0
+    missing = question_count - len(merge_quiz_parts(parts_data, question_count)['questions'])
+    return missing if 0 < missing <= QUESTIONS_PER_REQUEST else 0
+
+
+def _merge_or_raise(parts_data, errors, default_title, question_count):
+    quiz_data = merge_quiz_parts(parts_data, question_count)
+    if not quiz_data['questions']:
+        if errors:
+            raise errors[0]
+        raise QuizGenerationError('DeepSeek не вернул ни одного вопроса', status=500)
+    quiz_data['title'] = (quiz_data['title'] or default_title)[:200]
+    return quiz_data
+
+
+def _topic_part_payloads(topic, question_count):
+    counts = split_question_count(question_count)
+    return [build_topic_payload(topic, count, index + 1, len(counts)) for index, count in enumerate(counts)]
+
+
+def request_topic_quiz_data(topic, question_count, timeout=30):
+    """Запрашивает тест по теме; большой тест делится на части, которые запрашиваются параллельно.
+
+    Если после объединения частей вопросов не хватает (ошибка части или повторы),
+    недостающие запрашиваются одним дополнительным запросом.
+    """
+    payloads = _topic_part_payloads(topic, question_count)
+    if len(payloads) == 1:
+        return _merge_or_raise([_request_part(payloads[0], timeout)], [], topic, question_count)
+
+    parts_data, errors = _request_parts(payloads, timeout)
+    missing = _shortfall(parts_data, question_count)
+    if missing:
+        part = len(payloads) + 1
+        extra_data, extra_errors = _request_parts([build_topic_payload(topic, missing, part, part)], timeout)
+        parts_data += extra_data
+        errors += extra_errors
+
+    return _merge_or_raise(parts_data, errors, topic, question_count)
+
+
+async def arequest_topic_quiz_data(topic, question_count, timeout=30):
+    """Асинхронный вариант request_topic_quiz_data"""
+    payloads = _topic_part_payloads(topic, question_count)
+    if len(payloads) == 1:
+        return _merge_or_raise([await _arequest_part(payloads[0], timeout)], [], topic, question_count)
+
+    parts_data, errors = await _arequest_parts(payloads, timeout)
+    missing = _shortfall(parts_data, question_count)
+    if missing:
+        part = len(payloads) + 1
+        extra_data, extra_errors = await _arequest_parts([build_topic_payload(topic, missing, part, part)], timeout)
+        parts_data += extra_data
+        errors += extra_errors
+
+    return _merge_or_raise(parts_data, errors, topic, question_count)
+
+
+def build_file_payloads(text, question_count):
+    """Делит документ на фрагменты и собирает запросы для тех, кому достались вопросы"""
+    sections = split_text_into_sections(text)
+    allocation = allocate_questions([len(section) for section in sections], question_count)
+    used = [(section, count) for section, count in zip(sections, allocation) if count]
+    return [
+        build_file_payload(section, count, index + 1, len(used))
+        for index, (section, count) in enumerate(used)
+    ]
+
+
+def request_file_quiz_data(text, question_count, timeout=60):
+    """Генерирует тест по всему документу: фрагменты обрабатываются параллельно, вопросы объединяются"""
+    payloads = build_file_payloads(text, question_count)
+    if len(payloads) == 1:
+        return _merge_or_raise([_request_part(payloads[0], timeout)], [], 'Тест по документу', question_count)
+
+    parts_data, errors = _request_parts(payloads, timeout)
+    return _merge_or_raise(parts_data, errors, 'Тест по документу', question_count)
+
+
+async def arequest_file_quiz_data(text, question_count, timeout=60):
+    """Асинхронный вариант request_file_quiz_data"""
+    payloads = build_file_payloads(text, question_count)
+    if len(payloads) == 1:
+        return _merge_or_raise([await _arequest_part(payloads[0], timeout)], [], 'Тест по документу', question_count)
+
+    parts_data, errors = await _arequest_parts(payloads, timeout)
+    return _merge_or_raise(parts_data, errors, 'Тест по документу', question_count)
+
+
+def generate_topic_quiz_data(topic, question_count, timeout=30):
+    """Возвращает данные теста по теме и признак того, что они взяты из кэша"""
+    quiz_data = get_cached_topic_quiz_data(topic, question_count)
+    if quiz_data is not None:
+        return quiz_data, True
+
+    quiz_data = request_topic_quiz_data(topic, question_count, timeout=timeout)
+    if _is_cacheable(quiz_data):
+        cache_quiz_data(topic, question_count, get_llm_router().default_model, PROMPT_VERSION, quiz_data)
+    return quiz_data, False
+
+
+async def agenerate_topic_quiz_data(topic, question_count, timeout=30):
+    """Асинхронный вариант generate_topic_quiz_data"""
+    quiz_data = get_cached_topic_quiz_data(topic, question_count)
+    if quiz_data is not None:
+        return quiz_data, True
+
+    quiz_data = await arequest_topic_quiz_data(topic, question_count, timeout=timeout)
+    if _is_cacheable(quiz_data):
+        cache_quiz_data(topic, question_count, get_llm_router().default_model, PROMPT_VERSION, quiz_data)
+    return quiz_data, False
+
+
+def save_quiz_questions(quiz, questions_data):
+    """Сохраняет вопросы теста с вариантами ответов двумя пакетными INSERT"""
+    questions = Question.objects.bulk_create([
+        Question(quiz=quiz, text=question_data['question'])
+        for question_data in questions_data
+    ])
+    Answer.objects.bulk_create([
+        Answer(question=question, text=answer_data['text'], is_correct=answer_data['is_correct'])
+        for question, question_data in zip(questions, questions_data)
+        for answer_data in question_data['answers']
+    ])
+    # Пакетная вставка не отправляет сигналы, поэтому версию содержимого меняем сами
+    bump_content_version(quiz.id)
+    return questions
+
+
+def create_quiz_question(quiz, question_data):
+    """Сохраняет один вопрос теста вместе с вариантами ответов"""
+    with transaction.atomic():
+        return save_quiz_questions(quiz, [question_data])[0]
+
+
+def register_quiz_creation(user):
+    """Обновляет статистику пользователя при создании теста"""
+    if user:
+        record_quiz_creation(user)
+
+
+def save_generated_quiz(quiz_data, user):
+    """Сохраняет сгенерированный тест одной транзакцией и обновляет статистику автора"""
+    with transaction.atomic():
+        quiz = Quiz.objects.create(
+            title=quiz_data['title'],
+            user=user
+        )
+        save_quiz_questions(quiz, quiz_data['questions'])
+        register_quiz_creation(user)
+
+    return quiz
+
+
+async def astream_topic_quiz(topic, question_count, user):
+    """Генерирует тест по теме в потоковом режиме.
+
+    Отдает пары (событие, данные): 'quiz' - тест создан и его уже можно открыть,
+    'question' - очередной вопрос сохранен, 'done' - генерация завершена.
+    Если генерация прервана (ошибка или отключение клиента), недостроенный тест удаляется.
+    """
+    quiz_data = get_cached_topic_quiz_data(topic, question_count)
+    if quiz_data is not None:
+        quiz = await sync_to_async(save_generated_quiz)(quiz_data, user)
+        yield 'done', {
+            'quiz_id': quiz.id,
+            'redirect_url': f'/quiz/{quiz.id}/',
+            'question_count': len(quiz_data['questions']),
+            'cached': True
+        }
+        return
+
+    counts = split_question_count(question_count)
+    events = asyncio.Queue()
+    tasks = [
+        asyncio.ensure_future(_astream_topic_part(topic, count, index + 1, len(counts), events))
+        for index, count in enumerate(counts)
+    ]
+    titles = {}
+    quiz = None
+    questions = []
+    seen = set()
+    errors = []
+    finished = 0
+    completed = False
+
+    try:
+        # Части генерируются параллельно, вопросы сохраняются в порядке поступления
+        while finished < len(tasks):
+            kind, part, value = await events.get()
+            if kind == 'title':
+                titles.setdefault(part, value)
+                continue
+            if kind == 'error':
+                errors.append(value)
+                continue
+            if kind == 'end':
+                finished += 1
+                missing = question_count - len(questions)
+                if finished == len(tasks) == len(counts) > 1 and questions and 0 < missing <= QUESTIONS_PER_REQUEST:
+                    # Из-за повторов или ошибки части вопросов не хватает - дозапрашиваем один раз
+                    part = len(counts) + 1
+                    tasks.append(asyncio.ensure_future(_astream_topic_part(topic, missing, part, part, events)))
+                continue
+
+            key = _question_key(value)
+            if key in seen or len(questions) >= question_count:
+                continue
+            seen.add(key)
+
+            if quiz is None:
+                title = (titles.get(1) or next(iter(titles.values()), None) or topic)[:200]
+                quiz = await sync_to_async(Quiz.objects.create)(title=title, user=user)
+                # Создание засчитывается автору только в конце; до этого удаление его не вычитает
+                quiz.creation_counted = False
+                yield 'quiz', {'quiz_id': quiz.id, 'redirect_url': f'/quiz/{quiz.id}/'}
+
+            await sync_to_async(create_quiz_question)(quiz, value)
+            questions.append(value)
+            yield 'question', {
+                'index': len(questions),
+                'total': question_count,
+                'text': value['question']
+            }
+
+        if quiz is None:
+            if errors:
+                raise errors[0]
+            raise QuizGenerationError('DeepSeek не вернул ни одного вопроса', status=500)
+
+        # Название берем из первой части, даже если ее вопросы пришли не первыми
+        title = (titles.get(1) or quiz.title)[:200]
+        if title != quiz.title:
+            quiz.title = title
+            await sync_to_async(quiz.save)(update_fields=['title'])
+        await sync_to_async(register_quiz_creation)(user)
+        quiz.creation_counted = True
+        quiz_data = {'title': quiz.title, 'questions': questions}
+
+        # Оборванный поток дает неполный тест - такой ответ в кэш не кладем
+        if _is_cacheable(quiz_data) and len(questions) >= question_count:
+            cache_quiz_data(topic, question_count, get_llm_router().default_model, PROMPT_VERSION, quiz_data)
+
+        completed = True
+        yield 'done', {
+            'quiz_id': quiz.id,
+            'redirect_url': f'/quiz/{quiz.id}/',
+            'question_count': len(questions),
+            'cached': False
+        }
+    finally:
+        for task in tasks:
+            task.cancel()
+        if not completed and quiz is not None:
+            await sync_to_async(quiz.delete)()
+
+
+async def _astream_topic_part(topic, question_count, part, parts, events):
+    """Получает часть теста потоком и кладет в очередь события по мере разбора ответа"""
+    parser = QuizStreamParser()
+    repairs = Counter()
+    streamed = 0
+    title_sent = False
+    try:
+        payload = build_topic_payload(topic, question_count, part, parts)
+        async for chunk in astream_quiz_content(payload, timeout=30):
+            for question_data in parser.feed(chunk):
+                if parser.title and not title_sent:
+                    title_sent = True
+                    await events.put(('title', part, parser.title))
+                question_data = repair_question(question_data, repairs)
+                if question_data is not None:
+                    streamed += 1
+                    await events.put(('question', part, question_data))
+
+        if streamed:
+            if parser.title and not title_sent:
+                await events.put(('title', part, parser.title))
+        else:
+            # Ответ не удалось разобрать по ходу - пробуем целиком
+            quiz_data = parse_quiz_content(parser.text)
+            if quiz_data['title']:
+                await events.put(('title', part, quiz_data['title']))
+            for question_data in quiz_data['questions']:
+                await events.put(('question', part, question_data))
+    except QuizGenerationError as e:
+        await events.put(('error', part, e))
+    finally:
+        record_repairs(repairs)
+        events.put_nowait(('end', part, None))
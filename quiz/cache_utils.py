@@ -0,0 +1,121 @@
+import hashlib
+
+from django.core.cache import caches
+
+
+COUNTER_CACHE_ALIAS = 'counters'
+
+LLM_CACHE_ALIAS = 'llm'
+LLM_CACHE_HITS_KEY = 'llm_cache:hits'
+LLM_CACHE_MISSES_KEY = 'llm_cache:misses'
+
+DOCUMENT_CACHE_ALIAS = 'documents'
+DOCUMENT_CACHE_HITS_KEY = 'document_cache:hits'
+DOCUMENT_CACHE_MISSES_KEY = 'document_cache:misses'
+DOCUMENT_CACHE_BYTES_SAVED_KEY = 'document_cache:bytes_saved'
+
+
+def incr_counter(key, delta=1):
+    """Увеличивает счетчик в общем для всех процессов кэше counters.
+
+    Файловый кэш увеличивает значение чтением и записью, поэтому при одновременных
+    увеличениях из разных процессов отдельные приращения могут теряться - для
+    статистики попаданий это допустимо.
+    """
+    counters = caches[COUNTER_CACHE_ALIAS]
+    counters.add(key, 0, timeout=None)
+    try:
+        return counters.incr(key, delta)
+    except ValueError:
+        # Счетчик успели удалить между add и incr
+        counters.set(key, delta, timeout=None)
+        return delta
+
+
+def get_counters(keys):
+    """Значения счетчиков: {ключ: значение}, отсутствующие счетчики равны 0"""
+    counters = caches[COUNTER_CACHE_ALIAS].get_many(keys)
+    return {key: counters.get(key, 0) for key in keys}
+
+
+def normalize_topic(topic):
+    """Приводит тему к каноническому виду: регистр и пробелы не важны"""
+    return ' '.join(topic.casefold().split()).strip(' .!?')
+
+
+def get_topic_cache_key(topic, question_count, model, prompt_version):
+    """Строит ключ кэша по содержимому запроса к модели"""
+    raw_key = f'{prompt_version}|{model}|{question_count}|{normalize_topic(topic)}'
+    return 'quiz:' + hashlib.sha256(raw_key.encode('utf-8')).hexdigest()
+
+
+def get_cached_quiz_data(topic, question_count, model, prompt_version, record_miss=True):
+    """Возвращает разобранный ответ модели из кэша или None.
+
+    record_miss=False - для предварительной проверки, после которой запрос к модели
+    сделает другой процесс: промах учтет он, когда проверит кэш перед запросом.
+    """
+    key = get_topic_cache_key(topic, question_count, model, prompt_version)
+    quiz_data = caches[LLM_CACHE_ALIAS].get(key)
+    if quiz_data is not None:
+        incr_counter(LLM_CACHE_HITS_KEY)
+    elif record_miss:
+        incr_counter(LLM_CACHE_MISSES_KEY)
+    return quiz_data
+
+
+def cache_quiz_data(topic, question_count, model, prompt_version, quiz_data):
+    """Сохраняет разобранный ответ модели в кэш"""
+    key = get_topic_cache_key(topic, question_count, model, prompt_version)
+    caches[LLM_CACHE_ALIAS].set(key, quiz_data)
+
+
+def get_llm_cache_stats():
+    """Возвращает счетчики попаданий в кэш ответов модели"""
+    counters = get_counters([LLM_CACHE_HITS_KEY, LLM_CACHE_MISSES_KEY])
+    hits = counters[LLM_CACHE_HITS_KEY]
+    misses = counters[LLM_CACHE_MISSES_KEY]
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def get_document_cache_key(digest, extractor_version):
+    """Ключ кэша извлеченного текста по хэшу содержимого файла"""
+    return f'document:{extractor_version}:{digest}'
+
+
+def get_cached_document_text(digest, extractor_version, file_size):
+    """Возвращает извлеченный ранее текст файла или None.
+
+    При попадании file_size байт не приходится разбирать заново - они учитываются как сэкономленные.
+    """
+    text = caches[DOCUMENT_CACHE_ALIAS].get(get_document_cache_key(digest, extractor_version))
+    if text is not None:
+        incr_counter(DOCUMENT_CACHE_HITS_KEY)
+        incr_counter(DOCUMENT_CACHE_BYTES_SAVED_KEY, file_size)
+    else:
+        incr_counter(DOCUMENT_CACHE_MISSES_KEY)
+    return text
+
+
+def cache_document_text(digest, extractor_version, text):
+    """Сохраняет извлеченный из файла текст"""
+    caches[DOCUMENT_CACHE_ALIAS].set(get_document_cache_key(digest, extractor_version), text)
+
+
+def get_document_cache_stats():
+    """Возвращает счетчики кэша извлеченного из файлов текста"""
+    counters = get_counters([DOCUMENT_CACHE_HITS_KEY, DOCUMENT_CACHE_MISSES_KEY, DOCUMENT_CACHE_BYTES_SAVED_KEY])
+    hits = counters[DOCUMENT_CACHE_HITS_KEY]
+    misses = counters[DOCUMENT_CACHE_MISSES_KEY]
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / total if total else 0.0,
+        'bytes_saved': counters[DOCUMENT_CACHE_BYTES_SAVED_KEY],
+    }
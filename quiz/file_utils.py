@@ -1,73 +1,336 @@
+import hashlib
+import io
+import math
+import multiprocessing
 import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 import PyPDF2
 from docx import Document
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.conf import settings
+from django.core.signals import setting_changed
 
+from .cache_utils import get_cached_document_text, cache_document_text
 
-def extract_text_from_pdf(file_path):
+
+def iter_pdf_pages(file, max_pages=None):
+    """Постранично отдает текст PDF файла (путь или файловый объект)"""
+    pdf_reader = PyPDF2.PdfReader(file)
+    for index, page in enumerate(pdf_reader.pages):
+        if max_pages is not None and index >= max_pages:
+            break
+        yield page.extract_text() or ""
+
+
+def iter_docx_paragraphs(file):
+    """Отдает текст абзацев Word документа (путь или файловый объект)"""
+    for paragraph in Document(file).paragraphs:
+        yield paragraph.text
+
+
+def join_text_parts(parts, max_chars=None):
+    """Склеивает части текста через перенос строки, прекращая чтение после max_chars символов"""
+    collected = []
+    length = 0
+    for part in parts:
+        collected.append(part)
+        length += len(part) + 1
+        if max_chars is not None and length >= max_chars:
+            break
+    return "\n".join(collected).strip()
+
+
+def extract_text_from_pdf(file, max_pages=None, max_chars=None):
     """Извлекает текст из PDF файла"""
     try:
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text.strip()
+        return join_text_parts(iter_pdf_pages(file, max_pages), max_chars)
     except Exception as e:
         raise Exception(f"Ошибка при чтении PDF: {str(e)}")
 
 
-def extract_text_from_docx(file_path):
+# Последний открытый документ в процессе пула: диапазоны страниц одного PDF не разбирают его заново
+_open_pdf_cache = (None, None)
+
+
+def _open_pdf(path):
+    global _open_pdf_cache
+    # Временный файл с тем же именем может оказаться уже другим документом
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    cached_key, reader = _open_pdf_cache
+    if cached_key != key:
+        reader = PyPDF2.PdfReader(path)
+        _open_pdf_cache = (key, reader)
+    return reader
+
+
+@contextmanager
+def pdf_source_path(source):
+    """Путь к PDF, который процессы пула читают сами.
+
+    Путь отдается как есть; bytes (замеры и тесты) один раз записываются во временный
+    файл, чтобы документ не копировался в каждую задачу пула. Загрузки сюда не попадают:
+    в пул идут только загрузки, которые Django уже сохранил во временный файл.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        yield os.fspath(source)
+        return
+    spooled = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+    try:
+        with spooled:
+            spooled.write(source)
+        yield spooled.name
+    finally:
+        os.remove(spooled.name)
+
+
+def _pdf_page_count(path):
+    return len(_open_pdf(path).pages)
+
+
+def _pdf_pages_text(args):
+    """Извлекает текст диапазона страниц; выполняется в процессе пула"""
+    path, start, end = args
+    pages = _open_pdf(path).pages
+    return [pages[index].extract_text() or "" for index in range(start, end)]
+
+
+# forkserver порождает процессы из отдельного чистого процесса - без потоков и соединений веб-процесса,
+# но без полного запуска интерпретатора на каждый документ, как у spawn
+PDF_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+if PDF_START_METHOD == 'forkserver':
+    multiprocessing.get_context(PDF_START_METHOD).set_forkserver_preload([__name__])
+
+
+def _pdf_pool_size():
+    return max(1, min(settings.FILE_EXTRACT_WORKERS, settings.FILE_EXTRACT_MAX_PROCESSES))
+
+
+def _create_pdf_pool():
+    """Отдельный пул для одного документа: его можно убить, не затрагивая разбор других документов"""
+    return multiprocessing.get_context(PDF_START_METHOD).Pool(processes=_pdf_pool_size())
+
+
+# Сколько пулов документов может работать одновременно, чтобы всего процессов было не больше FILE_EXTRACT_MAX_PROCESSES
+_pdf_pool_slots = None
+_pdf_pool_slots_lock = threading.Lock()
+
+
+def _get_pdf_pool_slots():
+    global _pdf_pool_slots
+    with _pdf_pool_slots_lock:
+        if _pdf_pool_slots is None:
+            _pdf_pool_slots = threading.BoundedSemaphore(max(1, settings.FILE_EXTRACT_MAX_PROCESSES // _pdf_pool_size()))
+        return _pdf_pool_slots
+
+
+def _reset_pdf_pool_slots(setting, **kwargs):
+    global _pdf_pool_slots
+    if setting in ('FILE_EXTRACT_WORKERS', 'FILE_EXTRACT_MAX_PROCESSES'):
+        with _pdf_pool_slots_lock:
+            _pdf_pool_slots = None
+
+
+setting_changed.connect(_reset_pdf_pool_slots)
+
+
+def _pdf_source_size(source):
+    return len(source) if isinstance(source, bytes) else os.path.getsize(source)
+
+
+def extract_text_from_pdf_parallel(source, max_pages=None, max_chars=None, time_budget=None):
+    """Извлекает текст PDF (путь или bytes) в пуле процессов, сохраняя порядок страниц.
+
+    Документ меньше FILE_EXTRACT_PARALLEL_MIN_BYTES разбирается в текущем процессе.
+    Процессам передается только путь к документу (см. pdf_source_path).
+    Страницы делятся на диапазоны, которые разбираются параллельно в собственном
+    пуле документа. Пулов одновременно не больше, чем помещается в
+    FILE_EXTRACT_MAX_PROCESSES; ожидание свободного места входит в time_budget.
+    Если документ не уложился в time_budget секунд, уничтожаются только его
+    процессы: испорченный PDF не занимает воркер навсегда и не прерывает разбор
+    других загрузок.
+    """
+    if _pdf_source_size(source) < settings.FILE_EXTRACT_PARALLEL_MIN_BYTES:
+        file = io.BytesIO(source) if isinstance(source, bytes) else source
+        return extract_text_from_pdf(file, max_pages=max_pages, max_chars=max_chars)
+
+    if time_budget is None:
+        time_budget = settings.FILE_EXTRACT_TIME_BUDGET
+    deadline = time.monotonic() + time_budget
+
+    def remaining():
+        return max(0.0, deadline - time.monotonic())
+
+    slots = _get_pdf_pool_slots()
+    if not slots.acquire(timeout=remaining()):
+        raise Exception("Превышено время обработки PDF")
+    try:
+        return _extract_in_pdf_pool(source, max_pages, max_chars, remaining)
+    finally:
+        slots.release()
+
+
+def _extract_in_pdf_pool(source, max_pages, max_chars, remaining):
+    pool = _create_pdf_pool()
+    try:
+        with pdf_source_path(source) as path:
+            page_count = pool.apply_async(_pdf_page_count, (path,)).get(remaining())
+            if max_pages is not None:
+                page_count = min(page_count, max_pages)
+
+            # По два диапазона на процесс, чтобы быстрые процессы забирали работу у медленных
+            batch_size = max(1, math.ceil(page_count / (_pdf_pool_size() * 2)))
+            ranges = [(path, start, min(start + batch_size, page_count)) for start in range(0, page_count, batch_size)]
+            results = pool.imap(_pdf_pages_text, ranges)
+
+            def pages():
+                for _ in ranges:
+                    yield from results.next(remaining())
+
+            return join_text_parts(pages(), max_chars)
+    except multiprocessing.TimeoutError:
+        raise Exception("Превышено время обработки PDF")
+    except Exception as e:
+        raise Exception(f"Ошибка при чтении PDF: {str(e)}")
+    finally:
+        pool.terminate()
+
+
+def extract_text_from_docx(file, max_chars=None):
     """Извлекает текст из Word документа"""
     try:
-        doc = Document(file_path)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text.strip()
+        return join_text_parts(iter_docx_paragraphs(file), max_chars)
     except Exception as e:
         raise Exception(f"Ошибка при чтении Word документа: {str(e)}")
 
 
+def check_upload_size(uploaded_file):
+    """Отклоняет файлы больше FILE_UPLOAD_MAX_BYTES"""
+    if uploaded_file.size > settings.FILE_UPLOAD_MAX_BYTES:
+        max_mb = settings.FILE_UPLOAD_MAX_BYTES // (1024 * 1024)
+        raise Exception(f"Файл слишком большой. Максимальный размер - {max_mb} МБ.")
+
+
 def process_uploaded_file(uploaded_file):
-    """Обрабатывает загруженный файл и извлекает текст"""
-    # Сохраняем файл временно
-    file_name = uploaded_file.name
-    file_extension = os.path.splitext(file_name)[1].lower()
-    
-    # Создаем временный файл
-    temp_path = default_storage.save(f'temp/{file_name}', ContentFile(uploaded_file.read()))
-    full_path = default_storage.path(temp_path)
-    
-    try:
-        # Извлекаем текст в зависимости от типа файла
-        if file_extension == '.pdf':
-            text = extract_text_from_pdf(full_path)
-        elif file_extension in ['.docx', '.doc']:
-            text = extract_text_from_docx(full_path)
-        else:
-            raise Exception("Неподдерживаемый формат файла. Поддерживаются только PDF и Word документы.")
-        
-        # Очищаем временный файл
-        default_storage.delete(temp_path)
-        
-        return text
-    
-    except Exception as e:
-        # Удаляем временный файл в случае ошибки
-        if default_storage.exists(temp_path):
-            default_storage.delete(temp_path)
-        raise e
+    """Извлекает текст прямо из загруженного файла, не читая его целиком в память"""
+    file_extension = os.path.splitext(uploaded_file.name)[1].lower()
+    check_upload_size(uploaded_file)
+
+    # Django уже держит загрузку в памяти или во временном файле - читаем оттуда
+    uploaded_file.seek(0)
+    if file_extension == '.pdf':
+        # Большую загрузку Django уже сохранил во временный файл - его процессы пула читают сами.
+        # Маленькая загрузка в памяти разбирается здесь же, без записи на диск и запуска пула
+        if settings.FILE_EXTRACT_WORKERS and hasattr(uploaded_file, 'temporary_file_path'):
+            return extract_text_from_pdf_parallel(
+                uploaded_file.temporary_file_path(),
+                max_pages=settings.FILE_EXTRACT_MAX_PAGES,
+                max_chars=settings.FILE_EXTRACT_MAX_CHARS
+            )
+        return extract_text_from_pdf(
+            uploaded_file,
+            max_pages=settings.FILE_EXTRACT_MAX_PAGES,
+            max_chars=settings.FILE_EXTRACT_MAX_CHARS
+        )
+    if file_extension in ['.docx', '.doc']:
+        return extract_text_from_docx(uploaded_file, max_chars=settings.FILE_EXTRACT_MAX_CHARS)
+    raise Exception("Неподдерживаемый формат файла. Поддерживаются только PDF и Word документы.")
+
+
+# Увеличивайте при изменении извлечения или очистки текста, чтобы не отдавать из кэша старый текст
+EXTRACTOR_VERSION = 1
 
 
-def clean_text_for_ai(text, max_length=8000):
-    """Очищает и обрезает текст для отправки в AI"""
+def hash_uploaded_file(uploaded_file):
+    """Считает SHA-256 содержимого загрузки, читая ее по частям"""
+    digest = hashlib.sha256()
+    for chunk in uploaded_file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_document_text(uploaded_file):
+    """Возвращает очищенный текст загруженного файла; повторная загрузка того же файла берется из кэша"""
+    check_upload_size(uploaded_file)
+    file_extension = os.path.splitext(uploaded_file.name)[1].lower()
+    # От формата и лимитов зависит извлеченный текст, поэтому они входят в ключ
+    version = f'{EXTRACTOR_VERSION}:{file_extension}:{settings.FILE_EXTRACT_MAX_PAGES}:{settings.FILE_EXTRACT_MAX_CHARS}'
+    digest = hash_uploaded_file(uploaded_file)
+
+    text = get_cached_document_text(digest, version, uploaded_file.size)
+    if text is None:
+        text = clean_text_for_ai(process_uploaded_file(uploaded_file))
+        cache_document_text(digest, version, text)
+    return text
+
+
+# Размер фрагмента документа, который отправляется модели одним запросом
+SECTION_MAX_TOKENS = 2000
+# Грубая оценка для русского текста: токен в среднем занимает около трех символов
+CHARS_PER_TOKEN = 3
+
+SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+')
+
+
+def clean_text_for_ai(text, max_length=None):
+    """Очищает текст для отправки в AI и при необходимости обрезает его до max_length"""
     # Удаляем лишние пробелы и переносы строк
     text = ' '.join(text.split())
     
     # Обрезаем текст если он слишком длинный
-    if len(text) > max_length:
+    if max_length is not None and len(text) > max_length:
         text = text[:max_length] + "..."
     
     return text
+
+
+def estimate_tokens(text):
+    """Приблизительно оценивает число токенов в тексте"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def split_text_into_sections(text, max_tokens=SECTION_MAX_TOKENS):
+    """Делит текст на фрагменты не длиннее max_tokens, по возможности по границам предложений"""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    sections = []
+    current = []
+    current_length = 0
+
+    for sentence in SENTENCE_END_RE.split(text):
+        # Слишком длинное предложение режем на куски
+        pieces = [sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars)] or ['']
+        for piece in pieces:
+            if current and current_length + 1 + len(piece) > max_chars:
+                sections.append(' '.join(current))
+                current, current_length = [], 0
+            current.append(piece)
+            current_length += len(piece) + (1 if current_length else 0)
+
+    if current:
+        sections.append(' '.join(current))
+    return [section for section in sections if section.strip()]
+
+
+def allocate_questions(section_sizes, question_count):
+    """Распределяет вопросы по фрагментам пропорционально их размеру.
+
+    Вопрос с номером i достается фрагменту, в который попадает точка (i + 0.5) / question_count
+    документа, поэтому при нехватке вопросов на все фрагменты они равномерно покрывают весь текст.
+    """
+    total = sum(section_sizes)
+    counts = [0] * len(section_sizes)
+    if not total:
+        return counts
+
+    index = 0
+    boundary = section_sizes[0]
+    for i in range(question_count):
+        point = (i + 0.5) * total / question_count
+        while point > boundary and index < len(section_sizes) - 1:
+            index += 1
+            boundary += section_sizes[index]
+        counts[index] += 1
+    return counts
@@ -0,0 +1,154 @@
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Answer, UserAnswer
+
+
+# Ключ ответов теста после генерации не меняется, поэтому хранится долго
+ANSWER_KEY_TIMEOUT = 60 * 60 * 24
+
+
+def _answer_key_cache_key(quiz_id, content_version):
+    return f'answer_key:{quiz_id}:{content_version}'
+
+
+def get_answer_key(quiz_id, content_version):
+    """Ключ ответов теста: {id вопроса: (id правильного ответа, id всех вариантов)}.
+
+    Строится одним запросом и кэшируется для версии содержимого теста
+    (Quiz.content_version): после правки вопросов или ответов в любом процессе
+    версия растет, и старый ключ больше не используется.
+    """
+    cache_key = _answer_key_cache_key(quiz_id, content_version)
+    answer_key = cache.get(cache_key)
+    if answer_key is not None:
+        return answer_key
+
+    options = {}
+    correct = {}
+    answers = (
+        Answer.objects.filter(question__quiz_id=quiz_id)
+        .order_by('question_id', 'id')
+        .values_list('question_id', 'id', 'is_correct')
+    )
+    for question_id, answer_id, is_correct in answers:
+        options.setdefault(question_id, []).append(answer_id)
+        if is_correct and question_id not in correct:
+            correct[question_id] = answer_id
+
+    answer_key = {
+        question_id: (correct.get(question_id), tuple(answer_ids))
+        for question_id, answer_ids in options.items()
+    }
+    cache.set(cache_key, answer_key, ANSWER_KEY_TIMEOUT)
+    return answer_key
+
+
+def filter_answers(answer_key, selected):
+    """Оставляет ответы на вопросы теста существующими вариантами: {id вопроса: id ответа} числами"""
+    answers = {}
+    for question_id, answer_id in selected.items():
+        try:
+            question_id, answer_id = int(question_id), int(answer_id)
+        except (TypeError, ValueError):
+            continue
+        if question_id in answer_key and answer_id in answer_key[question_id][1]:
+            answers[question_id] = answer_id
+    return answers
+
+
+def grade_answers(answer_key, selected):
+    """Проверяет ответы {id вопроса: id ответа} по ключу, не обращаясь к БД.
+
+    Ответы на чужие вопросы и несуществующие варианты пропускаются.
+    Возвращает {id вопроса: (верно ли, id правильного ответа)}.
+    """
+    results = {}
+    for question_id, answer_id in filter_answers(answer_key, selected).items():
+        correct_id = answer_key[question_id][0]
+        results[question_id] = (answer_id == correct_id, correct_id)
+    return results
+
+
+def _checked_answers_session_key(quiz_id):
+    return f'quiz_{quiz_id}_checked'
+
+
+def get_checked_answers(session, quiz_id, content_version):
+    """Ответы, по которым уже показана мгновенная проверка: {id вопроса: id ответа}"""
+    checked = session.get(_checked_answers_session_key(quiz_id))
+    if not checked or checked['version'] != content_version:
+        return {}
+    return {int(question_id): answer_id for question_id, answer_id in checked['answers'].items()}
+
+
+def lock_checked_answers(session, quiz_id, content_version, answers):
+    """Закрепляет в сессии проверенные ответы; возвращает answers с уже закрепленными вариантами.
+
+    После мгновенной проверки правильный ответ известен, поэтому сменить проверенный
+    ответ нельзя: и повторная проверка, и отправка теста засчитывают первый вариант.
+    """
+    checked = get_checked_answers(session, quiz_id, content_version)
+    locked = {question_id: checked.get(question_id, answer_id) for question_id, answer_id in answers.items()}
+    if not locked.items() <= checked.items():
+        session[_checked_answers_session_key(quiz_id)] = {
+            'version': content_version,
+            'answers': {str(question_id): answer_id for question_id, answer_id in {**locked, **checked}.items()},
+        }
+    return locked
+
+
+def clear_checked_answers(session, quiz_id):
+    """Забывает проверенные ответы после отправки теста: новая попытка начинается заново"""
+    session.pop(_checked_answers_session_key(quiz_id), None)
+
+
+def read_selected_answers(data, question_ids):
+    """Достает из формы выбранные ответы: {id вопроса: id ответа}"""
+    selected = {}
+    for question_id in question_ids:
+        answer_id = data.get(f'question_{question_id}')
+        if not answer_id:
+            continue
+        try:
+            selected[question_id] = int(answer_id)
+        except (TypeError, ValueError):
+            continue
+    return selected
+
+
+def grade_submission(quiz, data, user=None, checked=None):
+    """Проверяет ответы на тест за фиксированное число запросов, независимо от числа вопросов.
+
+    Правильность берется из кэшированного ключа ответов, результат считается в
+    памяти. checked - ответы, закрепленные мгновенной проверкой: они заменяют
+    присланные в форме. Ответы авторизованного пользователя сохраняются одним
+    пакетным upsert в транзакции.
+    Возвращает (число правильных ответов, число вопросов, принятые ответы {id вопроса: id ответа}).
+    """
+    answer_key = get_answer_key(quiz.id, quiz.content_version)
+    selected = read_selected_answers(data, answer_key)
+    if checked:
+        selected.update(checked)
+    results = grade_answers(answer_key, selected)
+    accepted = {question_id: selected[question_id] for question_id in results}
+    correct_answers = sum(1 for is_correct, _ in results.values() if is_correct)
+
+    if user and accepted:
+        with transaction.atomic():
+            UserAnswer.objects.bulk_create(
+                [
+                    UserAnswer(
+                        user=user,
+                        question_id=question_id,
+                        answer_id=answer_id,
+                        is_correct=results[question_id][0]
+                    )
+                    for question_id, answer_id in accepted.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['user', 'question'],
+                update_fields=['answer', 'is_correct']
+            )
+
+    return correct_answers, len(answer_key), accepted
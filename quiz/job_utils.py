@@ -0,0 +1,144 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Min
+from django.utils import timezone
+
+from .models import GenerationJob
+from .ai_utils import QuizGenerationError, generate_topic_quiz_data, save_generated_quiz
+
+
+# Сколько пользователей с ожидающими заданиями рассматривать за один выбор
+CANDIDATE_OWNERS_LIMIT = 50
+
+# Сколько раз пытаться сохранить результат задания (например, если SQLite занята другим потоком)
+FINISH_JOB_ATTEMPTS = 3
+FINISH_JOB_RETRY_DELAY = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def get_owner_key(request):
+    """Возвращает ключ владельца задания для справедливого планирования"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def enqueue_generation_job(topic, question_count, user, owner_key):
+    """Ставит генерацию теста по теме в очередь"""
+    return GenerationJob.objects.create(
+        topic=topic,
+        question_count=question_count,
+        user=user,
+        owner_key=owner_key
+    )
+
+
+def claim_next_job(max_per_owner=None):
+    """Забирает следующее задание из очереди с учетом справедливости между пользователями.
+
+    Первым обслуживается пользователь с наименьшим числом выполняющихся заданий,
+    при равенстве - тот, чье самое старое задание ждет дольше всех.
+    """
+    if max_per_owner is None:
+        max_per_owner = settings.GENERATION_JOB_MAX_PER_OWNER
+
+    running = dict(
+        GenerationJob.objects.filter(status=GenerationJob.STATUS_RUNNING)
+        .values_list('owner_key')
+        .annotate(count=Count('id'))
+    )
+    candidates = (
+        GenerationJob.objects.filter(status=GenerationJob.STATUS_PENDING)
+        .values('owner_key')
+        .annotate(oldest=Min('created_at'))
+        .order_by('oldest')[:CANDIDATE_OWNERS_LIMIT]
+    )
+    candidates = sorted(candidates, key=lambda c: (running.get(c['owner_key'], 0), c['oldest']))
+
+    for candidate in candidates:
+        owner_key = candidate['owner_key']
+        if max_per_owner and running.get(owner_key, 0) >= max_per_owner:
+            continue
+
+        job_id = (
+            GenerationJob.objects.filter(status=GenerationJob.STATUS_PENDING, owner_key=owner_key)
+            .order_by('created_at')
+            .values_list('id', flat=True)
+            .first()
+        )
+        if job_id is None:
+            continue
+
+        # Условное обновление защищает от двойного захвата несколькими воркерами
+        claimed = GenerationJob.objects.filter(id=job_id, status=GenerationJob.STATUS_PENDING).update(
+            status=GenerationJob.STATUS_RUNNING,
+            started_at=timezone.now(),
+            attempts=F('attempts') + 1
+        )
+        if claimed:
+            return GenerationJob.objects.select_related('user').get(id=job_id)
+
+    return None
+
+
+def _finish_job(job, status, quiz=None, error='', from_cache=False):
+    """Сохраняет результат задания; возвращает False, если сохранить не удалось.
+
+    Ошибка сохранения не теряется молча: она пишется в лог, а задание, оставшееся
+    в статусе running, позже вернет в очередь requeue_stale_jobs.
+    """
+    for attempt in range(1, FINISH_JOB_ATTEMPTS + 1):
+        try:
+            GenerationJob.objects.filter(id=job.id).update(
+                status=status,
+                quiz=quiz,
+                error=error,
+                from_cache=from_cache,
+                finished_at=timezone.now()
+            )
+            return True
+        except Exception:
+            if attempt == FINISH_JOB_ATTEMPTS:
+                logger.exception('Не удалось сохранить результат задания %s (статус %s)', job.id, status)
+                return False
+            time.sleep(FINISH_JOB_RETRY_DELAY)
+
+
+def run_generation_job(job):
+    """Выполняет задание: запрос к DeepSeek (или кэшу), разбор ответа и сохранение теста.
+
+    Возвращает True, если результат задания сохранен.
+    """
+    try:
+        quiz_data, from_cache = generate_topic_quiz_data(job.topic, job.question_count)
+        quiz = save_generated_quiz(quiz_data, job.user)
+    except QuizGenerationError as e:
+        return _finish_job(job, GenerationJob.STATUS_FAILED, error=e.message)
+    except Exception as e:
+        logger.exception('Ошибка при выполнении задания %s', job.id)
+        return _finish_job(job, GenerationJob.STATUS_FAILED, error=f'Ошибка при генерации теста: {str(e)}')
+    return _finish_job(job, GenerationJob.STATUS_DONE, quiz=quiz, from_cache=from_cache)
+
+
+def requeue_stale_jobs(timeout=None, max_attempts=None):
+    """Возвращает в очередь задания, зависшие после падения воркера"""
+    if timeout is None:
+        timeout = settings.GENERATION_JOB_TIMEOUT
+    if max_attempts is None:
+        max_attempts = settings.GENERATION_JOB_MAX_ATTEMPTS
+
+    stale = GenerationJob.objects.filter(
+        status=GenerationJob.STATUS_RUNNING,
+        started_at__lt=timezone.now() - timedelta(seconds=timeout)
+    )
+    failed = stale.filter(attempts__gte=max_attempts).update(
+        status=GenerationJob.STATUS_FAILED,
+        error='Превышено время ожидания генерации теста',
+        finished_at=timezone.now()
+    )
+    requeued = stale.update(status=GenerationJob.STATUS_PENDING, started_at=None)
+    return requeued, failed
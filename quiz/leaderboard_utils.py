@@ -0,0 +1,151 @@
+import math
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import UserStats, PointsEntry
+
+
+# Период рейтинга -> за сколько последних дней считаются очки (None - за все время)
+LEADERBOARD_PERIODS = {
+    'all': None,
+    'week': timedelta(days=7),
+    'month': timedelta(days=30),
+}
+
+
+def _leaderboard_cache():
+    return caches['leaderboard']
+
+
+def _page_cache_key(period, page):
+    return f'leaderboard:{period}:page:{page}'
+
+
+def _built_cache_key(period):
+    return f'leaderboard:{period}:built'
+
+
+def _leaderboard_row(rank, user_id, username, first_name, last_name, points, quizzes_completed):
+    return {
+        'rank': rank,
+        'user_id': user_id,
+        'username': username,
+        'full_name': f'{first_name} {last_name}'.strip() or username,
+        'points': points,
+        'quizzes_completed': quizzes_completed or 0,
+    }
+
+
+def _ranking_queryset(period):
+    """Рейтинг за период по убыванию очков; при равенстве выше меньший id пользователя"""
+    fields = ('user_id', 'user__username', 'user__first_name', 'user__last_name')
+    window = LEADERBOARD_PERIODS[period]
+    if window is None:
+        return (
+            UserStats.objects.order_by('-total_points', 'user_id')
+            .values_list(*fields, 'total_points', 'total_quizzes_completed')
+        )
+    return (
+        PointsEntry.objects.filter(created_at__gte=timezone.now() - window)
+        .values(*fields, 'user__userstats__total_quizzes_completed')
+        .annotate(points=Sum('points'))
+        .filter(points__gt=0)
+        .order_by('-points', 'user_id')
+        .values_list(*fields, 'points', 'user__userstats__total_quizzes_completed')
+    )
+
+
+def build_leaderboard(period):
+    """Материализует рейтинг за период постранично в общем кэше leaderboard; возвращает число строк.
+
+    Каждая страница хранится отдельным ключом вместе с числом страниц и временем
+    сборки, поэтому чтение любой страницы, даже далекой, - одно обращение к кэшу.
+    Кэш хранится в БД и виден всем процессам; собирает его команда build_leaderboards.
+    """
+    page_size = settings.LEADERBOARD_PAGE_SIZE
+    timeout = settings.LEADERBOARD_TIMEOUT
+    rows = [_leaderboard_row(rank, *row) for rank, row in enumerate(_ranking_queryset(period).iterator(), 1)]
+    page_count = max(1, math.ceil(len(rows) / page_size))
+    built_at = int(time.time())
+    leaderboard_cache = _leaderboard_cache()
+
+    pages = {
+        _page_cache_key(period, page): {
+            'period': period,
+            'page': page,
+            'page_count': page_count,
+            'total': len(rows),
+            'built_at': built_at,
+            'rows': rows[(page - 1) * page_size:page * page_size],
+        }
+        for page in range(1, page_count + 1)
+    }
+    leaderboard_cache.set_many(pages, timeout)
+    # Страницы прошлой сборки, которых больше нет, удаляются
+    previous_count = leaderboard_cache.get(_built_cache_key(period), 0)
+    leaderboard_cache.delete_many([_page_cache_key(period, page) for page in range(page_count + 1, previous_count + 1)])
+    leaderboard_cache.set(_built_cache_key(period), page_count, timeout)
+    return len(rows)
+
+
+def build_all_leaderboards():
+    """Пересобирает рейтинги за все периоды: {период: число строк}"""
+    return {period: build_leaderboard(period) for period in LEADERBOARD_PERIODS}
+
+
+def _query_leaderboard_page(period, page):
+    """Одна страница рейтинга прямо из БД (OFFSET/LIMIT и COUNT), без сборки всего рейтинга"""
+    page_size = settings.LEADERBOARD_PAGE_SIZE
+    ranking = _ranking_queryset(period)
+    total = ranking.count()
+    page_count = max(1, math.ceil(total / page_size))
+    if page > page_count:
+        return None
+    offset = (page - 1) * page_size
+    return {
+        'period': period,
+        'page': page,
+        'page_count': page_count,
+        'total': total,
+        'built_at': int(time.time()),
+        'rows': [
+            _leaderboard_row(rank, *row)
+            for rank, row in enumerate(ranking[offset:offset + page_size], offset + 1)
+        ],
+    }
+
+
+def get_leaderboard_page(period='all', page=1):
+    """Страница рейтинга из снимка; если снимка нет или он устарел, страница читается прямо из БД.
+
+    Прочитанная из БД страница кладется в кэш на время жизни снимка, поэтому следующее
+    чтение - снова одно обращение к кэшу. Весь рейтинг запрос пользователя никогда не
+    пересобирает - это делает команда build_leaderboards. Для страницы за пределами
+    рейтинга возвращает None.
+    """
+    if period not in LEADERBOARD_PERIODS:
+        raise ValueError(f'Неизвестный период рейтинга: {period}')
+    page_key = _page_cache_key(period, page)
+    built_key = _built_cache_key(period)
+    leaderboard_cache = _leaderboard_cache()
+    cached = leaderboard_cache.get_many([page_key, built_key])
+    # Число страниц снимка проверяется первым: страница, сохраненная при промахе, могла пережить сборку
+    if built_key in cached and page > cached[built_key]:
+        return None
+    if page_key in cached:
+        return cached[page_key]
+    leaderboard_page = _query_leaderboard_page(period, page)
+    if leaderboard_page is not None:
+        leaderboard_cache.set(page_key, leaderboard_page, settings.LEADERBOARD_TIMEOUT)
+    return leaderboard_page
+
+
+def get_top_users(limit=10, period='all'):
+    """Первые limit строк рейтинга"""
+    leaderboard_page = get_leaderboard_page(period, 1)
+    return leaderboard_page['rows'][:limit] if leaderboard_page else []
@@ -0,0 +1,275 @@
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+# Ответы, после которых имеет смысл повторить запрос
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class LLMClientError(Exception):
+    """Базовая ошибка обращения к API языковой модели"""
+
+
+class LLMNetworkError(LLMClientError):
+    """Сетевая ошибка: нет соединения, таймаут, обрыв ответа"""
+
+
+class LLMHTTPError(LLMClientError):
+    """API вернул неуспешный HTTP статус"""
+
+    def __init__(self, status_code):
+        super().__init__(f'HTTP {status_code}')
+        self.status_code = status_code
+
+
+class CircuitOpenError(LLMClientError):
+    """Запрос не отправлен: API недавно был недоступен и цепь разомкнута"""
+
+
+class CircuitBreaker:
+    """Размыкатель цепи: после серии ошибок подряд временно перестает пускать запросы.
+
+    В разомкнутом состоянии запросы сразу завершаются ошибкой. По истечении
+    reset_timeout пропускается один пробный запрос: успех замыкает цепь,
+    ошибка снова размыкает ее.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _refresh_state(self):
+        """По истечении reset_timeout переводит разомкнутую цепь в ожидание пробного запроса"""
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+    def allows_request(self):
+        """Пропустит ли цепь запрос сейчас; в отличие от before_request пробный запрос не занимает"""
+        with self._lock:
+            self._refresh_state()
+            return self.state == self.CLOSED or (self.state == self.HALF_OPEN and not self._probe_in_flight)
+
+    def before_request(self):
+        """Проверяет, можно ли отправить запрос, иначе бросает CircuitOpenError.
+
+        Возвращает True, если запрос пробный: его исход решает, замкнется ли цепь.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            self._refresh_state()
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+        raise CircuitOpenError('API временно недоступен')
+
+    def release_probe(self):
+        """Пробный запрос отменен, не дойдя до исхода: следующий запрос станет пробным"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning('Цепь к API языковой модели разомкнута после %s ошибок', self._failures)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+def parse_retry_after(value):
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата) в число секунд"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class ChatCompletionClient:
+    """Клиент OpenAI-совместимого API с пулом соединений, повторами и размыкателем цепи.
+
+    Один экземпляр разделяется всеми запросами процесса: синхронные вызовы идут
+    через общий requests.Session, асинхронные - через httpx.AsyncClient своего event loop.
+    """
+
+    def __init__(self, url, pool_size=20, max_retries=2, backoff_base=0.5, backoff_max=8.0,
+                 max_retry_after=20.0, breaker=None):
+        self.url = url
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retry_after = max_retry_after
+        self.breaker = breaker or CircuitBreaker()
+
+        # Пул ограничен pool_size keep-alive соединениями; лишние соединения не удерживаются
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def get_async_client(self):
+        """Возвращает httpx-клиент для текущего event loop"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size * 25, max_keepalive_connections=self.pool_size)
+            )
+            self._async_clients[loop] = client
+        return client
+
+    def _retry_delay(self, attempt, retry_after=None):
+        """Пауза перед повтором или None, если повторять не нужно"""
+        if attempt >= self.max_retries:
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            if retry_after > self.max_retry_after:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+    def _handle_status(self, attempt, status_code, retry_after):
+        """Учитывает неуспешный ответ; возвращает паузу перед повтором или бросает ошибку"""
+        if status_code in RETRY_STATUS_CODES:
+            self.breaker.record_failure()
+            delay = self._retry_delay(attempt, retry_after)
+            if delay is not None:
+                logger.info('API вернул %s, повтор через %.1f с', status_code, delay)
+                return delay
+        else:
+            # Ошибки клиента (4xx) не говорят о недоступности API
+            self.breaker.record_success()
+        raise LLMHTTPError(status_code)
+
+    def _release_probe(self, probe):
+        """Освобождает пробный запрос, прерванный до исхода (отмена, выход генератора)"""
+        if probe:
+            self.breaker.release_probe()
+
+    def _handle_network_error(self, attempt, error, retryable=True):
+        self.breaker.record_failure()
+        delay = self._retry_delay(attempt) if retryable else None
+        if delay is None:
+            raise LLMNetworkError(str(error)) from error
+        logger.info('Сетевая ошибка при обращении к API (%s), повтор через %.1f с', error, delay)
+        return delay
+
+    def post(self, payload, headers, timeout):
+        """Отправляет запрос и возвращает разобранный JSON ответа"""
+        attempt = 0
+        while True:
+            probe = self.breaker.before_request()
+            try:
+                response = self.session.post(self.url, json=payload, headers=headers, timeout=timeout)
+            except requests.exceptions.ReadTimeout as e:
+                # Модель уже не уложилась в таймаут - повтор только удвоит ожидание
+                self._handle_network_error(attempt, e, retryable=False)
+            except requests.exceptions.RequestException as e:
+                time.sleep(self._handle_network_error(attempt, e))
+            except BaseException:
+                self._release_probe(probe)
+                raise
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    return response.json()
+                time.sleep(self._handle_status(attempt, response.status_code, response.headers.get('Retry-After')))
+            attempt += 1
+
+    async def apost(self, payload, headers, timeout):
+        """Асинхронный вариант post"""
+        attempt = 0
+        while True:
+            probe = self.breaker.before_request()
+            try:
+                response = await self.get_async_client().post(self.url, json=payload, headers=headers, timeout=timeout)
+            except httpx.ReadTimeout as e:
+                self._handle_network_error(attempt, e, retryable=False)
+            except httpx.HTTPError as e:
+                await asyncio.sleep(self._handle_network_error(attempt, e))
+            except BaseException:
+                # Отмена (клиент отключился, дублирующий запрос проиграл) ничего не говорит о доступности API
+                self._release_probe(probe)
+                raise
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    return response.json()
+                await asyncio.sleep(self._handle_status(attempt, response.status_code, response.headers.get('Retry-After')))
+            attempt += 1
+
+    async def astream_lines(self, payload, headers, timeout):
+        """Отправляет потоковый запрос и отдает строки ответа по мере поступления.
+
+        Повторы возможны только до получения первых данных.
+        """
+        attempt = 0
+        while True:
+            probe = self.breaker.before_request()
+            started = False
+            delay = None
+            try:
+                async with self.get_async_client().stream(
+                    'POST', self.url, json=payload, headers=headers, timeout=timeout
+                ) as response:
+                    if response.status_code != 200:
+                        delay = self._handle_status(attempt, response.status_code, response.headers.get('Retry-After'))
+                    else:
+                        self.breaker.record_success()
+                        started = True
+                        async for line in response.aiter_lines():
+                            yield line
+                        return
+            except httpx.ReadTimeout as e:
+                self._handle_network_error(attempt, e, retryable=False)
+            except httpx.HTTPError as e:
+                delay = self._handle_network_error(attempt, e, retryable=not started)
+            except BaseException:
+                self._release_probe(probe)
+                raise
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
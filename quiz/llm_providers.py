@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from .llm_client import ChatCompletionClient, CircuitBreaker, CircuitOpenError, LLMClientError
+
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Скользящее окно длительностей успешных запросов"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, percent, min_samples=1):
+        """Возвращает перцентиль длительности или None, если данных пока мало"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < max(1, min_samples):
+            return None
+        index = min(len(samples) - 1, math.ceil(percent / 100 * len(samples)) - 1)
+        return samples[max(0, index)]
+
+
+class LLMProvider:
+    """OpenAI-совместимый бэкенд языковой модели со своим пулом соединений и статистикой задержек"""
+
+    def __init__(self, name, url, api_key, model, priority=0):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.priority = priority
+        self.client = ChatCompletionClient(
+            url,
+            pool_size=settings.LLM_HTTP_POOL_SIZE,
+            max_retries=settings.LLM_MAX_RETRIES,
+            breaker=CircuitBreaker(
+                failure_threshold=settings.LLM_CIRCUIT_FAILURE_THRESHOLD,
+                reset_timeout=settings.LLM_CIRCUIT_RESET_TIMEOUT
+            )
+        )
+        self._latency = {}
+        self._latency_lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<LLMProvider {self.name}>'
+
+    @property
+    def is_available(self):
+        # Разомкнутая цепь снова доступна для пробного запроса по истечении reset_timeout
+        return bool(self.api_key) and self.client.breaker.allows_request()
+
+    def latency_for(self, payload):
+        """Статистика задержек для запросов такого же размера (по max_tokens)"""
+        key = payload.get('max_tokens')
+        with self._latency_lock:
+            tracker = self._latency.get(key)
+            if tracker is None:
+                tracker = self._latency[key] = LatencyTracker()
+            return tracker
+
+    def _prepare(self, payload):
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+        return dict(payload, model=self.model), headers
+
+    def complete(self, payload, timeout):
+        payload, headers = self._prepare(payload)
+        started = time.monotonic()
+        response_data = self.client.post(payload, headers, timeout)
+        self.latency_for(payload).record(time.monotonic() - started)
+        return response_data
+
+    async def acomplete(self, payload, timeout):
+        payload, headers = self._prepare(payload)
+        started = time.monotonic()
+        response_data = await self.client.apost(payload, headers, timeout)
+        self.latency_for(payload).record(time.monotonic() - started)
+        return response_data
+
+    def astream_lines(self, payload, timeout):
+        payload, headers = self._prepare(payload)
+        return self.client.astream_lines(payload, headers, timeout)
+
+
+class ProviderRouter:
+    """Выбирает провайдера по задержкам и страхует медленные запросы.
+
+    Первым идет доступный провайдер с наименьшей медианой задержки. Если его
+    ответ не пришел за p95 его задержки, параллельно отправляется страхующий
+    запрос следующему провайдеру и используется тот ответ, что пришел первым.
+    При ошибке запрос последовательно переходит к остальным провайдерам.
+    """
+
+    def __init__(self, providers, hedging_enabled=True, hedge_percentile=95, hedge_min_samples=20,
+                 hedge_min_delay=1.0):
+        self.providers = providers
+        self.hedging_enabled = hedging_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(4, settings.LLM_HTTP_POOL_SIZE),
+            thread_name_prefix='llm-hedge'
+        )
+
+    @property
+    def default_model(self):
+        return self.providers[0].model if self.providers else ''
+
+    @property
+    def is_configured(self):
+        return any(provider.api_key for provider in self.providers)
+
+    def ranked(self, payload):
+        """Доступные провайдеры, от самого быстрого к самому медленному"""
+        def sort_key(provider):
+            median = provider.latency_for(payload).percentile(50, self.hedge_min_samples)
+            return (median is None, median or 0, provider.priority)
+
+        providers = sorted((p for p in self.providers if p.is_available), key=sort_key)
+        if not providers:
+            raise CircuitOpenError('Нет доступных провайдеров языковой модели')
+        return providers
+
+    def hedge_delay(self, provider, payload):
+        """Через сколько секунд страховать запрос к провайдеру или None"""
+        if not self.hedging_enabled:
+            return None
+        p95 = provider.latency_for(payload).percentile(self.hedge_percentile, self.hedge_min_samples)
+        if p95 is None:
+            return None
+        return max(self.hedge_min_delay, p95)
+
+    def _complete_with_fallback(self, providers, payload, timeout):
+        last_error = None
+        for provider in providers:
+            try:
+                return provider.complete(payload, timeout)
+            except LLMClientError as e:
+                logger.warning('Провайдер %s не ответил: %s', provider.name, e)
+                last_error = e
+        raise last_error
+
+    def complete(self, payload, timeout):
+        """Выполняет запрос к лучшему провайдеру со страховкой и переходом на резервные.
+
+        Проигравший страхующий запрос дорабатывает в фоновом потоке, его ответ отбрасывается.
+        """
+        providers = self.ranked(payload)
+        primary, alternates = providers[0], providers[1:]
+        delay = self.hedge_delay(primary, payload) if alternates else None
+        if delay is None:
+            return self._complete_with_fallback(providers, payload, timeout)
+
+        futures = {self._executor.submit(primary.complete, payload, timeout): primary}
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            hedge = alternates[0]
+            logger.info('Провайдер %s не ответил за %.1f с, страхуем запросом к %s', primary.name, delay, hedge.name)
+            futures[self._executor.submit(hedge.complete, payload, timeout)] = hedge
+
+        pending = set(futures)
+        last_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except LLMClientError as e:
+                    logger.warning('Провайдер %s не ответил: %s', futures[future].name, e)
+                    last_error = e
+
+        remaining = [p for p in providers if p not in futures.values()]
+        if remaining:
+            return self._complete_with_fallback(remaining, payload, timeout)
+        raise last_error
+
+    async def acomplete(self, payload, timeout):
+        """Асинхронный вариант complete; проигравший запрос отменяется"""
+        providers = self.ranked(payload)
+        primary, alternates = providers[0], providers[1:]
+        delay = self.hedge_delay(primary, payload) if alternates else None
+
+        tasks = {asyncio.ensure_future(primary.acomplete(payload, timeout)): primary}
+        last_error = None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    hedge = alternates[0]
+                    logger.info('Провайдер %s не ответил за %.1f с, страхуем запросом к %s', primary.name, delay, hedge.name)
+                    tasks[asyncio.ensure_future(hedge.acomplete(payload, timeout))] = hedge
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None:
+                        return task.result()
+                    if not isinstance(error, LLMClientError):
+                        raise error
+                    logger.warning('Провайдер %s не ответил: %s', tasks[task].name, error)
+                    last_error = error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+        for provider in providers:
+            if provider in tasks.values():
+                continue
+            try:
+                return await provider.acomplete(payload, timeout)
+            except LLMClientError as e:
+                logger.warning('Провайдер %s не ответил: %s', provider.name, e)
+                last_error = e
+        raise last_error
+
+    async def astream_lines(self, payload, timeout):
+        """Потоковый запрос; на резервного провайдера переходит только до получения данных"""
+        last_error = None
+        for provider in self.ranked(payload):
+            started = False
+            try:
+                async for line in provider.astream_lines(payload, timeout):
+                    started = True
+                    yield line
+                return
+            except LLMClientError as e:
+                if started:
+                    raise
+                logger.warning('Провайдер %s не ответил: %s', provider.name, e)
+                last_error = e
+        raise last_error
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_llm_router():
+    """Возвращает общий для процесса маршрутизатор провайдеров из settings.LLM_PROVIDERS"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            providers = [
+                LLMProvider(
+                    name,
+                    url=config['URL'],
+                    api_key=config.get('API_KEY', ''),
+                    model=config['MODEL'],
+                    priority=index
+                )
+                for index, (name, config) in enumerate(settings.LLM_PROVIDERS.items())
+            ]
+            hedging = settings.LLM_HEDGING
+            _router = ProviderRouter(
+                providers,
+                hedging_enabled=hedging.get('ENABLED', True),
+                hedge_percentile=hedging.get('PERCENTILE', 95),
+                hedge_min_samples=hedging.get('MIN_SAMPLES', 20),
+                hedge_min_delay=hedging.get('MIN_DELAY', 1.0)
+            )
+        return _router
+
+
+def _reset_router(setting, **kwargs):
+    global _router
+    if setting in ('LLM_PROVIDERS', 'LLM_HEDGING'):
+        with _router_lock:
+            _router = None
+
+
+setting_changed.connect(_reset_router)
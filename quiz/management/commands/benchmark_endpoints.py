@@ -0,0 +1,503 @@
+import json
+import math
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timezone
+from unittest.mock import patch
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+from django.urls import reverse
+
+from quiz import urls as quiz_urls
+from quiz.achievement_utils import check_achievements
+from quiz.job_utils import enqueue_generation_job
+from quiz.models import Quiz, Question, Answer, UserAnswer, UserStats, QuizAttempt
+from quiz.stats_utils import create_default_achievements, recompute_user_stats
+from quiz.testing_utils import (
+    StubLLMRouter, build_synthetic_pdf, clear_caches, read_streaming_response, relocate_file_caches,
+)
+
+
+BATCH_SIZE = 2000
+
+# Сценарий замера: name - ключ в отчете, user - 'main', 'staff' или None (аноним),
+# request(номер повтора) -> (url, аргументы метода тестового клиента)
+Endpoint = namedtuple('Endpoint', ['name', 'url_name', 'method', 'user', 'request'])
+
+
+def percentile(sorted_values, percent):
+    """Перцентиль по методу ближайшего ранга"""
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _create_quizzes(quizzes, question_count):
+    """Сохраняет тесты пакетно; возвращает {id теста: [(id вопроса, id правильного ответа, id вариантов)]}"""
+    quizzes = Quiz.objects.bulk_create(quizzes, batch_size=BATCH_SIZE)
+    questions = Question.objects.bulk_create(
+        [
+            Question(quiz=quiz, text=f'Вопрос {number} теста «{quiz.title}»')
+            for quiz in quizzes
+            for number in range(question_count)
+        ],
+        batch_size=BATCH_SIZE
+    )
+    answers = Answer.objects.bulk_create(
+        [
+            Answer(question=question, text=f'Ответ {number}', is_correct=number == 0)
+            for question in questions
+            for number in range(4)
+        ],
+        batch_size=BATCH_SIZE
+    )
+    key = {quiz.id: [] for quiz in quizzes}
+    for number, question in enumerate(questions):
+        options = [answer.id for answer in answers[number * 4:number * 4 + 4]]
+        key[question.quiz_id].append((question.id, options[0], options))
+    return key
+
+
+def create_synthetic_dataset(rng, users, quizzes_per_user, questions, answered_quizzes, correct_rate, big_quiz_questions):
+    """Создает пользователей, их тесты, ответы, попытки, статистику и достижения.
+
+    Первый пользователь - основной: от его имени вызываются страницы, у него
+    есть большой публичный тест на big_quiz_questions вопросов.
+    """
+    prefix = f'endpoint-bench-{time.time_ns()}'
+    create_default_achievements()
+    staff = User.objects.create_superuser(username=f'{prefix}-staff', password='!')
+    main_user = User.objects.create_user(username=f'{prefix}-main', password='benchmark-password')
+    owners = [main_user] + User.objects.bulk_create(
+        [User(username=f'{prefix}-{number}', password='!') for number in range(1, users)],
+        batch_size=BATCH_SIZE
+    )
+
+    answer_key = _create_quizzes(
+        [
+            Quiz(user=owner, title=f'Тест {number} пользователя {owner.username}', is_public=rng.random() < 0.3)
+            for owner in owners
+            for number in range(quizzes_per_user)
+        ],
+        questions
+    )
+    big_quiz = Quiz(
+        user=main_user,
+        title='Большой тест',
+        is_public=True,
+        share_code=f'B{time.time_ns() % 10 ** 9:09d}'
+    )
+    answer_key.update(_create_quizzes([big_quiz], big_quiz_questions))
+
+    quiz_ids = sorted(answer_key)
+    user_answers = []
+    attempts = []
+    for user in owners:
+        for quiz_id in rng.sample(quiz_ids, min(answered_quizzes, len(quiz_ids))):
+            correct_answers = 0
+            for question_id, correct_id, options in answer_key[quiz_id]:
+                answer_id = correct_id if rng.random() < correct_rate else rng.choice(options[1:])
+                correct_answers += answer_id == correct_id
+                user_answers.append(UserAnswer(
+                    user=user, question_id=question_id, answer_id=answer_id, is_correct=answer_id == correct_id
+                ))
+            total = len(answer_key[quiz_id])
+            attempts.append(QuizAttempt(
+                quiz_id=quiz_id,
+                user=user,
+                score=correct_answers / total * 100,
+                correct_answers=correct_answers,
+                answered_questions=total,
+                question_count=total
+            ))
+    UserAnswer.objects.bulk_create(user_answers, batch_size=BATCH_SIZE)
+    QuizAttempt.objects.bulk_create(attempts, batch_size=BATCH_SIZE)
+
+    for user in owners:
+        check_achievements(user, recompute_user_stats(user))
+
+    return {
+        'prefix': prefix,
+        'staff': staff,
+        'main_user': main_user,
+        'big_quiz': big_quiz,
+        'answer_key': answer_key,
+        'counts': {
+            'users': len(owners),
+            'quizzes': len(answer_key),
+            'questions': sum(len(questions) for questions in answer_key.values()),
+            'user_answers': len(user_answers),
+            'attempts': len(attempts),
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет задержку, число запросов и пик памяти каждой страницы и API на синтетических данных '
+        'с заглушкой языковой модели во временной тестовой БД; печатает отчет в JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200, help='Сколько пользователей создать')
+        parser.add_argument('--quizzes-per-user', type=int, default=10, help='Сколько тестов у каждого пользователя')
+        parser.add_argument('--questions', type=int, default=10, help='Сколько вопросов в каждом тесте')
+        parser.add_argument(
+            '--big-quiz-questions',
+            type=int,
+            default=50,
+            help='Сколько вопросов в большом тесте, который открывают страницы теста'
+        )
+        parser.add_argument(
+            '--answered-quizzes',
+            type=int,
+            default=20,
+            help='Сколько случайных тестов прошел каждый пользователь'
+        )
+        parser.add_argument(
+            '--correct-rate',
+            type=float,
+            default=0.7,
+            help='Доля правильных ответов в синтетических прохождениях'
+        )
+        parser.add_argument('--repeat', type=int, default=20, help='Сколько замеров на каждый сценарий')
+        parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора данных')
+        parser.add_argument(
+            '--only',
+            nargs='+',
+            default=None,
+            help='Замерить только сценарии с этими именами URL'
+        )
+        parser.add_argument('--output', default=None, help='Файл для отчета (по умолчанию - стандартный вывод)')
+        parser.add_argument(
+            '--baseline',
+            default=None,
+            help='Отчет прошлого запуска: в отчет добавляются изменения относительно него'
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=20.0,
+            help='Рост p95 в процентах, при котором сценарий считается регрессией'
+        )
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat должен быть не меньше 1')
+        if options['users'] < 1 or options['questions'] < 1 or options['big_quiz_questions'] < 1:
+            raise CommandError('--users, --questions и --big-quiz-questions должны быть не меньше 1')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as baseline_file:
+                baseline = json.load(baseline_file)
+
+        # Файловые кэши подменяются временными, чтобы не трогать рабочие и начинать с пустых
+        cache_dir = tempfile.mkdtemp(prefix='endpoint-bench-')
+        bench_caches = relocate_file_caches(cache_dir)
+        router = StubLLMRouter()
+        # Замер идет во временной тестовой БД (как у manage.py test), рабочая БД не затрагивается
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], CACHES=bench_caches), \
+                    patch('quiz.ai_utils.get_llm_router', return_value=router):
+                report = self.run_benchmark(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        if baseline is not None:
+            report['regressions'] = self.compare(report, baseline, options['threshold'])
+
+        output = json.dumps(report, ensure_ascii=False, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output_file:
+                output_file.write(output + '\n')
+            self.stderr.write(f'Отчет сохранен в {options["output"]}')
+        else:
+            self.stdout.write(output)
+
+    def run_benchmark(self, options):
+        started = time.perf_counter()
+        data = create_synthetic_dataset(
+            random.Random(options['seed']),
+            users=options['users'],
+            quizzes_per_user=options['quizzes_per_user'],
+            questions=options['questions'],
+            answered_quizzes=options['answered_quizzes'],
+            correct_rate=options['correct_rate'],
+            big_quiz_questions=options['big_quiz_questions'],
+        )
+        self.stderr.write(f'Данные созданы за {time.perf_counter() - started:.1f} с: {data["counts"]}')
+
+        endpoints = self.build_endpoints(data, options['repeat'])
+        missing = {pattern.name for pattern in quiz_urls.urlpatterns} - {endpoint.url_name for endpoint in endpoints}
+        if missing:
+            self.stderr.write(self.style.WARNING(f'Нет сценариев для: {", ".join(sorted(missing))}'))
+        if options['only']:
+            endpoints = [endpoint for endpoint in endpoints if endpoint.url_name in options['only']]
+
+        results = {}
+        for endpoint in endpoints:
+            results[endpoint.name] = self.measure(endpoint, data, options['repeat'])
+            self.stderr.write(
+                f'{endpoint.name}: p50 {results[endpoint.name]["p50_ms"]:.2f} мс, '
+                f'p95 {results[endpoint.name]["p95_ms"]:.2f} мс, '
+                f'запросов {results[endpoint.name]["queries"]}'
+            )
+
+        return {
+            'commit': self.git_commit(),
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'platform': sys.platform,
+            },
+            'dataset': {
+                'users': options['users'],
+                'quizzes_per_user': options['quizzes_per_user'],
+                'questions': options['questions'],
+                'big_quiz_questions': options['big_quiz_questions'],
+                'answered_quizzes': options['answered_quizzes'],
+                'correct_rate': options['correct_rate'],
+                'seed': options['seed'],
+                'counts': data['counts'],
+            },
+            'repeat': options['repeat'],
+            'endpoints': results,
+        }
+
+    def build_endpoints(self, data, repeat):
+        """Сценарии для всех URL приложения; изменяющие данные сценарии на каждом повторе берут новый объект"""
+        main_user = data['main_user']
+        big_quiz = data['big_quiz']
+        prefix = data['prefix']
+        submission = {
+            f'question_{question_id}': correct_id
+            for question_id, correct_id, options in data['answer_key'][big_quiz.id]
+        }
+        own_quizzes = list(Quiz.objects.filter(user=main_user).exclude(id=big_quiz.id).values_list('id', flat=True))
+        # Для удаления - отдельные тесты на каждый повтор, включая прогрев и замер памяти
+        disposable = sorted(_create_quizzes(
+            [Quiz(user=main_user, title=f'Тест на удаление {number}') for number in range(repeat + 2)],
+            len(data['answer_key'][big_quiz.id])
+        ))
+        job = enqueue_generation_job('История Рима', 10, main_user, owner_key=f'user:{main_user.id}')
+        pdf = build_synthetic_pdf(3)
+        # Средняя страница рейтинга: первая и последняя могут быть особыми случаями
+        leaderboard_page = (math.ceil(UserStats.objects.count() / settings.LEADERBOARD_PAGE_SIZE) + 1) // 2
+
+        def get(url_name, *args, query=''):
+            return lambda number: (reverse(url_name, args=args) + query, {})
+
+        def post_json(url_name, payload, *args):
+            return lambda number: (
+                reverse(url_name, args=args),
+                {'data': json.dumps(payload), 'content_type': 'application/json'}
+            )
+
+        def post_file(url_name):
+            return lambda number: (reverse(url_name), {
+                'data': {
+                    'file': SimpleUploadedFile('lecture.pdf', pdf, content_type='application/pdf'),
+                    'questionCount': 20,
+                }
+            })
+
+        topic = {'topic': 'История Рима', 'questionCount': 20}
+        return [
+            Endpoint('index GET anonymous', 'index', 'get', None, get('index')),
+            Endpoint('index GET user', 'index', 'get', 'main', get('index')),
+            Endpoint('quiz_detail GET anonymous', 'quiz_detail', 'get', None, get('quiz_detail', big_quiz.id)),
+            Endpoint('quiz_detail GET user', 'quiz_detail', 'get', 'main', get('quiz_detail', big_quiz.id)),
+            Endpoint(
+                'quiz_detail POST user', 'quiz_detail', 'post', 'main',
+                lambda number: (reverse('quiz_detail', args=[big_quiz.id]), {'data': submission})
+            ),
+            Endpoint('quiz_results GET user', 'quiz_results', 'get', 'main', get('quiz_results', big_quiz.id)),
+            Endpoint(
+                'shared_quiz GET anonymous', 'shared_quiz', 'get', None, get('shared_quiz', big_quiz.share_code)
+            ),
+            Endpoint('my_quizzes GET user', 'my_quizzes', 'get', 'main', get('my_quizzes')),
+            Endpoint(
+                'generate_quiz POST user', 'generate_quiz', 'post', 'main',
+                post_json('generate_quiz', {'topic': 'История Рима', 'questionCount': 10})
+            ),
+            Endpoint(
+                'generate_quiz_from_file POST user', 'generate_quiz_from_file', 'post', 'main',
+                post_file('generate_quiz_from_file')
+            ),
+            Endpoint(
+                'generate_quiz_stream POST user', 'generate_quiz_stream', 'post', 'main',
+                post_json('generate_quiz_stream', topic)
+            ),
+            Endpoint(
+                'generation_job_status GET user', 'generation_job_status', 'get', 'main',
+                get('generation_job_status', job.id)
+            ),
+            Endpoint('cache_stats GET staff', 'cache_stats', 'get', 'staff', get('cache_stats')),
+            Endpoint(
+                'leaderboard GET all', 'leaderboard', 'get', None, get('leaderboard', query=f'?period=all&page={leaderboard_page}')
+            ),
+            Endpoint('leaderboard GET week', 'leaderboard', 'get', None, get('leaderboard', query='?period=week')),
+            Endpoint(
+                'generate_quiz_async POST user', 'generate_quiz_async', 'post', 'main',
+                post_json('generate_quiz_async', topic)
+            ),
+            Endpoint(
+                'generate_quiz_from_file_async POST user', 'generate_quiz_from_file_async', 'post', 'main',
+                post_file('generate_quiz_from_file_async')
+            ),
+            Endpoint(
+                'grade_quiz_answers POST anonymous', 'grade_quiz_answers', 'post', None,
+                post_json('grade_quiz_answers', {'answers': submission}, big_quiz.id)
+            ),
+            Endpoint(
+                'toggle_quiz_public POST user', 'toggle_quiz_public', 'post', 'main',
+                lambda number: (reverse('toggle_quiz_public', args=[own_quizzes[number % len(own_quizzes)]]), {})
+            ),
+            Endpoint(
+                'delete_quiz POST user', 'delete_quiz', 'post', 'main',
+                lambda number: (reverse('delete_quiz', args=[disposable[number]]), {})
+            ),
+            Endpoint('profile GET user', 'profile', 'get', 'main', get('profile')),
+            Endpoint(
+                'profile POST user', 'profile', 'post', 'main',
+                lambda number: (reverse('profile'), {'data': {
+                    'username': main_user.username,
+                    'email': 'bench@example.com',
+                    'first_name': 'Основной',
+                    'last_name': f'Пользователь {number}',
+                }})
+            ),
+            Endpoint('change_password GET user', 'change_password', 'get', 'main', get('change_password')),
+            Endpoint('register GET anonymous', 'register', 'get', None, get('register')),
+            Endpoint(
+                'register POST anonymous', 'register', 'post', None,
+                lambda number: (reverse('register'), {'data': {
+                    'username': f'{prefix}-new-{number}',
+                    'password1': 'Benchmark-password-1',
+                    'password2': 'Benchmark-password-1',
+                }})
+            ),
+            Endpoint('login GET anonymous', 'login', 'get', None, get('login')),
+            Endpoint(
+                'login POST anonymous', 'login', 'post', None,
+                lambda number: (reverse('login'), {'data': {
+                    'username': main_user.username,
+                    'password': 'benchmark-password',
+                }})
+            ),
+            Endpoint('logout GET user', 'logout', 'get', 'main', get('logout')),
+        ]
+
+    def request(self, client, endpoint, data, number):
+        """Один вызов сценария: (секунды, число запросов, код ответа)"""
+        client.logout()
+        if endpoint.user == 'main':
+            client.force_login(data['main_user'])
+        elif endpoint.user == 'staff':
+            client.force_login(data['staff'])
+        url, kwargs = endpoint.request(number)
+
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = getattr(client, endpoint.method)(url, **kwargs)
+            if response.streaming:
+                read_streaming_response(response)
+            elapsed = time.perf_counter() - started
+        return elapsed, len(context), response.status_code
+
+    def measure(self, endpoint, data, repeat):
+        """Холодный вызов с пустыми кэшами, repeat замеров с прогретыми и отдельный вызов для пика памяти"""
+        clear_caches()
+        client = Client()
+
+        cold_time, cold_queries, status = self.request(client, endpoint, data, 0)
+        timings = []
+        queries = []
+        statuses = {status}
+        for number in range(1, repeat + 1):
+            elapsed, query_count, status = self.request(client, endpoint, data, number)
+            timings.append(elapsed * 1000)
+            queries.append(query_count)
+            statuses.add(status)
+
+        # tracemalloc замедляет выполнение, поэтому память меряется отдельно от задержки
+        tracemalloc.start()
+        try:
+            self.request(client, endpoint, data, repeat + 1)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        timings.sort()
+        return {
+            'method': endpoint.method.upper(),
+            'url_name': endpoint.url_name,
+            'status_codes': sorted(statuses),
+            'cold_ms': round(cold_time * 1000, 3),
+            'cold_queries': cold_queries,
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'mean_ms': round(statistics.fmean(timings), 3),
+            'queries': round(statistics.median(queries)),
+            'queries_max': max(queries),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+
+    def compare(self, report, baseline, threshold):
+        """Изменения относительно прошлого отчета; возвращает имена сценариев с регрессией"""
+        if baseline.get('dataset') != report['dataset']:
+            self.stderr.write(self.style.WARNING('Параметры данных отличаются от прошлого отчета, сравнение условное'))
+        regressions = []
+        for name, result in report['endpoints'].items():
+            previous = baseline.get('endpoints', {}).get(name)
+            if previous is None:
+                continue
+            result['baseline'] = {
+                'commit': baseline.get('commit'),
+                'p50_change_pct': self.change_pct(previous['p50_ms'], result['p50_ms']),
+                'p95_change_pct': self.change_pct(previous['p95_ms'], result['p95_ms']),
+                'queries_change': result['queries'] - previous['queries'],
+            }
+            if result['baseline']['p95_change_pct'] > threshold or result['baseline']['queries_change'] > 0:
+                regressions.append(name)
+                self.stderr.write(self.style.ERROR(
+                    f'{name}: p95 {previous["p95_ms"]:.2f} -> {result["p95_ms"]:.2f} мс, '
+                    f'запросов {previous["queries"]} -> {result["queries"]}'
+                ))
+        return regressions
+
+    @staticmethod
+    def change_pct(before, after):
+        if not before:
+            return 0.0
+        return round((after - before) / before * 100, 1)
+
+    @staticmethod
+    def git_commit():
+        """Коммит, на котором сделан замер (None вне git)"""
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
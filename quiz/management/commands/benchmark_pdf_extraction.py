@@ -0,0 +1,71 @@
+import io
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from quiz.file_utils import extract_text_from_pdf, extract_text_from_pdf_parallel
+from quiz.testing_utils import build_synthetic_pdf
+
+
+def _best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает последовательный и параллельный разбор синтетических PDF'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pages',
+            type=int,
+            nargs='+',
+            default=[200, 500],
+            help='Размеры тестовых документов в страницах'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=settings.FILE_EXTRACT_WORKERS or 4,
+            help='Число процессов пула'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Сколько раз повторять замер (берется лучший результат)'
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        repeat = options['repeat']
+
+        with override_settings(FILE_EXTRACT_WORKERS=workers, FILE_EXTRACT_MAX_PROCESSES=workers,
+                               FILE_EXTRACT_PARALLEL_MIN_BYTES=0, FILE_EXTRACT_TIME_BUDGET=600):
+            # Порог размера отключен, чтобы пул замерялся и на маленьких документах
+            # Первый вызов запускает сервер процессов - это разовая стоимость, в замер она не входит.
+            # Запуск собственного пула каждого документа в замер входит
+            started = time.perf_counter()
+            extract_text_from_pdf_parallel(build_synthetic_pdf(1))
+            self.stdout.write(f'Первый документ в пуле из {workers} процессов: {time.perf_counter() - started:.2f} с')
+
+            for page_count in options['pages']:
+                pdf = build_synthetic_pdf(page_count)
+                serial_time, serial_text = _best_time(lambda: extract_text_from_pdf(io.BytesIO(pdf)), repeat)
+                parallel_time, parallel_text = _best_time(lambda: extract_text_from_pdf_parallel(pdf), repeat)
+
+                if parallel_text != serial_text:
+                    self.stderr.write(self.style.ERROR(f'{page_count} стр.: тексты не совпадают'))
+                self.stdout.write(
+                    f'{page_count} стр. ({len(pdf) / 1024 / 1024:.1f} МБ): '
+                    f'последовательно {serial_time:.2f} с, в пуле {parallel_time:.2f} с, '
+                    f'ускорение x{serial_time / parallel_time:.1f}'
+                )
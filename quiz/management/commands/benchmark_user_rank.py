@@ -0,0 +1,103 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_databases, teardown_databases
+
+from quiz.models import UserStats
+from quiz.stats_utils import get_user_rank
+
+
+BATCH_SIZE = 5000
+
+
+def legacy_user_rank(user):
+    """Прежний способ: перебор всей таблицы статистики в Python"""
+    for i, stat in enumerate(UserStats.objects.all().order_by('-total_points')):
+        if stat.user == user:
+            return i + 1
+    return 0
+
+
+def create_synthetic_users(count, max_points):
+    """Создает count пользователей со случайными очками пакетами"""
+    prefix = f'rank-bench-{time.time_ns()}'
+    for start in range(0, count, BATCH_SIZE):
+        users = User.objects.bulk_create([
+            User(username=f'{prefix}-{number}', password='!')
+            for number in range(start, min(start + BATCH_SIZE, count))
+        ])
+        UserStats.objects.bulk_create([
+            UserStats(user=user, total_points=random.randint(0, max_points))
+            for user in users
+        ])
+    return list(User.objects.filter(username__startswith=prefix).order_by('id'))
+
+
+class Command(BaseCommand):
+    help = 'Замеряет вычисление ранга пользователя на синтетических данных во временной тестовой БД'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=100_000,
+            help='Сколько пользователей создать'
+        )
+        parser.add_argument(
+            '--lookups',
+            type=int,
+            default=200,
+            help='Сколько раз вычислить ранг случайного пользователя'
+        )
+        parser.add_argument(
+            '--max-points',
+            type=int,
+            default=5000,
+            help='Максимум очков у синтетического пользователя (меньше - больше равенств)'
+        )
+        parser.add_argument(
+            '--legacy',
+            action='store_true',
+            help='Замерить и прежний перебор (один запрос к пользователю на каждую строку - очень долго)'
+        )
+
+    def handle(self, *args, **options):
+        # Замер идет во временной тестовой БД (как у manage.py test), рабочая БД не затрагивается
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'})
+        try:
+            self.run_benchmark(options)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+    def run_benchmark(self, options):
+        started = time.perf_counter()
+        users = create_synthetic_users(options['users'], options['max_points'])
+        self.stdout.write(f'Создано {len(users)} пользователей за {time.perf_counter() - started:.1f} с')
+
+        timings = []
+        queries = 0
+        for user in random.sample(users, min(options['lookups'], len(users))):
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                get_user_rank(user)
+                timings.append(time.perf_counter() - started)
+            queries += len(context)
+
+        timings.sort()
+        self.stdout.write(
+            f'Ранг через индекс: медиана {statistics.median(timings) * 1000:.2f} мс, '
+            f'p95 {timings[int(len(timings) * 0.95) - 1] * 1000:.2f} мс, '
+            f'максимум {timings[-1] * 1000:.2f} мс, запросов на вызов {queries / len(timings):.1f}'
+        )
+
+        if options['legacy']:
+            user = random.choice(users)
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                legacy_user_rank(user)
+                elapsed = time.perf_counter() - started
+            self.stdout.write(f'Прежний перебор: {elapsed * 1000:.0f} мс, запросов {len(context)}')
@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from quiz.leaderboard_utils import build_all_leaderboards
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает рейтинги пользователей за все время, неделю и месяц (запускать по расписанию)'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        for period, total in build_all_leaderboards().items():
+            self.stdout.write(f'{period}: {total} пользователей')
+        self.stdout.write(f'Готово за {time.perf_counter() - started:.2f} с')
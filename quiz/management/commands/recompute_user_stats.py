@@ -0,0 +1,28 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+
+from quiz.achievement_utils import check_achievements
+from quiz.stats_utils import recompute_user_stats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает статистику пользователей с нуля и открывает пропущенные достижения'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'usernames',
+            nargs='*',
+            help='Имена пользователей; по умолчанию пересчитываются все'
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('id')
+        if options['usernames']:
+            users = users.filter(username__in=options['usernames'])
+
+        count = 0
+        for user in users.iterator():
+            stats = recompute_user_stats(user)
+            check_achievements(user, stats)
+            count += 1
+        self.stdout.write(f'Пересчитана статистика {count} пользователей')
@@ -0,0 +1,100 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from quiz.job_utils import claim_next_job, run_generation_job, requeue_stale_jobs
+
+
+# Как часто (в секундах) проверять зависшие задания
+STALE_CHECK_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+def _run_job(job):
+    try:
+        return run_generation_job(job)
+    finally:
+        # У каждого потока свое соединение с БД, закрываем его после задания
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = 'Запускает воркер, выполняющий задания на генерацию тестов из очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.GENERATION_WORKER_CONCURRENCY,
+            help='Максимальное число одновременно выполняемых заданий'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Пауза между проверками пустой очереди (в секундах)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Завершить работу, когда очередь опустеет'
+        )
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        poll_interval = options['poll_interval']
+        self.stdout.write(f'Воркер генерации запущен (параллельно: {concurrency})')
+
+        # Выполняющиеся задания: {future: задание}
+        in_flight = {}
+        last_stale_check = 0
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            try:
+                while True:
+                    if time.monotonic() - last_stale_check > STALE_CHECK_INTERVAL:
+                        requeued, failed = requeue_stale_jobs()
+                        if requeued or failed:
+                            self.stdout.write(f'Зависшие задания: возвращено {requeued}, провалено {failed}')
+                        last_stale_check = time.monotonic()
+
+                    for future in [future for future in in_flight if future.done()]:
+                        self.report_job(in_flight.pop(future), future)
+
+                    job = None
+                    while len(in_flight) < concurrency:
+                        job = claim_next_job()
+                        if job is None:
+                            break
+                        in_flight[executor.submit(_run_job, job)] = job
+
+                    if not in_flight:
+                        if options['once']:
+                            break
+                        time.sleep(poll_interval)
+                    else:
+                        wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            except KeyboardInterrupt:
+                self.stdout.write('Остановка воркера, ожидаем завершения текущих заданий...')
+
+        for future, job in in_flight.items():
+            self.report_job(job, future)
+        self.stdout.write('Воркер генерации остановлен')
+
+    def report_job(self, job, future):
+        """Сообщает о задании, которое завершилось исключением или не смогло сохранить результат"""
+        try:
+            saved = future.result()
+        except Exception as e:
+            logger.exception('Задание %s завершилось с ошибкой', job.id)
+            self.stderr.write(self.style.ERROR(f'Задание {job.id} завершилось с ошибкой: {e}'))
+            return
+        if not saved:
+            self.stderr.write(self.style.ERROR(
+                f'Результат задания {job.id} не сохранен, оно будет возвращено в очередь как зависшее'
+            ))
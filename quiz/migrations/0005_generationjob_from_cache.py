@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0004_generationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='generationjob',
+            name='from_cache',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 02:56
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0005_generationjob_from_cache'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userstats',
+            index=models.Index(fields=['-total_points', 'user'], name='quiz_userst_total_p_1af01a_idx'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.7 on 2026-10-18 03:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0007_pointsentry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quiz',
+            name='attempt_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='quiz',
+            name='attempt_score_sum',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='attempt_score_sum',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='total_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='QuizAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('correct_answers', models.IntegerField()),
+                ('answered_questions', models.IntegerField()),
+                ('question_count', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('quiz', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attempts', to='quiz.quiz')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Quiz Attempt',
+                'verbose_name_plural': 'Quiz Attempts',
+                'indexes': [models.Index(fields=['quiz', 'created_at'], name='quiz_quizat_quiz_id_fad9c7_idx'), models.Index(fields=['user', 'created_at'], name='quiz_quizat_user_id_457f2b_idx')],
+            },
+        ),
+    ]
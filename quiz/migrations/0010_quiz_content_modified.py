@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-18 03:23
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quiz', '0009_quiz_content_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quiz',
+            name='content_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
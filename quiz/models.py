@@ -1,4 +1,7 @@
+import uuid
+
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 
@@ -10,10 +13,22 @@ class Quiz(models.Model):
     is_public = models.BooleanField(default=False)
     share_code = models.CharField(max_length=10, unique=True, null=True, blank=True)
     description = models.TextField(blank=True, null=True)
+    # Растет при каждом изменении вопросов и ответов; входит в ключи кэшей, поэтому
+    # правка в одном процессе сразу делает устаревшими кэши всех процессов
+    content_version = models.PositiveIntegerField(default=1)
+    content_modified = models.DateTimeField(default=timezone.now)
+    # Суммы по журналу попыток (QuizAttempt), обновляются при каждой попытке
+    attempt_count = models.IntegerField(default=0)
+    attempt_score_sum = models.FloatField(default=0.0)
 
     def __str__(self):
         return self.title
 
+    def get_average_attempt_score(self):
+        if self.attempt_count > 0:
+            return self.attempt_score_sum / self.attempt_count
+        return None
+
     class Meta:
         verbose_name = "Quiz"
         verbose_name_plural = "Quizzes"
@@ -90,12 +105,104 @@ class UserStats(models.Model):
     total_correct_answers = models.IntegerField(default=0)
     total_points = models.IntegerField(default=0)
     average_score = models.FloatField(default=0.0)
+    # Суммы по журналу попыток (QuizAttempt), включая повторные прохождения
+    total_attempts = models.IntegerField(default=0)
+    attempt_score_sum = models.FloatField(default=0.0)
     last_activity = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return f"{self.user.username} - Stats"
     
+    class Meta:
+        indexes = [
+            # Рейтинг: очки по убыванию, при равенстве раньше зарегистрированный выше
+            models.Index(fields=['-total_points', 'user']),
+        ]
+    
     def get_accuracy_percentage(self):
         if self.total_questions_answered > 0:
             return (self.total_correct_answers / self.total_questions_answered) * 100
-        return 0
\ No newline at end of file
+        return 0
+    
+    def get_average_attempt_score(self):
+        if self.total_attempts > 0:
+            return self.attempt_score_sum / self.total_attempts
+        return 0
+
+
+class QuizAttempt(models.Model):
+    """Одна попытка прохождения теста; записи только добавляются"""
+    quiz = models.ForeignKey(Quiz, on_delete=models.CASCADE, related_name='attempts')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)  # None - гость
+    score = models.FloatField()
+    correct_answers = models.IntegerField()
+    answered_questions = models.IntegerField()
+    question_count = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        username = self.user.username if self.user else 'guest'
+        return f"{username} - {self.quiz.title} - {self.score:.0f}%"
+
+    class Meta:
+        verbose_name = "Quiz Attempt"
+        verbose_name_plural = "Quiz Attempts"
+        indexes = [
+            models.Index(fields=['quiz', 'created_at']),
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+
+class PointsEntry(models.Model):
+    """Начисление или списание очков; по этим записям строятся рейтинги за неделю и месяц"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    points = models.IntegerField()  # Отрицательное при повторном прохождении хуже или удалении теста
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.points:+d}"
+
+    class Meta:
+        verbose_name = "Points Entry"
+        verbose_name_plural = "Points Entries"
+        indexes = [
+            models.Index(fields=['created_at', 'user']),
+        ]
+
+
+class GenerationJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Готово'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    owner_key = models.CharField(max_length=64)  # Ключ для справедливого распределения между пользователями
+    topic = models.TextField()
+    question_count = models.PositiveSmallIntegerField(default=5)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    quiz = models.ForeignKey(Quiz, on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    from_cache = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.topic[:50]} - {self.status}"
+
+    class Meta:
+        verbose_name = "Generation Job"
+        verbose_name_plural = "Generation Jobs"
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['status', 'owner_key']),
+        ]
@@ -0,0 +1,393 @@
+import json
+from collections import Counter
+
+from .cache_utils import get_counters, incr_counter
+
+
+# Столько вариантов ответа просим у модели; лишние отбрасываются
+ANSWERS_PER_QUESTION = 4
+MIN_ANSWERS = 2
+# Длина поля Answer.text
+MAX_ANSWER_LENGTH = 500
+
+PARSER_COUNTER_PREFIX = 'quiz_parser:'
+# Исправления, которые может выполнить разбор, и их счетчики
+REPAIRS = (
+    'trailing_commas',           # убраны запятые перед } и ]
+    'truncated_recovered',       # ответ оборван, сохранены завершенные вопросы
+    'missing_title',             # у теста нет названия
+    'question_key_renamed',      # текст вопроса пришел в поле "text"
+    'answer_coerced',            # вариант ответа пришел строкой или с "answer" вместо "text"
+    'is_correct_coerced',        # is_correct пришел строкой или числом
+    'correct_from_question',     # правильный ответ указан в вопросе (correct_answer / correct)
+    'duplicate_answers_removed', # повторяющиеся варианты ответа
+    'extra_answers_trimmed',     # вариантов больше четырех
+    'answer_truncated',          # вариант длиннее MAX_ANSWER_LENGTH
+    'multiple_correct_fixed',    # несколько правильных ответов, оставлен первый
+    'question_dropped',          # вопрос не удалось исправить
+)
+
+
+class QuizParseError(ValueError):
+    """Ответ модели не содержит ни одного пригодного вопроса"""
+
+
+class QuizStreamParser:
+    """Инкрементальный разбор JSON теста, который модель присылает по частям.
+
+    Каждый символ просматривается один раз. Вопрос из массива "questions"
+    отдается сразу, как только закрывается его объект.
+    """
+
+    def __init__(self):
+        self.title = None
+        self.text = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._key = None
+        self._expect_value = False
+        self._in_questions = False
+        self._question_start = None
+
+    def feed(self, chunk):
+        """Добавляет фрагмент ответа и возвращает список вопросов, завершенных в нем"""
+        self.text += chunk
+        text = self.text
+        questions = []
+
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._on_top_level_string(text[self._string_start:pos + 1])
+                continue
+
+            # Все, что до корневого объекта (например, ```json), пропускаем
+            if self._depth == 0 and char != '{':
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char in '{[':
+                if self._depth == 1 and char == '[' and self._expect_value and self._key == 'questions':
+                    self._in_questions = True
+                elif self._depth == 2 and char == '{' and self._in_questions:
+                    self._question_start = pos
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 2 and char == '}' and self._question_start is not None:
+                    question = self._decode(text[self._question_start:pos + 1])
+                    self._question_start = None
+                    if question is not None:
+                        questions.append(question)
+                elif self._depth == 1 and char == ']':
+                    self._in_questions = False
+            elif self._depth == 1:
+                if char == ':':
+                    self._expect_value = True
+                elif char == ',':
+                    self._expect_value = False
+
+        self._pos = len(text)
+        return questions
+
+    def _on_top_level_string(self, raw):
+        value = self._decode(raw)
+        if self._expect_value:
+            if self._key == 'title' and isinstance(value, str):
+                self.title = value
+        else:
+            self._key = value
+
+    @staticmethod
+    def _decode(raw):
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+
+
+def scan_json_object(text, start=0):
+    """Находит первый JSON-объект, начиная с позиции start, за один линейный проход.
+
+    Возвращает (начало, конец) объекта; конец равен None, если объект оборван,
+    и оба значения равны None, если в тексте нет "{".
+    """
+    begin = text.find('{', start)
+    if begin == -1:
+        return None, None
+
+    depth = 0
+    in_string = False
+    escape = False
+    for pos in range(begin, len(text)):
+        char = text[pos]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                return begin, pos + 1
+    return begin, None
+
+
+def strip_trailing_commas(text):
+    """Убирает запятые перед закрывающими скобками вне строк; возвращает текст и число правок"""
+    result = []
+    removed = 0
+    in_string = False
+    escape = False
+    pending_comma = None
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+            result.append(char)
+            continue
+
+        if pending_comma is not None:
+            if char.isspace():
+                pending_comma.append(char)
+                continue
+            if char in '}]':
+                removed += 1
+                result.extend(pending_comma[1:])
+            else:
+                result.extend(pending_comma)
+            pending_comma = None
+
+        if char == ',':
+            pending_comma = [char]
+            continue
+        if char == '"':
+            in_string = True
+        result.append(char)
+
+    if pending_comma is not None:
+        result.extend(pending_comma)
+    return ''.join(result), removed
+
+
+def _loads(raw, repairs):
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        pass
+    fixed, removed = strip_trailing_commas(raw)
+    if removed:
+        try:
+            data = json.loads(fixed)
+        except json.JSONDecodeError:
+            return None
+        repairs['trailing_commas'] += removed
+        return data
+    return None
+
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'да', 'yes', '1')
+    return bool(value)
+
+
+def _repair_answer(answer_data, repairs):
+    if isinstance(answer_data, str):
+        repairs['answer_coerced'] += 1
+        answer_data = {'text': answer_data, 'is_correct': False}
+    if not isinstance(answer_data, dict):
+        return None
+
+    text = answer_data.get('text')
+    if text is None and 'answer' in answer_data:
+        repairs['answer_coerced'] += 1
+        text = answer_data['answer']
+    if not isinstance(text, (str, int, float)) or isinstance(text, bool):
+        return None
+    text = str(text).strip()
+    if not text:
+        return None
+    if len(text) > MAX_ANSWER_LENGTH:
+        repairs['answer_truncated'] += 1
+        text = text[:MAX_ANSWER_LENGTH]
+
+    is_correct = answer_data.get('is_correct', False)
+    if not isinstance(is_correct, bool):
+        repairs['is_correct_coerced'] += 1
+        is_correct = _as_bool(is_correct)
+    return {'text': text, 'is_correct': is_correct}
+
+
+def _mark_correct_from_question(question_data, answers, repairs):
+    """Отмечает правильный ответ, если модель указала его в самом вопросе"""
+    correct = question_data.get('correct_answer', question_data.get('correct'))
+    if correct is None or isinstance(correct, bool):
+        return
+    if isinstance(correct, int) and 0 <= correct < len(answers):
+        answers[correct]['is_correct'] = True
+        repairs['correct_from_question'] += 1
+        return
+    for answer in answers:
+        if answer['text'].casefold() == str(correct).strip().casefold():
+            answer['is_correct'] = True
+            repairs['correct_from_question'] += 1
+            return
+
+
+def repair_question(question_data, repairs=None):
+    """Проверяет вопрос по схеме и исправляет его; возвращает None, если вопрос не спасти"""
+    if repairs is None:
+        repairs = Counter()
+    if not isinstance(question_data, dict):
+        repairs['question_dropped'] += 1
+        return None
+
+    text = question_data.get('question')
+    if text is None and isinstance(question_data.get('text'), str):
+        repairs['question_key_renamed'] += 1
+        text = question_data['text']
+    if not isinstance(text, str) or not text.strip():
+        repairs['question_dropped'] += 1
+        return None
+
+    raw_answers = question_data.get('answers')
+    if not isinstance(raw_answers, list):
+        repairs['question_dropped'] += 1
+        return None
+
+    answers = []
+    seen = set()
+    for answer_data in raw_answers:
+        answer = _repair_answer(answer_data, repairs)
+        if answer is None:
+            continue
+        key = answer['text'].casefold()
+        if key in seen:
+            repairs['duplicate_answers_removed'] += 1
+            # Повтор правильного ответа переносит отметку на уже принятый вариант
+            if answer['is_correct']:
+                next(a for a in answers if a['text'].casefold() == key)['is_correct'] = True
+            continue
+        seen.add(key)
+        answers.append(answer)
+
+    if not any(answer['is_correct'] for answer in answers):
+        _mark_correct_from_question(question_data, answers, repairs)
+
+    correct = [answer for answer in answers if answer['is_correct']]
+    if not correct or len(answers) < MIN_ANSWERS:
+        repairs['question_dropped'] += 1
+        return None
+    if len(correct) > 1:
+        repairs['multiple_correct_fixed'] += 1
+        for answer in correct[1:]:
+            answer['is_correct'] = False
+
+    if len(answers) > ANSWERS_PER_QUESTION:
+        repairs['extra_answers_trimmed'] += 1
+        first_correct = correct[0]
+        wrong = [answer for answer in answers if answer is not first_correct][:ANSWERS_PER_QUESTION - 1]
+        answers = [answer for answer in answers if answer is first_correct or answer in wrong]
+
+    return {'question': text.strip(), 'answers': answers}
+
+
+def validate_quiz_data(quiz_data, repairs=None):
+    """Приводит разобранный ответ модели к схеме теста, исправляя или отбрасывая плохие вопросы"""
+    if repairs is None:
+        repairs = Counter()
+    if isinstance(quiz_data, list):
+        quiz_data = {'questions': quiz_data}
+    if not isinstance(quiz_data, dict):
+        raise QuizParseError('ответ не является JSON-объектом теста')
+
+    title = quiz_data.get('title')
+    if not isinstance(title, str) or not title.strip():
+        repairs['missing_title'] += 1
+        title = None
+    else:
+        title = title.strip()
+
+    raw_questions = quiz_data.get('questions')
+    if not isinstance(raw_questions, list):
+        raise QuizParseError('в ответе нет списка вопросов')
+
+    questions = []
+    for question_data in raw_questions:
+        question = repair_question(question_data, repairs)
+        if question is not None:
+            questions.append(question)
+    if not questions:
+        raise QuizParseError('в ответе нет ни одного корректного вопроса')
+
+    return {'title': title, 'questions': questions}
+
+
+def parse_quiz_output(content):
+    """Извлекает тест из ответа модели без повторных запросов.
+
+    Markdown и текст вокруг JSON пропускаются, лишние запятые убираются, из
+    оборванного ответа сохраняются завершенные вопросы. Каждое исправление
+    учитывается в счетчиках get_parser_stats.
+    """
+    repairs = Counter()
+    try:
+        begin, end = scan_json_object(content)
+        if begin is None:
+            raise QuizParseError('в ответе нет JSON')
+
+        # Ищем первый объект с вопросами: перед ним может быть текст с фигурными скобками
+        first_begin = begin
+        while begin is not None and end is not None:
+            data = _loads(content[begin:end], repairs)
+            if isinstance(data, dict) and 'questions' in data:
+                return validate_quiz_data(data, repairs)
+            begin, end = scan_json_object(content, end)
+
+        # Объект оборван или не разбирается целиком - забираем завершенные вопросы
+        truncated = begin is not None
+        parser = QuizStreamParser()
+        questions = parser.feed(content[begin if truncated else first_begin:])
+        if not questions:
+            raise QuizParseError('ответ оборван до первого вопроса' if truncated else 'в ответе нет теста с вопросами')
+        repairs['truncated_recovered'] += 1
+        return validate_quiz_data({'title': parser.title, 'questions': questions}, repairs)
+    finally:
+        record_repairs(repairs)
+
+
+def record_repairs(repairs):
+    """Добавляет исправления одного разбора к общим счетчикам"""
+    for repair, count in repairs.items():
+        if count:
+            incr_counter(PARSER_COUNTER_PREFIX + repair, count)
+
+
+def get_parser_stats():
+    """Возвращает, сколько раз срабатывало каждое исправление ответа модели"""
+    counters = get_counters([PARSER_COUNTER_PREFIX + repair for repair in REPAIRS])
+    return {repair: counters[PARSER_COUNTER_PREFIX + repair] for repair in REPAIRS}
@@ -0,0 +1,106 @@
+from types import SimpleNamespace
+
+from django.core.cache import cache
+from django.db.models import F, Prefetch, prefetch_related_objects
+from django.shortcuts import get_object_or_404
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from .models import Quiz, Question, Answer, UserAnswer, QuizAttempt
+
+
+# Отрисованные вопросы теста после генерации не меняются, поэтому хранятся долго
+QUIZ_PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def bump_content_version(quiz_id):
+    """Выдает тесту новую версию содержимого после изменения его названия, вопросов или ответов.
+
+    Версия хранится в БД, поэтому кэши с версией в ключе (ключ ответов, блок
+    вопросов, ETag страницы) устаревают во всех процессах, а не только в текущем.
+    """
+    Quiz.objects.filter(id=quiz_id).update(content_version=F('content_version') + 1, content_modified=timezone.now())
+
+
+def _questions_prefetch():
+    questions = Question.objects.order_by('id').prefetch_related(
+        Prefetch('answers', queryset=Answer.objects.order_by('id'))
+    )
+    return Prefetch('questions', queryset=questions)
+
+
+def get_quiz_with_questions(**lookup):
+    """Загружает тест вместе с вопросами и вариантами ответов за три запроса.
+
+    Возвращает (тест, список вопросов); шаблоны перебирают question.answers.all
+    без дополнительных запросов. Если тест не найден, бросает Http404.
+    """
+    quiz = get_object_or_404(Quiz.objects.prefetch_related(_questions_prefetch()), **lookup)
+    return quiz, list(quiz.questions.all())
+
+
+def load_quiz_questions(quiz):
+    """Догружает вопросы и варианты ответов уже полученного теста за два запроса"""
+    prefetch_related_objects([quiz], _questions_prefetch())
+    return list(quiz.questions.all())
+
+
+def get_last_attempt(request, quiz):
+    """Последняя попытка текущего пользователя (для гостя - сохраненная в сессии) или None"""
+    if request.user.is_authenticated:
+        return QuizAttempt.objects.filter(user=request.user, quiz=quiz).order_by('-id').first()
+
+    attempt_id = request.session.get(f'quiz_{quiz.id}_attempt')
+    if attempt_id is None:
+        return None
+    return QuizAttempt.objects.filter(id=attempt_id, quiz=quiz, user__isnull=True).first()
+
+
+def render_quiz_questions(quiz):
+    """Отрисованный блок вопросов теста для его версии содержимого (Quiz.content_version).
+
+    Возвращает (HTML, число вопросов). При попадании в кэш к БД не обращается.
+    """
+    cache_key = f'quiz_page:{quiz.id}:{quiz.content_version}:questions'
+    fragment = cache.get(cache_key)
+    if fragment is None:
+        questions = load_quiz_questions(quiz)
+        fragment = {
+            'html': render_to_string('quiz_questions.html', {'questions': questions}),
+            'count': len(questions)
+        }
+        cache.set(cache_key, fragment, QUIZ_PAGE_CACHE_TIMEOUT)
+    return mark_safe(fragment['html']), fragment['count']
+
+
+def get_user_answers(request, quiz, questions):
+    """Ответы пользователя на вопросы теста: {id вопроса: объект с answer и is_correct}.
+
+    Для авторизованного пользователя - один запрос, для гостя ответы из сессии
+    сопоставляются с уже загруженными вариантами без обращения к БД.
+    """
+    if request.user.is_authenticated:
+        return {
+            user_answer.question_id: user_answer
+            for user_answer in UserAnswer.objects.filter(user=request.user, question__quiz=quiz).select_related('answer')
+        }
+
+    session_answers = request.session.get(f'quiz_{quiz.id}_answers', {})
+    if not session_answers:
+        return {}
+
+    answers = {
+        (question.id, answer.id): answer
+        for question in questions
+        for answer in question.answers.all()
+    }
+    user_answers = {}
+    for question_id, answer_id in session_answers.items():
+        try:
+            answer = answers.get((int(question_id), int(answer_id)))
+        except (TypeError, ValueError):
+            continue
+        if answer is not None:
+            user_answers[answer.question_id] = SimpleNamespace(answer=answer, is_correct=answer.is_correct)
+    return user_answers
@@ -0,0 +1,65 @@
+from django.contrib.auth.models import User
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from .models import Quiz, Question, Answer, Achievement
+from .achievement_utils import reset_achievement_catalog
+from .quiz_utils import bump_content_version
+from .stats_utils import record_quiz_deletion
+
+
+def _deleted_with_quiz(kwargs):
+    # Вопросы и ответы, удаляемые вместе с тестом, не меняют версию: кэши удаленного теста больше не читаются
+    return isinstance(kwargs.get('origin'), Quiz)
+
+
+@receiver([post_save, post_delete], sender=Question)
+def question_changed(sender, instance, **kwargs):
+    """Изменение вопроса (например, в админке) меняет версию содержимого теста"""
+    if not _deleted_with_quiz(kwargs):
+        bump_content_version(instance.quiz_id)
+
+
+@receiver([post_save, post_delete], sender=Answer)
+def answer_changed(sender, instance, **kwargs):
+    """Изменение варианта ответа меняет версию содержимого теста"""
+    if not _deleted_with_quiz(kwargs):
+        quiz_id = Question.objects.filter(id=instance.question_id).values_list('quiz_id', flat=True).first()
+        if quiz_id is not None:
+            bump_content_version(quiz_id)
+
+
+def _deleted_user_ids(origin):
+    """id пользователей, удаление которых каскадно удаляет тест"""
+    if isinstance(origin, User):
+        return {origin.pk}
+    if isinstance(origin, QuerySet) and origin.model is User:
+        return set(origin.values_list('pk', flat=True))
+    return set()
+
+
+@receiver(pre_delete, sender=Quiz)
+def quiz_deleting(sender, instance, **kwargs):
+    """Удаление теста любым путем (страница, админка, каскад) вычитается из статистики, пока ответы еще в БД.
+
+    Тест, создание которого еще не засчитано (creation_counted=False, например оборванная
+    потоковая генерация), не уменьшает счетчик созданных тестов автора.
+    """
+    record_quiz_deletion(
+        instance,
+        skip_user_ids=_deleted_user_ids(kwargs.get('origin')),
+        creation_counted=getattr(instance, 'creation_counted', True)
+    )
+
+
+@receiver(post_save, sender=Quiz)
+def quiz_saved(sender, instance, created, **kwargs):
+    """Правка теста (название, публикация) меняет версию его страницы"""
+    if not created:
+        bump_content_version(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Achievement)
+def achievement_changed(sender, **kwargs):
+    reset_achievement_catalog()
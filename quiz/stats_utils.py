@@ -1,5 +1,8 @@
 from django.contrib.auth.models import User
-from .models import UserStats, Achievement, UserAchievement, Quiz, UserAnswer
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from .models import UserStats, Achievement, UserAchievement, Quiz, Question, UserAnswer, QuizAttempt, PointsEntry
+from .achievement_utils import check_achievements, snapshot_counters, changed_counters
 
 
 def get_or_create_user_stats(user):
@@ -8,31 +11,167 @@ def get_or_create_user_stats(user):
     return stats
 
 
-def update_user_stats(user, quiz_completed=False, questions_answered=0, correct_answers=0, quiz_score=0):
-    """Обновляет статистику пользователя"""
-    stats = get_or_create_user_stats(user)
-    
-    if quiz_completed:
-        stats.total_quizzes_completed += 1
-        stats.total_questions_answered += questions_answered
-        stats.total_correct_answers += correct_answers
-        
-        # Начисляем очки за прохождение теста
-        points_earned = calculate_quiz_points(quiz_score, questions_answered, correct_answers)
-        stats.total_points += points_earned
-        
-        # Пересчитываем средний балл на основе всех завершенных тестов
-        from .models import Quiz
-        completed_quizzes = Quiz.objects.filter(user=user, score__isnull=False)
-        if completed_quizzes.exists():
-            total_score = sum(quiz.score for quiz in completed_quizzes)
-            stats.average_score = total_score / completed_quizzes.count()
-    
-    stats.save()
-    check_achievements(user)
+def get_user_stats(user):
+    """Статистика пользователя только для чтения: если ее еще нет, возвращает пустую без записи в БД"""
+    return UserStats.objects.filter(user=user).first() or UserStats(user=user)
+
+
+def _lock_user_stats(user_id):
+    """Статистика пользователя, заблокированная до конца транзакции"""
+    stats, created = UserStats.objects.select_for_update().get_or_create(user_id=user_id)
     return stats
 
 
+def get_quiz_answer_counts(user, quiz_id):
+    """Ответы пользователя на вопросы теста: (сколько отвечено, сколько верно)"""
+    counts = UserAnswer.objects.filter(user=user, question__quiz_id=quiz_id).aggregate(
+        answered=Count('id'),
+        correct=Count('id', filter=Q(is_correct=True))
+    )
+    return counts['answered'], counts['correct']
+
+
+def calculate_quiz_score(correct_answers, question_count):
+    """Процент правильных ответов на тест"""
+    return correct_answers / question_count * 100 if question_count > 0 else 0
+
+
+def _apply_quiz_contribution(stats, question_count, previous, current):
+    """Заменяет вклад одного теста в статистику: previous и current - (отвечено, верно), (0, 0) - вклада нет.
+
+    Возвращает изменение очков.
+    """
+    previous_answered, previous_correct = previous
+    answered, correct = current
+
+    points_before = stats.total_points
+    completed = stats.total_quizzes_completed
+    score_sum = stats.average_score * completed
+    if previous_answered:
+        completed -= 1
+        previous_score = calculate_quiz_score(previous_correct, question_count)
+        score_sum -= previous_score
+        stats.total_points -= calculate_quiz_points(previous_score, previous_answered, previous_correct)
+    if answered:
+        completed += 1
+        score = calculate_quiz_score(correct, question_count)
+        score_sum += score
+        stats.total_points += calculate_quiz_points(score, answered, correct)
+
+    stats.total_quizzes_completed = completed
+    stats.total_questions_answered += answered - previous_answered
+    stats.total_correct_answers += correct - previous_correct
+    stats.average_score = max(0.0, score_sum / completed) if completed else 0.0
+    return stats.total_points - points_before
+
+
+def record_quiz_attempt(quiz, user, correct_answers, answered_questions, question_count):
+    """Добавляет попытку в журнал и обновляет суммы попыток теста.
+
+    Результат теста (Quiz.score) меняет только попытка его автора. Суммы
+    пользователя обновляет record_quiz_completion.
+    """
+    score = calculate_quiz_score(correct_answers, question_count)
+    user_id = user.id if user else None
+    with transaction.atomic():
+        attempt = QuizAttempt.objects.create(
+            quiz=quiz,
+            user=user,
+            score=score,
+            correct_answers=correct_answers,
+            answered_questions=answered_questions,
+            question_count=question_count
+        )
+        updates = {
+            'attempt_count': F('attempt_count') + 1,
+            'attempt_score_sum': F('attempt_score_sum') + score,
+        }
+        if quiz.user_id == user_id:
+            updates['score'] = score
+        Quiz.objects.filter(pk=quiz.pk).update(**updates)
+    return attempt
+
+
+def record_quiz_completion(user, question_count, previous, current, attempt=None):
+    """Учитывает прохождение теста в статистике пользователя.
+
+    previous и current - ответы пользователя на этот тест до и после сохранения
+    попытки (см. get_quiz_answer_counts). Повторное прохождение заменяет вклад
+    прошлой попытки, поэтому число запросов не зависит от истории пользователя.
+    attempt - запись журнала попыток, добавляется к суммам попыток пользователя.
+    """
+    with transaction.atomic():
+        stats = _lock_user_stats(user.id)
+        before = snapshot_counters(stats)
+        if attempt is not None:
+            stats.total_attempts += 1
+            stats.attempt_score_sum += attempt.score
+        points = _apply_quiz_contribution(stats, question_count, previous, current)
+        stats.save()
+        if points:
+            PointsEntry.objects.create(user=user, points=points)
+        check_achievements(user, stats, changed_counters(before, stats))
+    return stats
+
+
+def record_quiz_creation(user):
+    """Учитывает созданный пользователем тест в статистике и достижениях"""
+    with transaction.atomic():
+        stats = _lock_user_stats(user.id)
+        stats.total_quizzes_created += 1
+        stats.save()
+        check_achievements(user, stats, {'total_quizzes_created'})
+    return stats
+
+
+def record_quiz_deletion(quiz, skip_user_ids=(), creation_counted=True):
+    """Вычитает удаляемый тест из статистики автора и всех, кто его проходил.
+
+    Вызывается до удаления теста, пока его ответы еще в БД (сигнал pre_delete).
+    Статистика пользователей из skip_user_ids не меняется - они удаляются вместе с тестом.
+    creation_counted=False - создание теста еще не засчитано автору, вычитать его не нужно.
+    """
+    question_count = quiz.questions.count()
+    contributions = (
+        UserAnswer.objects.filter(question__quiz=quiz)
+        .exclude(user_id__in=skip_user_ids)
+        .values('user_id')
+        .annotate(answered=Count('id'), correct=Count('id', filter=Q(is_correct=True)))
+        .order_by()
+    )
+    attempts = {
+        row['user_id']: row
+        for row in QuizAttempt.objects.filter(quiz=quiz, user__isnull=False)
+        .exclude(user_id__in=skip_user_ids)
+        .values('user_id')
+        .annotate(count=Count('id'), score_sum=Sum('score'))
+        .order_by()
+    }
+    with transaction.atomic():
+        entries = []
+        for row in contributions:
+            stats = _lock_user_stats(row['user_id'])
+            points = _apply_quiz_contribution(stats, question_count, (row['answered'], row['correct']), (0, 0))
+            user_attempts = attempts.pop(row['user_id'], None)
+            if user_attempts:
+                stats.total_attempts -= user_attempts['count']
+                stats.attempt_score_sum -= user_attempts['score_sum']
+            stats.save()
+            if points:
+                entries.append(PointsEntry(user_id=row['user_id'], points=points))
+        PointsEntry.objects.bulk_create(entries)
+        # Попытки, в которых ни один ответ не был принят, в contributions не попали
+        for user_id, user_attempts in attempts.items():
+            UserStats.objects.filter(user_id=user_id).update(
+                total_attempts=F('total_attempts') - user_attempts['count'],
+                attempt_score_sum=F('attempt_score_sum') - user_attempts['score_sum']
+            )
+        if creation_counted and quiz.user_id and quiz.user_id not in skip_user_ids:
+            UserStats.objects.filter(user_id=quiz.user_id, total_quizzes_created__gt=0).update(
+                total_quizzes_created=F('total_quizzes_created') - 1
+            )
+
+
 def calculate_quiz_points(quiz_score, questions_answered, correct_answers):
     """Вычисляет очки за прохождение теста"""
     base_points = 10  # Базовые очки за прохождение теста
@@ -69,154 +208,79 @@ def calculate_quiz_points(quiz_score, questions_answered, correct_answers):
     return int(total_points)
 
 
-def check_achievements(user):
-    """Проверяет и разблокирует достижения"""
-    stats = get_or_create_user_stats(user)
-    achievements = Achievement.objects.all()
-    
-    for achievement in achievements:
-        if not UserAchievement.objects.filter(user=user, achievement=achievement).exists():
-            if check_achievement_condition(user, achievement, stats):
-                UserAchievement.objects.create(user=user, achievement=achievement)
-                # Очки за достижения начисляются отдельно
-                stats.total_points += achievement.points
-                stats.save()
-
-
-def check_achievement_condition(user, achievement, stats):
-    """Проверяет условие для разблокировки достижения"""
-    condition = achievement.condition
-    
-    if condition == "first_quiz":
-        return stats.total_quizzes_created >= 1
-    elif condition == "quiz_creator":
-        return stats.total_quizzes_created >= 5
-    elif condition == "quiz_master":
-        return stats.total_quizzes_created >= 10
-    elif condition == "perfectionist":
-        return stats.average_score >= 90 and stats.total_quizzes_completed >= 5
-    elif condition == "accuracy_king":
-        return stats.get_accuracy_percentage() >= 95 and stats.total_quizzes_completed >= 3
-    elif condition == "speed_demon":
-        return stats.total_quizzes_completed >= 20
-    elif condition == "dedicated_learner":
-        return stats.total_quizzes_completed >= 50
-    elif condition == "scholar":
-        return stats.total_questions_answered >= 100
-    elif condition == "question_master":
-        return stats.total_questions_answered >= 500
-    elif condition == "genius":
-        return stats.average_score >= 95 and stats.total_quizzes_completed >= 10
-    elif condition == "points_collector":
-        return stats.total_points >= 500
-    elif condition == "points_master":
-        return stats.total_points >= 1000
-    
-    return False
-
+def get_user_rank(user, stats=None):
+    """Получает ранг пользователя: 1 + число пользователей с большим числом очков.
 
-def get_user_rank(user):
-    """Получает ранг пользователя"""
-    stats = get_or_create_user_stats(user)
-    all_stats = UserStats.objects.all().order_by('-total_points')
-    
-    for i, stat in enumerate(all_stats):
-        if stat.user == user:
-            return i + 1
-    return 0
+    При равенстве очков выше тот, кто зарегистрировался раньше (меньший id). Подсчет
+    идет по индексу (total_points, user), поэтому не зависит от числа пользователей
+    линейно. Пользователь без статистики ранга не имеет (0).
+    """
+    if stats is None:
+        stats = UserStats.objects.filter(user=user).only('total_points').first()
+    if stats is None or stats.pk is None:
+        return 0
+    ahead = UserStats.objects.filter(
+        Q(total_points__gt=stats.total_points) | Q(total_points=stats.total_points, user_id__lt=user.id)
+    ).count()
+    return ahead + 1
 
 
-def get_top_users(limit=10):
-    """Получает топ пользователей"""
-    return UserStats.objects.all().order_by('-total_points')[:limit]
+def recompute_user_stats(user):
+    """Пересчитывает статистику пользователя с нуля за фиксированное число запросов.
 
+    Ответы группируются по тестам одним запросом (вместе с числом вопросов теста),
+    очки за тесты считаются в памяти, очки за достижения - одним агрегатом. Итог
+    совпадает с тем, что поддерживают record_quiz_completion и record_quiz_deletion.
+    """
+    question_count = (
+        Question.objects.filter(quiz=OuterRef('question__quiz'))
+        .order_by()
+        .values('quiz')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    per_quiz = (
+        UserAnswer.objects.filter(user=user)
+        .values('question__quiz')
+        .annotate(
+            answered=Count('id'),
+            correct=Count('id', filter=Q(is_correct=True)),
+            question_count=Subquery(question_count)
+        )
+        .order_by()
+    )
 
-def sync_user_stats(user):
-    """Полная синхронизация статистики пользователя"""
-    from .models import Quiz, UserAnswer
-    
-    stats = get_or_create_user_stats(user)
-    
-    # Подсчитываем все показатели заново
-    created_quizzes = Quiz.objects.filter(user=user).count()
-    completed_quizzes = Quiz.objects.filter(user=user, score__isnull=False).count()
-    
-    user_answers = UserAnswer.objects.filter(user=user)
-    total_questions_answered = user_answers.count()
-    total_correct_answers = user_answers.filter(is_correct=True).count()
-    
-    # Вычисляем средний балл
-    completed_quiz_scores = Quiz.objects.filter(user=user, score__isnull=False).values_list('score', flat=True)
-    average_score = sum(completed_quiz_scores) / len(completed_quiz_scores) if completed_quiz_scores else 0
-    
-    # Пересчитываем очки на основе всех завершенных тестов
+    total_questions_answered = 0
+    total_correct_answers = 0
+    score_sum = 0
     total_points = 0
-    for quiz in Quiz.objects.filter(user=user, score__isnull=False):
-        quiz_answers = UserAnswer.objects.filter(user=user, question__quiz=quiz)
-        quiz_questions = quiz_answers.count()
-        quiz_correct = quiz_answers.filter(is_correct=True).count()
-        total_points += calculate_quiz_points(quiz.score, quiz_questions, quiz_correct)
-    
-    # Обновляем статистику
-    stats.total_quizzes_created = created_quizzes
-    stats.total_quizzes_completed = completed_quizzes
-    stats.total_questions_answered = total_questions_answered
-    stats.total_correct_answers = total_correct_answers
-    stats.average_score = average_score
-    stats.total_points = total_points
-    stats.save()
-    
-    return stats
+    completed_quizzes = 0
+    for row in per_quiz:
+        score = calculate_quiz_score(row['correct'], row['question_count'] or 0)
+        completed_quizzes += 1
+        total_questions_answered += row['answered']
+        total_correct_answers += row['correct']
+        score_sum += score
+        total_points += calculate_quiz_points(score, row['answered'], row['correct'])
 
+    # Очки за уже открытые достижения начисляются сверх очков за тесты
+    achievement_points = UserAchievement.objects.filter(user=user).aggregate(
+        points=Sum('achievement__points')
+    )['points'] or 0
 
-def force_check_all_achievements(user):
-    """Принудительно проверяет все достижения для пользователя"""
-    stats = get_or_create_user_stats(user)
-    achievements = Achievement.objects.all()
-    
-    for achievement in achievements:
-        if not UserAchievement.objects.filter(user=user, achievement=achievement).exists():
-            if check_achievement_condition(user, achievement, stats):
-                UserAchievement.objects.create(user=user, achievement=achievement)
-                stats.total_points += achievement.points
-                stats.save()
-                print(f"Разблокировано достижение: {achievement.name}")
+    attempts = QuizAttempt.objects.filter(user=user).aggregate(count=Count('id'), score_sum=Sum('score'))
 
-
-def update_stats_after_quiz_deletion(user):
-    """Обновляет статистику после удаления теста"""
     stats = get_or_create_user_stats(user)
-    
-    # Пересчитываем статистику
-    from .models import Quiz, UserAnswer
-    created_quizzes = Quiz.objects.filter(user=user).count()
-    completed_quizzes = Quiz.objects.filter(user=user, score__isnull=False).count()
-    
-    user_answers = UserAnswer.objects.filter(user=user)
-    total_questions_answered = user_answers.count()
-    total_correct_answers = user_answers.filter(is_correct=True).count()
-    
-    # Вычисляем средний балл
-    completed_quiz_scores = Quiz.objects.filter(user=user, score__isnull=False).values_list('score', flat=True)
-    average_score = sum(completed_quiz_scores) / len(completed_quiz_scores) if completed_quiz_scores else 0
-    
-    # Пересчитываем очки
-    total_points = 0
-    for quiz in Quiz.objects.filter(user=user, score__isnull=False):
-        quiz_answers = UserAnswer.objects.filter(user=user, question__quiz=quiz)
-        quiz_questions = quiz_answers.count()
-        quiz_correct = quiz_answers.filter(is_correct=True).count()
-        total_points += calculate_quiz_points(quiz.score, quiz_questions, quiz_correct)
-    
-    # Обновляем статистику
-    stats.total_quizzes_created = created_quizzes
+    stats.total_quizzes_created = Quiz.objects.filter(user=user).count()
+    stats.total_attempts = attempts['count']
+    stats.attempt_score_sum = attempts['score_sum'] or 0
     stats.total_quizzes_completed = completed_quizzes
     stats.total_questions_answered = total_questions_answered
     stats.total_correct_answers = total_correct_answers
-    stats.average_score = average_score
-    stats.total_points = total_points
+    stats.average_score = score_sum / completed_quizzes if completed_quizzes else 0
+    stats.total_points = total_points + achievement_points
     stats.save()
-    
+
     return stats
 
 
@@ -0,0 +1,127 @@
+import json
+import re
+import shutil
+import tempfile
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import caches
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+
+FILE_CACHE_BACKEND = 'django.core.cache.backends.filebased.FileBasedCache'
+
+
+def relocate_file_caches(directory):
+    """Настройки CACHES, в которых каждый файловый кэш хранится в своем подкаталоге directory"""
+    return {
+        alias: {**config, 'LOCATION': f'{directory}/{alias}'} if config['BACKEND'] == FILE_CACHE_BACKEND else config
+        for alias, config in settings.CACHES.items()
+    }
+
+
+def clear_caches():
+    """Очищает все кэши, включая общие для процессов"""
+    for alias in settings.CACHES:
+        caches[alias].clear()
+
+
+class QuizTestRunner(DiscoverRunner):
+    """Запускает тесты с файловыми кэшами во временном каталоге, а не в рабочем дереве"""
+
+    def setup_test_environment(self, **kwargs):
+        self.file_cache_dir = tempfile.mkdtemp(prefix='quiz-tests-caches-')
+        self.caches_override = override_settings(CACHES=relocate_file_caches(self.file_cache_dir))
+        self.caches_override.enable()
+        super().setup_test_environment(**kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        super().teardown_test_environment(**kwargs)
+        self.caches_override.disable()
+        shutil.rmtree(self.file_cache_dir, ignore_errors=True)
+
+
+def build_synthetic_pdf(page_count, lines_per_page=45):
+    """Собирает PDF из page_count страниц с текстом, не требуя библиотек для записи PDF"""
+    objects = [b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    pages_id = 2 + 2 * page_count
+    page_ids = []
+    for page in range(page_count):
+        lines = b' '.join(
+            b"(Page %d, line %d: synthetic lecture text used to benchmark PDF extraction.) '" % (page, line)
+            for line in range(lines_per_page)
+        )
+        content = b'BT /F1 10 Tf 40 800 Td 12 TL ' + lines + b' ET'
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content))
+        objects.append(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R '
+            b'/Resources << /Font << /F1 1 0 R >> >> >>' % (pages_id, len(objects))
+        )
+        page_ids.append(len(objects))
+    kids = b' '.join(b'%d 0 R' % page_id for page_id in page_ids)
+    objects.append(b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, page_count))
+    objects.append(b'<< /Type /Catalog /Pages %d 0 R >>' % pages_id)
+
+    pdf = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, len(objects), xref)
+    return bytes(pdf)
+
+
+class StubLLMRouter:
+    """Заглушка маршрутизатора языковой модели: сразу отвечает тестом с запрошенным числом вопросов"""
+
+    is_configured = True
+    default_model = 'stub'
+
+    def __init__(self):
+        self.calls = 0
+
+    def _content(self, payload):
+        self.calls += 1
+        match = re.search(r'ровно (\d+) вопрос', payload['messages'][-1]['content'])
+        question_count = int(match.group(1)) if match else 5
+        return json.dumps({
+            'title': 'Сгенерированный тест',
+            'questions': [
+                {
+                    'question': f'Вопрос {self.calls}-{number}',
+                    'answers': [
+                        {'text': f'Ответ {answer}', 'is_correct': answer == 0}
+                        for answer in range(4)
+                    ],
+                }
+                for number in range(question_count)
+            ],
+        }, ensure_ascii=False)
+
+    def complete(self, payload, timeout):
+        return {'choices': [{'message': {'content': self._content(payload)}}]}
+
+    async def acomplete(self, payload, timeout):
+        return self.complete(payload, timeout)
+
+    async def astream_lines(self, payload, timeout):
+        content = self._content(payload)
+        for start in range(0, len(content), 200):
+            chunk = {'choices': [{'delta': {'content': content[start:start + 200]}}]}
+            yield f'data: {json.dumps(chunk, ensure_ascii=False)}'
+        yield 'data: [DONE]'
+
+
+def read_streaming_response(response):
+    """Дочитывает потоковый ответ, в том числе асинхронный"""
+    if not response.is_async:
+        return response.getvalue()
+
+    async def read():
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    return async_to_sync(read)()
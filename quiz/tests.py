@@ -1,3 +1,1534 @@
-from django.test import TestCase
+import asyncio
+import email.utils
+import io
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest.mock import patch
 
-# Create your tests here.
+import httpx
+import requests
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.db import OperationalError, connection
+from django.db.models import F, QuerySet, Sum
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import file_utils, urls as quiz_urls
+from .ai_utils import (
+    QUESTIONS_PER_REQUEST, _shortfall, astream_topic_quiz, build_file_payloads, create_quiz_question,
+    generate_topic_quiz_data, merge_quiz_parts, save_quiz_questions, split_question_count,
+)
+from .achievement_utils import check_achievements
+from .grading_utils import get_answer_key, grade_submission
+from .job_utils import enqueue_generation_job, claim_next_job, _finish_job
+from .llm_client import (
+    ChatCompletionClient, CircuitBreaker, CircuitOpenError, LLMHTTPError, LLMNetworkError, parse_retry_after,
+)
+from .llm_providers import LLMProvider, ProviderRouter
+from .file_utils import (
+    allocate_questions, extract_text_from_pdf, extract_text_from_pdf_parallel, process_uploaded_file,
+    split_text_into_sections,
+)
+from .quiz_parser import (
+    QuizParseError, QuizStreamParser, get_parser_stats, parse_quiz_output, repair_question, strip_trailing_commas,
+)
+from .models import (
+    Quiz, Question, Answer, UserAnswer, UserStats, UserAchievement, QuizAttempt, GenerationJob, PointsEntry, Achievement,
+)
+from .leaderboard_utils import build_all_leaderboards, build_leaderboard, get_leaderboard_page
+from .stats_utils import create_default_achievements, get_user_rank, recompute_user_stats, record_quiz_creation
+from .testing_utils import StubLLMRouter, build_synthetic_pdf, clear_caches, read_streaming_response
+
+
+def create_quiz(question_count, **kwargs):
+    """Создает тест с question_count вопросами по 4 варианта ответа"""
+    quiz = Quiz.objects.create(title=f'Тест на {question_count} вопросов', **kwargs)
+    questions = Question.objects.bulk_create(
+        [Question(quiz=quiz, text=f'Вопрос {number}') for number in range(question_count)]
+    )
+    Answer.objects.bulk_create([
+        Answer(question=question, text=f'Ответ {number}', is_correct=number == 0)
+        for question in questions
+        for number in range(4)
+    ])
+    return quiz
+
+
+class QuizPageQueryCountTests(TestCase):
+    """Страницы теста загружаются за фиксированное число запросов"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='student', password='password')
+
+    def assert_page_queries(self, url, expected):
+        with self.assertNumQueries(expected):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def answer_all(self, quiz):
+        return {
+            f'question_{question.id}': question.answers.filter(is_correct=True).first().id
+            for question in quiz.questions.all()
+        }
+
+    def test_quiz_detail(self):
+        # тест, вопросы, ответы; повторно блок вопросов берется из кэша
+        for size in (5, 50):
+            with self.subTest(size=size):
+                quiz = create_quiz(size)
+                url = reverse('quiz_detail', args=[quiz.id])
+                response = self.assert_page_queries(url, 3)
+                self.assertContains(response, 'name="question_', count=size * 4)
+                response = self.assert_page_queries(url, 1)
+                self.assertContains(response, 'name="question_', count=size * 4)
+
+    def test_shared_quiz(self):
+        for size in (5, 50):
+            with self.subTest(size=size):
+                quiz = create_quiz(size, is_public=True, share_code=f'code{size}')
+                url = reverse('shared_quiz', args=[quiz.share_code])
+                self.assert_page_queries(url, 3)
+                self.assert_page_queries(url, 1)
+
+    def test_results_anonymous(self):
+        # сессия + тест, вопросы, ответы + попытка; ответы из сессии сопоставляются в памяти
+        for size in (5, 50):
+            with self.subTest(size=size):
+                quiz = create_quiz(size)
+                self.client.post(reverse('quiz_detail', args=[quiz.id]), self.answer_all(quiz))
+                response = self.assert_page_queries(reverse('quiz_results', args=[quiz.id]), 5)
+                self.assertEqual(len(response.context['user_answers']), size)
+
+    def test_results_authenticated(self):
+        # сессия, пользователь + тест, вопросы, ответы + ответы пользователя + попытка
+        self.client.force_login(self.user)
+        for size in (5, 50):
+            with self.subTest(size=size):
+                quiz = create_quiz(size, user=self.user)
+                self.client.post(reverse('quiz_detail', args=[quiz.id]), self.answer_all(quiz))
+                response = self.assert_page_queries(reverse('quiz_results', args=[quiz.id]), 7)
+                user_answers = response.context['user_answers']
+                self.assertEqual(len(user_answers), size)
+                self.assertTrue(all(user_answer.is_correct for user_answer in user_answers.values()))
+
+
+class QuizPageCacheTests(TestCase):
+    """Условный GET и сброс кэша страницы теста"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='author', password='password')
+        self.quiz = create_quiz(5, user=self.user, is_public=True, share_code='SHARE123')
+        self.url = reverse('shared_quiz', args=[self.quiz.share_code])
+
+    def test_repeat_visit_gets_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_etag_depends_on_user(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.force_login(self.user)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_csrf_token_after_login(self):
+        login = {'username': 'author', 'password': 'password'}
+        self.client.post(reverse('login'), login)
+        etag = self.client.get(self.url)['ETag']
+        self.client.get(reverse('logout'))
+        # Вход выдает новый CSRF-токен, форма сохраненной страницы с ним уже не пройдет проверку
+        self.client.post(reverse('login'), login)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_question_change_invalidates_page(self):
+        etag = self.client.get(self.url)['ETag']
+        question = self.quiz.questions.first()
+        question.text = 'Исправленный вопрос'
+        question.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Исправленный вопрос')
+
+    def test_questions_added_during_generation_change_page(self):
+        # Потоковая генерация отдает ссылку на тест, когда в нем еще не все вопросы
+        quiz = Quiz.objects.create(title='Генерируется', user=self.user)
+        question = {
+            'question': 'Первый вопрос',
+            'answers': [{'text': 'Да', 'is_correct': True}, {'text': 'Нет', 'is_correct': False}],
+        }
+        create_quiz_question(quiz, question)
+        url = reverse('quiz_detail', args=[quiz.id])
+        response = self.client.get(url)
+        self.assertEqual(response.context['question_count'], 1)
+
+        save_quiz_questions(quiz, [dict(question, question='Второй вопрос'), dict(question, question='Третий вопрос')])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Третий вопрос')
+        self.assertEqual(response.context['question_count'], 3)
+
+    def test_title_change_changes_page(self):
+        etag = self.client.get(self.url)['ETag']
+        self.quiz.title = 'Новое название'
+        self.quiz.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Новое название')
+
+    def test_unpublish_invalidates_page(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.force_login(self.user)
+        self.client.post(reverse('toggle_quiz_public', args=[self.quiz.id]))
+        self.client.logout()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertRedirects(response, reverse('index'), fetch_redirect_response=False)
+
+
+def count_fetched_rows(captured_queries):
+    """Сколько строк вернули SELECT-запросы (каждый запрос пересчитывается через COUNT)"""
+    rows = 0
+    with connection.cursor() as cursor:
+        for query in captured_queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+            cursor.execute(f'SELECT COUNT(*) FROM ({sql})')
+            rows += cursor.fetchone()[0]
+    return rows
+
+
+@override_settings(FILE_EXTRACT_WORKERS=0, LEADERBOARD_PAGE_SIZE=50, MY_QUIZZES_PAGE_SIZE=20)
+class QueryBudgetTests(TestCase):
+    """Бюджет запросов и прочитанных строк для каждого URL приложения и админки.
+
+    Данные похожи на реальные: у пользователя сотни пройденных тестов, есть тест
+    на 50 вопросов, рейтинг из сотни пользователей. Бюджеты не зависят от объема
+    данных, поэтому запрос на каждую строку (N+1) выводит тест за бюджет.
+    """
+
+    QUIZ_COUNT = 200
+
+    @classmethod
+    def setUpTestData(cls):
+        create_default_achievements()
+        cls.staff = User.objects.create_superuser(username='admin', password='password')
+        cls.user = User.objects.create_user(username='heavy', password='password')
+        cls.other_users = User.objects.bulk_create([
+            User(username=f'user{number}', password='!') for number in range(100)
+        ])
+        UserStats.objects.bulk_create([
+            UserStats(user=user, total_points=number * 10, total_quizzes_completed=number)
+            for number, user in enumerate(cls.other_users)
+        ])
+
+        cls.quizzes = [create_quiz(5, user=cls.user) for _ in range(cls.QUIZ_COUNT)]
+        cls.big_quiz = create_quiz(50, user=cls.user, is_public=True, share_code='BIGQUIZ1')
+        cls.quizzes.append(cls.big_quiz)
+
+        correct = Answer.objects.filter(question__quiz__user=cls.user, is_correct=True).values_list('question_id', 'id')
+        UserAnswer.objects.bulk_create([
+            UserAnswer(user=cls.user, question_id=question_id, answer_id=answer_id, is_correct=True)
+            for question_id, answer_id in correct
+        ])
+        QuizAttempt.objects.bulk_create([
+            QuizAttempt(
+                quiz=quiz, user=cls.user, score=100, correct_answers=5, answered_questions=5, question_count=5
+            )
+            for quiz in cls.quizzes
+        ])
+        Quiz.objects.filter(user=cls.user).update(score=100)
+        check_achievements(cls.user, recompute_user_stats(cls.user))
+
+    def setUp(self):
+        clear_caches()
+        self.router = StubLLMRouter()
+        patcher = patch('quiz.ai_utils.get_llm_router', return_value=self.router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assert_budget(self, max_queries, max_rows, method, url, user=None, **kwargs):
+        if user is not None:
+            self.client.force_login(user)
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, **kwargs)
+            if response.streaming:
+                read_streaming_response(response)
+        rows = count_fetched_rows(context.captured_queries)
+        sql = '\n'.join(query['sql'] for query in context.captured_queries)
+        self.assertLessEqual(len(context), max_queries, f'{method.upper()} {url}: слишком много запросов\n{sql}')
+        self.assertLessEqual(rows, max_rows, f'{method.upper()} {url}: прочитано слишком много строк\n{sql}')
+        return response
+
+    def submission(self, quiz):
+        return {
+            f'question_{question_id}': answer_id
+            for question_id, answer_id in Answer.objects.filter(question__quiz=quiz, is_correct=True)
+            .values_list('question_id', 'id')
+        }
+
+    def test_every_url_has_budget(self):
+        names = {pattern.name for pattern in quiz_urls.urlpatterns}
+        covered = {name for name in dir(self) if name.startswith('test_')}
+        missing = {name for name in names if f'test_{name}' not in covered}
+        self.assertFalse(missing, f'Нет бюджета запросов для: {", ".join(sorted(missing))}')
+
+    def test_index(self):
+        self.assert_budget(0, 0, 'get', reverse('index'))
+        self.assert_budget(2, 2, 'get', reverse('index'), user=self.user)
+
+    def test_quiz_detail(self):
+        url = reverse('quiz_detail', args=[self.big_quiz.id])
+        # тест, 50 вопросов, 200 вариантов; затем блок вопросов из кэша
+        self.assert_budget(3, 251, 'get', url)
+        self.assert_budget(3, 3, 'get', url, user=self.user)
+        # ключ ответов строится одним запросом по 200 вариантам
+        self.assert_budget(17, 206, 'post', url, data=self.submission(self.big_quiz))
+
+    def test_quiz_results(self):
+        url = reverse('quiz_results', args=[self.big_quiz.id])
+        self.assert_budget(7, 304, 'get', url, user=self.user)
+
+    def test_shared_quiz(self):
+        self.assert_budget(3, 251, 'get', reverse('shared_quiz', args=[self.big_quiz.share_code]))
+
+    def test_my_quizzes(self):
+        self.assert_budget(4, 23, 'get', reverse('my_quizzes'), user=self.user)
+        self.assert_budget(4, 23, 'get', reverse('my_quizzes') + '?page=5', user=self.user)
+
+    def test_generate_quiz(self):
+        # только постановка в очередь
+        data = json.dumps({'topic': 'История Рима', 'questionCount': 10})
+        self.assert_budget(1, 0, 'post', reverse('generate_quiz'), data=data, content_type='application/json')
+
+    def test_generate_quiz_from_file(self):
+        # 20 вопросов сохраняются двумя пакетными вставками и одной сменой версии содержимого
+        upload = SimpleUploadedFile('lecture.pdf', build_synthetic_pdf(3), content_type='application/pdf')
+        self.assert_budget(
+            13, 15, 'post', reverse('generate_quiz_from_file'),
+            user=self.user, data={'file': upload, 'questionCount': 20}
+        )
+
+    def test_generate_quiz_stream(self):
+        data = json.dumps({'topic': 'История Рима', 'questionCount': 20})
+        # Вопросы сохраняются по мере поступления: на каждый точка сохранения, вопрос, варианты и версия теста
+        self.assert_budget(
+            110, 15, 'post', reverse('generate_quiz_stream'),
+            user=self.user, data=data, content_type='application/json'
+        )
+
+    def test_generation_job_status(self):
+        job = enqueue_generation_job('История Рима', 10, self.user, owner_key=f'user:{self.user.id}')
+        self.assert_budget(1, 1, 'get', reverse('generation_job_status', args=[job.id]), user=self.user)
+
+    def test_cache_stats(self):
+        self.assert_budget(2, 2, 'get', reverse('cache_stats'), user=self.staff)
+
+    def test_leaderboard(self):
+        url = reverse('leaderboard')
+        # без снимка читается только запрошенная страница (кэш, COUNT и LIMIT/OFFSET)
+        # и сохраняется в кэш в БД: отбраковка, проверка ключа и вставка в точке сохранения
+        self.assert_budget(8, 54, 'get', url + '?period=all&page=2')
+        self.assert_budget(8, 5, 'get', url + '?period=week')
+        # Сохраненная страница и страница после build_leaderboards - одно чтение из кэша в БД
+        self.assert_budget(1, 1, 'get', url + '?period=week')
+        build_all_leaderboards()
+        self.assert_budget(1, 2, 'get', url + '?period=all&page=2')
+
+    def test_generate_quiz_async(self):
+        data = json.dumps({'topic': 'История Рима', 'questionCount': 20})
+        self.assert_budget(
+            13, 15, 'post', reverse('generate_quiz_async'),
+            user=self.user, data=data, content_type='application/json'
+        )
+
+    def test_generate_quiz_from_file_async(self):
+        upload = SimpleUploadedFile('lecture.pdf', build_synthetic_pdf(3), content_type='application/pdf')
+        self.assert_budget(
+            13, 15, 'post', reverse('generate_quiz_from_file_async'),
+            user=self.user, data={'file': upload, 'questionCount': 20}
+        )
+
+    def test_grade_quiz_answers(self):
+        url = reverse('grade_quiz_answers', args=[self.big_quiz.id])
+        answers = {key.removeprefix('question_'): value for key, value in self.submission(self.big_quiz).items()}
+        data = json.dumps({'answers': answers})
+        # версия содержимого теста, ключ ответов одним запросом по 200 вариантам,
+        # затем одна запись сессии с закрепленными ответами
+        response = self.assert_budget(6, 202, 'post', url, data=data, content_type='application/json')
+        self.assertEqual(response.json()['answered'], 50)
+
+    def test_toggle_quiz_public(self):
+        url = reverse('toggle_quiz_public', args=[self.quizzes[0].id])
+        # сохранение теста меняет версию его страницы
+        self.assert_budget(6, 4, 'post', url, user=self.user)
+
+    def test_delete_quiz(self):
+        url = reverse('delete_quiz', args=[self.big_quiz.id])
+        self.assert_budget(25, 5, 'post', url, user=self.user)
+
+    def test_profile(self):
+        # без снимка рейтинга первая страница читается из БД (кэш, COUNT и LIMIT) и сохраняется в кэш
+        self.assert_budget(14, 120, 'get', reverse('profile'), user=self.user)
+        data = {'username': 'heavy', 'email': 'heavy@example.com', 'first_name': 'Тяжелый', 'last_name': 'Пользователь'}
+        self.assert_budget(4, 2, 'post', reverse('profile'), user=self.user, data=data)
+
+    def test_change_password(self):
+        self.assert_budget(2, 2, 'get', reverse('change_password'), user=self.user)
+
+    def test_register(self):
+        self.assert_budget(0, 0, 'get', reverse('register'))
+
+    def test_login(self):
+        self.assert_budget(0, 0, 'get', reverse('login'))
+        data = {'username': 'heavy', 'password': 'password'}
+        self.assert_budget(9, 2, 'post', reverse('login'), data=data)
+
+    def test_logout(self):
+        self.assert_budget(4, 1, 'get', reverse('logout'), user=self.user)
+
+    # Строки включают варианты фильтров справа: все тесты или все пользователи
+    ADMIN_BUDGETS = {
+        'quiz': (6, 206),
+        'question': (6, 305),
+        'answer': (6, 305),
+        'useranswer': (6, 206),
+        'achievement': (6, 25),
+        'userachievement': (6, 28),
+        'userstats': (5, 104),
+        'quizattempt': (5, 104),
+        'pointsentry': (5, 5),
+        'generationjob': (5, 4),
+    }
+
+    def test_admin_changelists(self):
+        models = [model for model in admin.site._registry if model._meta.app_label == 'quiz']
+        self.assertEqual({model._meta.model_name for model in models}, set(self.ADMIN_BUDGETS))
+        for model in models:
+            with self.subTest(model=model.__name__):
+                max_queries, max_rows = self.ADMIN_BUDGETS[model._meta.model_name]
+                url = reverse(f'admin:quiz_{model._meta.model_name}_changelist')
+                self.assert_budget(max_queries, max_rows, 'get', url, user=self.staff)
+
+
+class QuizAttemptAdminTests(TestCase):
+    """Попытки в админке только просматриваются"""
+
+    def setUp(self):
+        self.staff = User.objects.create_superuser(username='admin', password='password')
+        self.attempt = QuizAttempt.objects.create(
+            quiz=create_quiz(2), score=50, correct_answers=1, answered_questions=2, question_count=2
+        )
+        self.client.force_login(self.staff)
+
+    def test_view_only(self):
+        response = self.client.get(reverse('admin:quiz_quizattempt_change', args=[self.attempt.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.context['has_change_permission'])
+        self.assertFalse(response.context['has_delete_permission'])
+
+    def test_cannot_change_or_delete(self):
+        change_url = reverse('admin:quiz_quizattempt_change', args=[self.attempt.id])
+        self.assertEqual(self.client.post(change_url, {'score': 100}).status_code, 403)
+        delete_url = reverse('admin:quiz_quizattempt_delete', args=[self.attempt.id])
+        self.assertEqual(self.client.post(delete_url, {'post': 'yes'}).status_code, 403)
+        self.assertEqual(self.client.get(reverse('admin:quiz_quizattempt_add')).status_code, 403)
+        self.attempt.refresh_from_db()
+        self.assertEqual(self.attempt.score, 50)
+
+    def test_deleted_with_quiz_or_user(self):
+        self.client.post(reverse('admin:quiz_quiz_delete', args=[self.attempt.quiz_id]), {'post': 'yes'})
+        self.assertFalse(QuizAttempt.objects.exists())
+        user = User.objects.create_user(username='learner', password='password')
+        QuizAttempt.objects.create(
+            quiz=create_quiz(2), user=user, score=50, correct_answers=1, answered_questions=2, question_count=2
+        )
+        self.client.post(reverse('admin:auth_user_delete', args=[user.id]), {'post': 'yes'})
+        self.assertFalse(QuizAttempt.objects.exists())
+
+
+@override_settings(GENERATION_JOB_MAX_PER_OWNER=2)
+class GenerationJobTests(TestCase):
+    """Справедливый захват заданий из очереди и сохранение их результата"""
+
+    def enqueue(self, owner_key, count=1):
+        return [enqueue_generation_job('История Рима', 5, None, owner_key=owner_key) for _ in range(count)]
+
+    def test_owner_with_fewer_running_jobs_goes_first(self):
+        first_jobs = self.enqueue('ip:1', 3)
+        later_job, = self.enqueue('ip:2')
+
+        self.assertEqual(claim_next_job().id, first_jobs[0].id)
+        # У ip:1 уже выполняется задание, поэтому следующим обслуживается ip:2, хотя его задание новее
+        self.assertEqual(claim_next_job().id, later_job.id)
+        self.assertEqual(claim_next_job().id, first_jobs[1].id)
+
+    def test_owner_limit(self):
+        self.enqueue('ip:1', 3)
+        self.assertIsNotNone(claim_next_job())
+        self.assertIsNotNone(claim_next_job())
+        self.assertIsNone(claim_next_job())
+
+    def test_job_is_claimed_once(self):
+        job, = self.enqueue('ip:1')
+        claimed = claim_next_job()
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, GenerationJob.STATUS_RUNNING)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNone(claim_next_job())
+
+    def test_job_taken_by_another_worker_is_skipped(self):
+        job, = self.enqueue('ip:1')
+        # Другой воркер успевает забрать задание между выбором и условным обновлением
+        original_update = QuerySet.update
+
+        def update(queryset, **kwargs):
+            original_update(GenerationJob.objects.filter(id=job.id), status=GenerationJob.STATUS_RUNNING)
+            return original_update(queryset, **kwargs)
+
+        with patch.object(QuerySet, 'update', update):
+            self.assertIsNone(claim_next_job())
+
+    def test_finish_error_is_logged(self):
+        job, = self.enqueue('ip:1')
+        with patch('quiz.job_utils.FINISH_JOB_RETRY_DELAY', 0), \
+                patch.object(QuerySet, 'update', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('quiz.job_utils', 'ERROR'):
+            self.assertFalse(_finish_job(job, GenerationJob.STATUS_DONE))
+
+
+@override_settings(FILE_EXTRACT_WORKERS=2)
+@override_settings(FILE_EXTRACT_PARALLEL_MIN_BYTES=0)
+class FileExtractionTests(TestCase):
+    """Разбор PDF в пуле процессов"""
+
+    def test_upload_in_memory_extracted_in_process(self):
+        pdf = build_synthetic_pdf(12)
+        upload = SimpleUploadedFile('lecture.pdf', pdf, content_type='application/pdf')
+        with patch('quiz.file_utils.extract_text_from_pdf_parallel') as parallel, \
+                patch('quiz.file_utils.tempfile.NamedTemporaryFile') as named_temporary_file:
+            text = process_uploaded_file(upload)
+        parallel.assert_not_called()
+        named_temporary_file.assert_not_called()
+        self.assertEqual(text, extract_text_from_pdf(io.BytesIO(pdf)))
+
+    def test_temporary_file_upload_read_by_pool_from_its_path(self):
+        pdf = build_synthetic_pdf(12)
+        upload = TemporaryUploadedFile('lecture.pdf', 'application/pdf', len(pdf), None)
+        upload.write(pdf)
+        upload.flush()
+        self.addCleanup(upload.close)
+        with patch('quiz.file_utils.tempfile.NamedTemporaryFile') as named_temporary_file:
+            self.assertEqual(process_uploaded_file(upload), extract_text_from_pdf(io.BytesIO(pdf)))
+        named_temporary_file.assert_not_called()
+
+    def test_timeout_does_not_cancel_other_documents(self):
+        pdf = build_synthetic_pdf(40)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other = executor.submit(extract_text_from_pdf_parallel, pdf)
+            with self.assertRaisesMessage(Exception, 'Превышено время обработки PDF'):
+                extract_text_from_pdf_parallel(build_synthetic_pdf(1), time_budget=0)
+            self.assertEqual(other.result(), extract_text_from_pdf(SimpleUploadedFile('lecture.pdf', pdf)))
+
+    @override_settings(FILE_EXTRACT_PARALLEL_MIN_BYTES=1024 * 1024)
+    def test_small_document_skips_pool(self):
+        pdf = build_synthetic_pdf(3)
+        with patch('quiz.file_utils._create_pdf_pool') as create_pool:
+            text = extract_text_from_pdf_parallel(pdf)
+        create_pool.assert_not_called()
+        self.assertEqual(text, extract_text_from_pdf(io.BytesIO(pdf)))
+
+    @override_settings(FILE_EXTRACT_WORKERS=2, FILE_EXTRACT_MAX_PROCESSES=3)
+    def test_pool_processes_are_capped(self):
+        slots = file_utils._get_pdf_pool_slots()
+        # Пул из двух процессов помещается в лимит один раз
+        self.assertTrue(slots.acquire(blocking=False))
+        try:
+            self.assertFalse(slots.acquire(blocking=False))
+            with patch('quiz.file_utils._create_pdf_pool') as create_pool, \
+                    self.assertRaisesMessage(Exception, 'Превышено время обработки PDF'):
+                extract_text_from_pdf_parallel(build_synthetic_pdf(1), time_budget=0.1)
+            create_pool.assert_not_called()
+        finally:
+            slots.release()
+        pdf = build_synthetic_pdf(4)
+        self.assertEqual(extract_text_from_pdf_parallel(pdf), extract_text_from_pdf(io.BytesIO(pdf)))
+
+
+def quiz_json(question_count=2, title='Тест'):
+    return json.dumps({
+        'title': title,
+        'questions': [
+            {
+                'question': f'Вопрос {number}',
+                'answers': [{'text': f'Ответ {answer}', 'is_correct': answer == 0} for answer in range(4)],
+            }
+            for number in range(question_count)
+        ],
+    }, ensure_ascii=False)
+
+
+def question_data(text):
+    return {'question': text, 'answers': [{'text': f'Ответ {answer}', 'is_correct': answer == 0} for answer in range(4)]}
+
+
+class ChunkedGenerationTests(SimpleTestCase):
+    """Деление большого теста на части и объединение ответов модели"""
+
+    def test_split_question_count(self):
+        self.assertEqual(split_question_count(7), [7])
+        self.assertEqual(split_question_count(10), [10])
+        self.assertEqual(split_question_count(11), [6, 5])
+        self.assertEqual(split_question_count(25), [9, 8, 8])
+        self.assertEqual(split_question_count(50), [10] * 5)
+        for question_count in range(1, 101):
+            with self.subTest(question_count=question_count):
+                counts = split_question_count(question_count)
+                self.assertEqual(sum(counts), question_count)
+                self.assertLessEqual(max(counts), QUESTIONS_PER_REQUEST)
+                self.assertLessEqual(max(counts) - min(counts), 1)
+
+    def test_merge_drops_duplicates_and_broken_questions(self):
+        parts = [
+            {'title': 'Рим', 'questions': [question_data('Кто основал Рим?'), question_data('Когда пал Рим?')]},
+            {'title': 'Другое название', 'questions': [
+                question_data('кто  основал Рим'),  # повтор с другим регистром и пунктуацией
+                {'question': 'Без ответов'},
+                question_data('Кто такой Цезарь?'),
+            ]},
+            None,
+        ]
+        quiz_data = merge_quiz_parts(parts, 10)
+        self.assertEqual(quiz_data['title'], 'Рим')
+        self.assertEqual(
+            [question['question'] for question in quiz_data['questions']],
+            ['Кто основал Рим?', 'Когда пал Рим?', 'Кто такой Цезарь?']
+        )
+
+    def test_merge_trims_to_question_count(self):
+        parts = [{'title': 'Тест', 'questions': [question_data(f'Вопрос {number}') for number in range(8)]}]
+        self.assertEqual(len(merge_quiz_parts(parts, 5)['questions']), 5)
+        self.assertIsNone(merge_quiz_parts([{'questions': []}], 5)['title'])
+
+    def test_shortfall_triggers_top_up(self):
+        parts = [
+            {'title': 'Тест', 'questions': [question_data(f'Вопрос {number}') for number in range(10)]},
+            {'title': 'Тест', 'questions': [question_data(f'Вопрос {number}') for number in range(5, 12)]},
+        ]
+        # 12 разных вопросов из 20: не хватает 8 - один дозапрос
+        self.assertEqual(_shortfall(parts, 20), 8)
+        self.assertEqual(_shortfall(parts, 12), 0)
+        # Нехватка больше одной части не дозапрашивается
+        self.assertEqual(_shortfall(parts, 30), 0)
+        self.assertEqual(_shortfall([], 20), 0)
+
+
+class DocumentSectionTests(SimpleTestCase):
+    """Деление документа на фрагменты и распределение вопросов между ними"""
+
+    def test_sections_end_at_sentence_boundaries(self):
+        sentences = [f'Предложение номер {number} о Риме.' for number in range(20)]
+        text = ' '.join(sentences)
+        sections = split_text_into_sections(text, max_tokens=30)  # до 90 символов
+        self.assertGreater(len(sections), 1)
+        for section in sections:
+            self.assertLessEqual(len(section), 90)
+            self.assertTrue(section.endswith('.'))
+        self.assertEqual(' '.join(sections), text)
+
+    def test_long_sentence_is_cut(self):
+        text = 'а' * 250
+        sections = split_text_into_sections(text, max_tokens=30)
+        self.assertEqual([len(section) for section in sections], [90, 90, 70])
+        self.assertEqual(''.join(sections), text)
+        self.assertEqual(split_text_into_sections('   '), [])
+
+    def test_allocation_is_proportional(self):
+        self.assertEqual(allocate_questions([100, 100, 200], 8), [2, 2, 4])
+        self.assertEqual(allocate_questions([300, 100], 4), [3, 1])
+        self.assertEqual(allocate_questions([0, 0], 5), [0, 0])
+
+    def test_allocation_sums_to_question_count(self):
+        sizes = [5000, 1200, 6000, 300, 6000, 6000]
+        for question_count in range(1, 60):
+            with self.subTest(question_count=question_count):
+                self.assertEqual(sum(allocate_questions(sizes, question_count)), question_count)
+
+    def test_few_questions_cover_whole_document(self):
+        # Вопросов меньше, чем фрагментов: они достаются фрагментам по всему документу, а не первым
+        self.assertEqual(allocate_questions([100] * 10, 2), [0, 0, 1, 0, 0, 0, 0, 1, 0, 0])
+
+    def test_payloads_only_for_sections_with_questions(self):
+        text = ' '.join(f'Предложение номер {number} о Риме.' for number in range(2000))
+        sections = split_text_into_sections(text)
+        self.assertGreater(len(sections), 3)
+        payloads = build_file_payloads(text, 2)
+        self.assertEqual(len(payloads), 2)
+        self.assertEqual(sum(payload['messages'][-1]['content'].count('ровно 1 вопрос') for payload in payloads), 2)
+
+
+class CacheStatsTests(TestCase):
+    """Кэш ответов модели и счетчики общие для веб-процессов и воркера генерации"""
+
+    def setUp(self):
+        clear_caches()
+        self.staff = User.objects.create_superuser(username='admin', password='password')
+        self.router = StubLLMRouter()
+        patcher = patch('quiz.ai_utils.get_llm_router', return_value=self.router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shared_stores(self):
+        locmem = 'django.core.cache.backends.locmem.LocMemCache'
+        for alias in ('llm', 'counters', 'documents'):
+            with self.subTest(alias=alias):
+                self.assertNotEqual(settings.CACHES[alias]['BACKEND'], locmem)
+
+    def test_miss_counted_by_worker_and_hit_by_web(self):
+        data = json.dumps({'topic': 'История Рима', 'questionCount': 5})
+        # Промах веб-процесса не учитывается: задание ставится в очередь
+        self.assertEqual(self.client.post(reverse('generate_quiz'), data, content_type='application/json').status_code, 202)
+        # Воркер проверяет кэш еще раз, учитывает промах и обращается к модели
+        generate_topic_quiz_data('История Рима', 5)
+        self.assertEqual(self.router.calls, 1)
+        response = self.client.post(reverse('generate_quiz'), data, content_type='application/json')
+        self.assertTrue(response.json()['cached'])
+
+        self.client.force_login(self.staff)
+        stats = self.client.get(reverse('cache_stats')).json()['llm']
+        self.assertEqual(stats, {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    def test_parser_repairs_visible(self):
+        parse_quiz_output(quiz_json().replace(']}', '],}'))
+        self.client.force_login(self.staff)
+        repairs = self.client.get(reverse('cache_stats')).json()['parser_repairs']
+        self.assertGreater(repairs['trailing_commas'], 0)
+        self.assertEqual(repairs, get_parser_stats())
+
+
+class QuizParserTests(SimpleTestCase):
+    """Разбор и исправление ответа модели"""
+
+    def setUp(self):
+        caches['counters'].clear()
+
+    def test_plain_json(self):
+        quiz_data = parse_quiz_output(quiz_json(3))
+        self.assertEqual(quiz_data['title'], 'Тест')
+        self.assertEqual([question['question'] for question in quiz_data['questions']], ['Вопрос 0', 'Вопрос 1', 'Вопрос 2'])
+        self.assertEqual(get_parser_stats()['truncated_recovered'], 0)
+
+    def test_markdown_wrapped(self):
+        quiz_data = parse_quiz_output(f'Вот тест:\n```json\n{quiz_json()}\n```\nУдачи!')
+        self.assertEqual(len(quiz_data['questions']), 2)
+
+    def test_trailing_commas(self):
+        content = quiz_json().replace(']}', '],}').replace('}]', '},]')
+        quiz_data = parse_quiz_output(content)
+        self.assertEqual(len(quiz_data['questions']), 2)
+        self.assertGreater(get_parser_stats()['trailing_commas'], 0)
+
+    def test_truncated_output_keeps_finished_questions(self):
+        content = quiz_json(3)
+        content = content[:content.index('Вопрос 2') + 10]
+        quiz_data = parse_quiz_output(content)
+        self.assertEqual(quiz_data['title'], 'Тест')
+        self.assertEqual(len(quiz_data['questions']), 2)
+        self.assertEqual(get_parser_stats()['truncated_recovered'], 1)
+
+    def test_truncated_before_first_question(self):
+        with self.assertRaises(QuizParseError):
+            parse_quiz_output('{"title": "Тест", "questions": [{"question": "Вопр')
+
+    def test_braces_in_text_before_json(self):
+        content = 'Формат ответа {"пример": true} и множество {1, 2}. ' + quiz_json()
+        quiz_data = parse_quiz_output(content)
+        self.assertEqual(len(quiz_data['questions']), 2)
+
+    def test_braces_inside_strings(self):
+        content = quiz_json().replace('Вопрос 0', 'Что вернет {\\"a\\": [1]}?')
+        quiz_data = parse_quiz_output(content)
+        self.assertEqual(quiz_data['questions'][0]['question'], 'Что вернет {"a": [1]}?')
+
+    def test_no_json(self):
+        with self.assertRaises(QuizParseError):
+            parse_quiz_output('Не могу составить тест')
+
+    def test_stream_parser_yields_questions_as_they_close(self):
+        parser = QuizStreamParser()
+        content = quiz_json(2)
+        middle = content.index('Вопрос 1')
+        self.assertEqual(len(parser.feed(content[:middle])), 1)
+        self.assertEqual(parser.title, 'Тест')
+        self.assertEqual(len(parser.feed(content[middle:])), 1)
+
+
+class RepairQuestionTests(SimpleTestCase):
+    """Исправление отдельных вопросов по схеме"""
+
+    def repair(self, question_data):
+        repairs = Counter()
+        return repair_question(question_data, repairs), repairs
+
+    def test_valid_question_unchanged(self):
+        question_data = {'question': 'Вопрос', 'answers': [{'text': 'Да', 'is_correct': True}, {'text': 'Нет', 'is_correct': False}]}
+        question, repairs = self.repair(question_data)
+        self.assertEqual(question, question_data)
+        self.assertFalse(+repairs)
+
+    def test_coerces_keys_and_types(self):
+        question, repairs = self.repair({
+            'text': 'Вопрос',
+            'answers': ['Нет', {'answer': 'Да', 'is_correct': 'true'}, {'text': 'Может быть', 'is_correct': 0}],
+        })
+        self.assertEqual(question['question'], 'Вопрос')
+        self.assertEqual([answer['is_correct'] for answer in question['answers']], [False, True, False])
+        self.assertEqual(repairs['question_key_renamed'], 1)
+        self.assertEqual(repairs['answer_coerced'], 2)
+        self.assertEqual(repairs['is_correct_coerced'], 2)
+
+    def test_correct_answer_from_question(self):
+        question, repairs = self.repair({'question': 'Вопрос', 'answers': ['Рим', 'Афины'], 'correct_answer': 'афины'})
+        self.assertEqual([answer['is_correct'] for answer in question['answers']], [False, True])
+        self.assertEqual(repairs['correct_from_question'], 1)
+
+        question, repairs = self.repair({'question': 'Вопрос', 'answers': ['Рим', 'Афины'], 'correct': 0})
+        self.assertEqual([answer['is_correct'] for answer in question['answers']], [True, False])
+
+    def test_duplicates_multiple_correct_and_extra_answers(self):
+        question, repairs = self.repair({
+            'question': 'Вопрос',
+            'answers': [
+                {'text': 'A', 'is_correct': False},
+                {'text': 'a', 'is_correct': True},
+                {'text': 'B', 'is_correct': True},
+                {'text': 'C', 'is_correct': False},
+                {'text': 'D', 'is_correct': False},
+                {'text': 'E', 'is_correct': False},
+            ],
+        })
+        self.assertEqual([answer['text'] for answer in question['answers']], ['A', 'B', 'C', 'D'])
+        self.assertEqual([answer['is_correct'] for answer in question['answers']], [True, False, False, False])
+        self.assertEqual(repairs['duplicate_answers_removed'], 1)
+        self.assertEqual(repairs['multiple_correct_fixed'], 1)
+        self.assertEqual(repairs['extra_answers_trimmed'], 1)
+
+    def test_long_answer_truncated(self):
+        question, repairs = self.repair({'question': 'Вопрос', 'answers': [{'text': 'x' * 600, 'is_correct': True}, 'Нет']})
+        self.assertEqual(len(question['answers'][0]['text']), 500)
+        self.assertEqual(repairs['answer_truncated'], 1)
+
+    def test_unrecoverable_questions_dropped(self):
+        for question_data in (
+            'Вопрос',
+            {'question': '', 'answers': ['Да', 'Нет']},
+            {'question': 'Вопрос', 'answers': 'Да, Нет'},
+            {'question': 'Вопрос', 'answers': [{'text': 'Да', 'is_correct': True}]},
+            {'question': 'Вопрос', 'answers': ['Да', 'Нет']},
+        ):
+            with self.subTest(question_data=question_data):
+                question, repairs = self.repair(question_data)
+                self.assertIsNone(question)
+                self.assertEqual(repairs['question_dropped'], 1)
+
+
+class StripTrailingCommasTests(SimpleTestCase):
+
+    def test_removes_commas_before_closing_brackets(self):
+        self.assertEqual(strip_trailing_commas('{"a": [1, 2, ], "b": 3 ,\n}'), ('{"a": [1, 2 ], "b": 3 \n}', 2))
+
+    def test_keeps_commas_inside_strings(self):
+        text = '{"a": "x, ]", "b": "y,}"}'
+        self.assertEqual(strip_trailing_commas(text), (text, 0))
+
+    def test_escaped_quotes(self):
+        text = '{"a": "x\\", ]", "b": 1,}'
+        self.assertEqual(strip_trailing_commas(text), ('{"a": "x\\", ]", "b": 1}', 1))
+
+
+class FakeResponse:
+    """Ответ requests с нужным статусом и заголовками"""
+
+    def __init__(self, status_code, headers=None, data=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    """Размыкание цепи, пробный запрос и замыкание"""
+
+    def open_breaker(self, reset_timeout=0):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        return breaker
+
+    def test_open_rejects_until_timeout(self):
+        breaker = self.open_breaker(reset_timeout=60)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+
+    def test_single_probe_then_close(self):
+        breaker = self.open_breaker()
+        self.assertTrue(breaker.before_request())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertFalse(breaker.before_request())
+
+    def test_failed_probe_reopens(self):
+        breaker = self.open_breaker(reset_timeout=0.2)
+        time.sleep(0.2)
+        self.assertTrue(breaker.before_request())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+
+    def test_released_probe_lets_next_request_probe(self):
+        breaker = self.open_breaker()
+        self.assertTrue(breaker.before_request())
+        breaker.release_probe()
+        self.assertTrue(breaker.before_request())
+
+
+class RetryDelayTests(SimpleTestCase):
+    """Паузы перед повторами и заголовок Retry-After"""
+
+    def setUp(self):
+        self.client = ChatCompletionClient('https://llm.example/v1', max_retries=2, backoff_base=0.5, max_retry_after=20)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('3'), 3.0)
+        self.assertEqual(parse_retry_after('-1'), 0.0)
+        self.assertIsNone(parse_retry_after(''))
+        self.assertIsNone(parse_retry_after('скоро'))
+        retry_at = email.utils.format_datetime(datetime.now(dt_timezone.utc) + timedelta(seconds=30), usegmt=True)
+        self.assertAlmostEqual(parse_retry_after(retry_at), 30, delta=2)
+
+    def test_backoff_is_bounded(self):
+        for attempt in range(2):
+            with self.subTest(attempt=attempt):
+                delay = self.client._retry_delay(attempt)
+                self.assertGreaterEqual(delay, 0)
+                self.assertLessEqual(delay, 0.5 * 2 ** attempt)
+        self.assertIsNone(self.client._retry_delay(2))
+
+    def test_retry_after_extends_delay(self):
+        self.assertGreaterEqual(self.client._retry_delay(0, '5'), 5)
+
+    def test_long_retry_after_is_not_waited(self):
+        self.assertIsNone(self.client._retry_delay(0, '60'))
+
+
+@patch('quiz.llm_client.time.sleep')
+class RetryLoopTests(SimpleTestCase):
+    """Повторы запроса к API и учет их исходов размыкателем"""
+
+    def setUp(self):
+        self.client = ChatCompletionClient(
+            'https://llm.example/v1', max_retries=2, breaker=CircuitBreaker(failure_threshold=5, reset_timeout=60)
+        )
+
+    def post(self, *responses):
+        with patch.object(self.client.session, 'post', side_effect=responses) as session_post:
+            try:
+                return self.client.post({}, {}, timeout=5)
+            finally:
+                self.calls = session_post.call_count
+
+    def test_retries_until_success(self, sleep):
+        self.assertEqual(self.post(FakeResponse(503), FakeResponse(502), FakeResponse(200, data={'ok': True})), {'ok': True})
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_gives_up_after_max_retries(self, sleep):
+        with self.assertRaises(LLMHTTPError) as context:
+            self.post(FakeResponse(503), FakeResponse(503), FakeResponse(503))
+        self.assertEqual(context.exception.status_code, 503)
+        self.assertEqual(self.calls, 3)
+
+    def test_client_error_not_retried(self, sleep):
+        with self.assertRaises(LLMHTTPError):
+            self.post(FakeResponse(400))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.client.breaker._failures, 0)
+
+    def test_waits_retry_after(self, sleep):
+        self.post(FakeResponse(429, headers={'Retry-After': '3'}), FakeResponse(200, data={}))
+        self.assertGreaterEqual(sleep.call_args.args[0], 3)
+
+    def test_network_errors(self, sleep):
+        self.assertEqual(self.post(requests.exceptions.ConnectionError('reset'), FakeResponse(200, data={})), {})
+        self.assertEqual(self.calls, 2)
+        # Таймаут чтения не повторяется
+        with self.assertRaises(LLMNetworkError):
+            self.post(requests.exceptions.ReadTimeout('slow'), FakeResponse(200, data={}))
+        self.assertEqual(self.calls, 1)
+
+    def test_open_circuit_stops_retries(self, sleep):
+        self.client.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        with self.assertRaises(CircuitOpenError):
+            self.post(FakeResponse(503), FakeResponse(503), FakeResponse(200, data={}))
+        self.assertEqual(self.calls, 2)
+
+
+class CancelledProbeTests(SimpleTestCase):
+    """Отмененный пробный запрос не блокирует следующие"""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        self.breaker.record_failure()
+        self.client = ChatCompletionClient('https://llm.example/v1', breaker=self.breaker)
+
+    async def slow_handler(self, request):
+        await asyncio.sleep(10)
+        return httpx.Response(200, json={})
+
+    def run_cancelled(self, coroutine):
+        async def run():
+            self.client._async_clients[asyncio.get_running_loop()] = httpx.AsyncClient(
+                transport=httpx.MockTransport(self.slow_handler)
+            )
+            task = asyncio.ensure_future(coroutine)
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.before_request())
+
+    def test_apost(self):
+        self.run_cancelled(self.client.apost({}, {}, timeout=30))
+
+    def test_astream_lines(self):
+        async def consume():
+            async for line in self.client.astream_lines({}, {}, timeout=30):
+                pass
+
+        self.run_cancelled(consume())
+
+
+@override_settings(LLM_MAX_RETRIES=0, LLM_CIRCUIT_FAILURE_THRESHOLD=1, LLM_CIRCUIT_RESET_TIMEOUT=60)
+class ProviderRouterTests(SimpleTestCase):
+    """Выбор провайдера, восстановление после размыкания, переход на резервный и страховка"""
+
+    def provider(self, name, *responses):
+        provider = LLMProvider(name, url=f'https://{name}.example/v1', api_key='key', model=name)
+        patcher = patch.object(provider.client.session, 'post', side_effect=responses)
+        self.addCleanup(patcher.stop)
+        provider.session_post = patcher.start()
+        return provider
+
+    def test_open_provider_probed_after_timeout(self):
+        provider = self.provider('main', FakeResponse(503), FakeResponse(200, data={'answer': 1}))
+        router = ProviderRouter([provider], hedging_enabled=False)
+        with self.assertRaises(LLMHTTPError):
+            router.complete({}, timeout=5)
+        with self.assertRaisesMessage(CircuitOpenError, 'Нет доступных провайдеров'):
+            router.ranked({})
+
+        provider.client.breaker.reset_timeout = 0
+        self.assertEqual(router.ranked({}), [provider])
+        self.assertEqual(router.complete({}, timeout=5), {'answer': 1})
+        self.assertEqual(provider.client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_keeps_provider_out(self):
+        provider = self.provider('main', FakeResponse(503), FakeResponse(503))
+        provider.client.breaker.reset_timeout = 0.2
+        router = ProviderRouter([provider], hedging_enabled=False)
+        with self.assertRaises(LLMHTTPError):
+            router.complete({}, timeout=5)
+        time.sleep(0.2)
+        with self.assertRaises(LLMHTTPError):
+            router.complete({}, timeout=5)
+        with self.assertRaises(CircuitOpenError):
+            router.ranked({})
+
+    def test_fallback_to_next_provider(self):
+        primary = self.provider('primary', FakeResponse(503), FakeResponse(200, data={'from': 'primary'}))
+        backup = self.provider('backup', FakeResponse(200, data={'from': 'backup'}), FakeResponse(200, data={'from': 'backup'}))
+        router = ProviderRouter([primary, backup], hedging_enabled=False)
+        self.assertEqual(router.complete({}, timeout=5), {'from': 'backup'})
+        # Разомкнутый основной провайдер пропускается
+        self.assertEqual(router.ranked({}), [backup])
+        self.assertEqual(router.complete({}, timeout=5), {'from': 'backup'})
+        self.assertEqual(primary.session_post.call_count, 1)
+
+    def test_hedge_slow_provider(self):
+        def slow(*args, **kwargs):
+            time.sleep(1)
+            return FakeResponse(200, data={'from': 'primary'})
+
+        primary = self.provider('primary')
+        primary.session_post.side_effect = slow
+        primary.latency_for({}).record(0.01)
+        backup = self.provider('backup', FakeResponse(200, data={'from': 'backup'}))
+        router = ProviderRouter([primary, backup], hedge_min_samples=1, hedge_min_delay=0.05)
+        self.assertEqual(router.ranked({}), [primary, backup])
+
+        started = time.monotonic()
+        self.assertEqual(router.complete({}, timeout=5), {'from': 'backup'})
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_async_hedge_cancels_slow_provider(self):
+        async def slow(request):
+            await asyncio.sleep(10)
+            return httpx.Response(200, json={'from': 'primary'})
+
+        primary = self.provider('primary')
+        primary.latency_for({}).record(0.01)
+        backup = self.provider('backup')
+        router = ProviderRouter([primary, backup], hedge_min_samples=1, hedge_min_delay=0.05)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            primary.client._async_clients[loop] = httpx.AsyncClient(transport=httpx.MockTransport(slow))
+            backup.client._async_clients[loop] = httpx.AsyncClient(
+                transport=httpx.MockTransport(lambda request: httpx.Response(200, json={'from': 'backup'}))
+            )
+            return await router.acomplete({}, timeout=30)
+
+        self.assertEqual(asyncio.run(run()), {'from': 'backup'})
+        # Отмененный запрос к основному провайдеру не размыкает его цепь
+        self.assertEqual(primary.client.breaker.state, CircuitBreaker.CLOSED)
+        self.assertCountEqual(router.ranked({}), [primary, backup])
+
+
+class GradeSubmissionTests(TestCase):
+    """Проверка ответов на тест: принимаются только варианты вопросов этого теста"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='student', password='password')
+        self.quiz = create_quiz(3)
+        self.other_quiz = create_quiz(2)
+        self.questions = list(self.quiz.questions.order_by('id'))
+
+    def answer(self, question, correct=True):
+        return question.answers.filter(is_correct=correct).order_by('id').first()
+
+    def test_grades_and_saves_answers(self):
+        data = {
+            f'question_{self.questions[0].id}': self.answer(self.questions[0]).id,
+            f'question_{self.questions[1].id}': self.answer(self.questions[1], correct=False).id,
+        }
+        self.assertEqual(grade_submission(self.quiz, data, self.user)[:2], (1, 3))
+        self.assertEqual(
+            dict(UserAnswer.objects.filter(user=self.user).values_list('question_id', 'is_correct')),
+            {self.questions[0].id: True, self.questions[1].id: False}
+        )
+
+    def test_foreign_questions_and_answers_are_ignored(self):
+        other_question = self.other_quiz.questions.first()
+        data = {
+            # вопрос другого теста
+            f'question_{other_question.id}': self.answer(other_question).id,
+            # правильный ответ другого вопроса этого теста
+            f'question_{self.questions[0].id}': self.answer(self.questions[1]).id,
+            # ответ из другого теста
+            f'question_{self.questions[1].id}': self.answer(other_question).id,
+            f'question_{self.questions[2].id}': 'не число',
+        }
+        correct_answers, total, accepted = grade_submission(self.quiz, data, self.user)
+        self.assertEqual((correct_answers, total, accepted), (0, 3, {}))
+        self.assertFalse(UserAnswer.objects.exists())
+
+    def test_resubmission_replaces_answers(self):
+        question = self.questions[0]
+        grade_submission(self.quiz, {f'question_{question.id}': self.answer(question, correct=False).id}, self.user)
+        grade_submission(self.quiz, {f'question_{question.id}': self.answer(question).id}, self.user)
+        user_answer = UserAnswer.objects.get(user=self.user)
+        self.assertEqual((user_answer.answer_id, user_answer.is_correct), (self.answer(question).id, True))
+
+
+class AnswerKeyCacheTests(TestCase):
+    """Проверка по кэшированному ключу ответов и его смена при правке теста"""
+
+    def setUp(self):
+        cache.clear()
+        self.quiz = create_quiz(2)
+        self.question = self.quiz.questions.order_by('id').first()
+        self.correct, self.wrong = self.question.answers.order_by('-is_correct', 'id')[:2]
+        self.url = reverse('grade_quiz_answers', args=[self.quiz.id])
+
+    def grade(self, answer):
+        data = json.dumps({'question_id': self.question.id, 'answer_id': answer.id})
+        return self.client.post(self.url, data=data, content_type='application/json').json()
+
+    def test_cached_key_needs_no_answer_queries(self):
+        self.grade(self.correct)
+        # версия теста и сессия с проверенными ответами; ответы из БД не читаются
+        with self.assertNumQueries(2):
+            result = self.grade(self.correct)
+        self.assertTrue(result['results'][str(self.question.id)]['is_correct'])
+        self.assertEqual(result['total_questions'], 2)
+
+    def test_admin_edit_changes_key(self):
+        self.grade(self.correct)
+        self.wrong.is_correct = True
+        self.wrong.save()
+        self.correct.is_correct = False
+        self.correct.save()
+        self.assertTrue(self.grade(self.wrong)['results'][str(self.question.id)]['is_correct'])
+
+    def test_edit_in_another_process_changes_key(self):
+        quiz = Quiz.objects.get(id=self.quiz.id)
+        grade_submission(quiz, {f'question_{self.question.id}': self.correct.id})
+        # Другой процесс правит ответы: его сигнал меняет версию в БД, но не трогает кэш этого процесса
+        Answer.objects.filter(id=self.correct.id).update(is_correct=False)
+        Answer.objects.filter(id=self.wrong.id).update(is_correct=True)
+        Quiz.objects.filter(id=self.quiz.id).update(content_version=F('content_version') + 1)
+
+        quiz.refresh_from_db()
+        self.assertEqual(grade_submission(quiz, {f'question_{self.question.id}': self.wrong.id})[0], 1)
+        self.assertEqual(get_answer_key(quiz.id, quiz.content_version)[self.question.id][0], self.wrong.id)
+
+    def test_unknown_quiz(self):
+        response = self.client.post(
+            reverse('grade_quiz_answers', args=[self.quiz.id + 100]),
+            data=json.dumps({'answers': {}}), content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class InstantFeedbackLockTests(TestCase):
+    """После мгновенной проверки ответ на вопрос нельзя сменить"""
+
+    def setUp(self):
+        cache.clear()
+        self.quiz = create_quiz(2)
+        self.question = self.quiz.questions.order_by('id').first()
+        self.correct, self.wrong = self.question.answers.order_by('-is_correct', 'id')[:2]
+        self.url = reverse('grade_quiz_answers', args=[self.quiz.id])
+
+    def check(self, answer):
+        data = json.dumps({'question_id': self.question.id, 'answer_id': answer.id})
+        return self.client.post(self.url, data=data, content_type='application/json').json()['results'][str(self.question.id)]
+
+    def submit(self, answer):
+        return self.client.post(reverse('quiz_detail', args=[self.quiz.id]), {f'question_{self.question.id}': answer.id})
+
+    def test_recheck_keeps_first_answer(self):
+        self.check(self.wrong)
+        result = self.check(self.correct)
+        self.assertFalse(result['is_correct'])
+        self.assertEqual(result['answer_id'], self.wrong.id)
+
+    def test_submission_scores_checked_answer(self):
+        self.check(self.wrong)
+        self.submit(self.correct)
+        attempt = QuizAttempt.objects.get(quiz=self.quiz)
+        self.assertEqual(attempt.correct_answers, 0)
+        self.assertEqual(attempt.answered_questions, 1)
+        self.assertEqual(self.client.session[f'quiz_{self.quiz.id}_answers'], {str(self.question.id): str(self.wrong.id)})
+
+    def test_submission_starts_new_attempt(self):
+        self.check(self.wrong)
+        self.submit(self.wrong)
+        self.assertNotIn(f'quiz_{self.quiz.id}_checked', self.client.session)
+        self.assertTrue(self.check(self.correct)['is_correct'])
+
+    def test_content_change_resets_lock(self):
+        self.check(self.wrong)
+        Quiz.objects.filter(id=self.quiz.id).update(content_version=F('content_version') + 1)
+        self.assertTrue(self.check(self.correct)['is_correct'])
+
+
+STATS_FIELDS = (
+    'total_quizzes_created', 'total_quizzes_completed', 'total_questions_answered', 'total_correct_answers',
+    'total_points', 'average_score', 'total_attempts', 'attempt_score_sum',
+)
+
+
+class StatsTestMixin:
+    """Сверка статистики, которую поддерживают события, с пересчетом с нуля"""
+
+    def submit(self, user, quiz, correct_count):
+        """Проходит тест от имени пользователя, отвечая верно на первые correct_count вопросов"""
+        self.client.force_login(user)
+        data = {}
+        for number, question in enumerate(quiz.questions.order_by('id')):
+            answer = question.answers.filter(is_correct=number < correct_count).order_by('id').first()
+            data[f'question_{question.id}'] = answer.id
+        self.client.post(reverse('quiz_detail', args=[quiz.id]), data)
+
+    def assert_stats_match_recompute(self, user):
+        incremental = UserStats.objects.get(user=user)
+        recomputed = recompute_user_stats(user)
+        for field in STATS_FIELDS:
+            with self.subTest(user=user.username, field=field):
+                self.assertAlmostEqual(getattr(incremental, field), getattr(recomputed, field))
+
+
+class QuizDeletionStatsTests(StatsTestMixin, TestCase):
+    """Удаление теста любым путем вычитается из статистики"""
+
+    def setUp(self):
+        cache.clear()
+        create_default_achievements()
+        self.staff = User.objects.create_superuser(username='admin', password='password')
+        self.author = User.objects.create_user(username='author', password='password')
+        self.student = User.objects.create_user(username='student', password='password')
+        self.quizzes = []
+        for _ in range(3):
+            self.client.force_login(self.author)
+            quiz = create_quiz(4, user=self.author)
+            record_quiz_creation(self.author)
+            self.quizzes.append(quiz)
+            self.submit(self.student, quiz, 3)
+            self.submit(self.author, quiz, 4)
+
+    def assert_all_stats_match(self):
+        for user in (self.author, self.student):
+            self.assert_stats_match_recompute(user)
+
+    def test_delete_from_page(self):
+        self.client.force_login(self.author)
+        self.client.post(reverse('delete_quiz', args=[self.quizzes[0].id]))
+        self.assertEqual(UserStats.objects.get(user=self.student).total_quizzes_completed, 2)
+        self.assert_all_stats_match()
+
+    def test_admin_delete(self):
+        self.client.force_login(self.staff)
+        self.client.post(reverse('admin:quiz_quiz_delete', args=[self.quizzes[0].id]), {'post': 'yes'})
+        self.assertFalse(Quiz.objects.filter(id=self.quizzes[0].id).exists())
+        self.assert_all_stats_match()
+
+    def test_admin_bulk_delete(self):
+        self.client.force_login(self.staff)
+        self.client.post(reverse('admin:quiz_quiz_changelist'), {
+            'action': 'delete_selected',
+            '_selected_action': [quiz.id for quiz in self.quizzes[:2]],
+            'post': 'yes',
+        })
+        self.assertEqual(Quiz.objects.count(), 1)
+        self.assertEqual(UserStats.objects.get(user=self.student).total_quizzes_completed, 1)
+        self.assert_all_stats_match()
+
+    def test_aborted_stream_keeps_created_count(self):
+        async def abort_after_first_question():
+            stream = astream_topic_quiz('История Рима', 5, self.author)
+            async for event, data in stream:
+                if event == 'question':
+                    break
+            await stream.aclose()
+            return data
+
+        with patch('quiz.ai_utils.get_llm_router', return_value=StubLLMRouter()):
+            data = async_to_sync(abort_after_first_question)()
+        self.assertEqual(data['index'], 1)
+        self.assertEqual(Quiz.objects.count(), 3)
+        self.assertEqual(UserStats.objects.get(user=self.author).total_quizzes_created, 3)
+        self.assert_all_stats_match()
+
+    def test_author_deletion_cascades_to_student_stats(self):
+        self.author.delete()
+        self.assertFalse(Quiz.objects.exists())
+        self.assertEqual(UserStats.objects.get(user=self.student).total_quizzes_completed, 0)
+        self.assert_stats_match_recompute(self.student)
+
+
+class IncrementalStatsTests(StatsTestMixin, TestCase):
+    """Статистика, обновляемая при каждом прохождении, совпадает с пересчетом с нуля"""
+
+    def setUp(self):
+        cache.clear()
+        create_default_achievements()
+        self.author = User.objects.create_user(username='author', password='password')
+        self.student = User.objects.create_user(username='student', password='password')
+        self.quizzes = [create_quiz(size, user=self.author) for size in (3, 5, 20)]
+        for _ in self.quizzes:
+            record_quiz_creation(self.author)
+
+    def test_submissions_and_resubmissions(self):
+        for quiz, correct_count in zip(self.quizzes, (3, 2, 18)):
+            self.submit(self.student, quiz, correct_count)
+        # Повторное прохождение заменяет вклад прошлой попытки
+        self.submit(self.student, self.quizzes[1], 5)
+        self.submit(self.student, self.quizzes[0], 0)
+        self.submit(self.author, self.quizzes[2], 20)
+
+        stats = UserStats.objects.get(user=self.student)
+        self.assertEqual((stats.total_quizzes_completed, stats.total_attempts), (3, 5))
+        self.assertEqual(stats.total_correct_answers, 0 + 5 + 18)
+        self.assert_stats_match_recompute(self.student)
+        self.assert_stats_match_recompute(self.author)
+
+    def test_many_quizzes_unlock_achievements(self):
+        quizzes = [create_quiz(5, user=self.author) for _ in range(6)]
+        for quiz in quizzes:
+            self.submit(self.student, quiz, 5)
+        self.assertTrue(UserAchievement.objects.filter(user=self.student, achievement__condition='perfectionist').exists())
+        self.assert_stats_match_recompute(self.student)
+
+
+class AchievementTests(TestCase):
+    """Проверка достижений по порогам статистики"""
+
+    def setUp(self):
+        create_default_achievements()
+        self.user = User.objects.create_user(username='learner', password='password')
+        self.stats = UserStats.objects.create(user=self.user)
+        self.ids = dict(Achievement.objects.values_list('condition', 'id'))
+
+    def check(self, changed=None, **counters):
+        UserStats.objects.filter(pk=self.stats.pk).update(**counters)
+        self.stats.refresh_from_db()
+        return check_achievements(self.user, self.stats, changed)
+
+    def test_unlocks_only_reached_thresholds(self):
+        new = self.check(total_quizzes_created=5)
+        self.assertCountEqual(new, [self.ids['first_quiz'], self.ids['quiz_creator']])
+        self.assertCountEqual(
+            UserAchievement.objects.filter(user=self.user).values_list('achievement_id', flat=True), new
+        )
+        self.stats.refresh_from_db()
+        self.assertEqual(self.stats.total_points, 25 + 50)
+        self.assertEqual(list(PointsEntry.objects.filter(user=self.user).values_list('points', flat=True)), [75])
+
+    def test_points_from_achievements_unlock_points_achievements(self):
+        new = self.check(total_quizzes_created=1, total_points=480)
+        self.assertCountEqual(new, [self.ids['first_quiz'], self.ids['points_collector']])
+        self.stats.refresh_from_db()
+        bonus = Achievement.objects.filter(id__in=new).aggregate(total=Sum('points'))['total']
+        self.assertEqual(self.stats.total_points, 480 + bonus)
+        self.assertEqual(PointsEntry.objects.get(user=self.user).points, bonus)
+
+    def test_no_queries_when_nothing_satisfied(self):
+        check_achievements(self.user, self.stats)  # каталог загружается один раз
+        with self.assertNumQueries(0):
+            self.assertEqual(check_achievements(self.user, self.stats), [])
+
+    def test_checks_only_rules_of_changed_counters(self):
+        self.assertEqual(self.check(changed={'total_points'}, total_quizzes_created=1), [])
+        self.assertEqual(self.check(changed={'total_quizzes_created'}), [self.ids['first_quiz']])
+
+    def test_idempotent(self):
+        first = self.check(total_quizzes_created=10)
+        self.assertTrue(first)
+        self.stats.refresh_from_db()
+        with self.assertNumQueries(1):
+            self.assertEqual(check_achievements(self.user, self.stats), [])
+        self.assertEqual(UserAchievement.objects.filter(user=self.user).count(), len(first))
+        self.assertEqual(PointsEntry.objects.filter(user=self.user).count(), 1)
+
+
+@override_settings(LEADERBOARD_PAGE_SIZE=1)
+class LeaderboardTests(TestCase):
+    """Снимки рейтинга в общем кэше и чтение страницы без снимка"""
+
+    USER_COUNT = 350  # страниц больше, чем вмещал локальный кэш по умолчанию
+
+    def setUp(self):
+        self.users = User.objects.bulk_create([
+            User(username=f'user{number}', password='!') for number in range(self.USER_COUNT)
+        ])
+        UserStats.objects.bulk_create([
+            UserStats(user=user, total_points=number, total_quizzes_completed=1) for number, user in enumerate(self.users)
+        ])
+
+    def test_snapshot_keeps_every_page(self):
+        self.assertEqual(build_all_leaderboards()['all'], self.USER_COUNT)
+        with self.assertNumQueries(1):
+            first = get_leaderboard_page('all', 1)
+        with self.assertNumQueries(1):
+            last = get_leaderboard_page('all', self.USER_COUNT)
+        self.assertEqual(first['rows'][0]['user_id'], self.users[-1].id)
+        self.assertEqual(last['rows'][0]['user_id'], self.users[0].id)
+        self.assertEqual(last['page_count'], self.USER_COUNT)
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_leaderboard_page('all', self.USER_COUNT + 1))
+
+    def test_miss_reads_single_page_without_building(self):
+        leaderboard_page = get_leaderboard_page('all', 10)
+        self.assertEqual(leaderboard_page['rows'][0]['rank'], 10)
+        self.assertEqual(leaderboard_page['rows'][0]['user_id'], self.users[-10].id)
+        self.assertEqual(leaderboard_page['total'], self.USER_COUNT)
+        self.assertIsNone(caches['leaderboard'].get('leaderboard:all:built'))
+        self.assertIsNone(caches['leaderboard'].get('leaderboard:all:page:9'))
+        # Прочитанная страница сохранена: следующее чтение - одно обращение к кэшу
+        with self.assertNumQueries(1):
+            self.assertEqual(get_leaderboard_page('all', 10), leaderboard_page)
+        self.assertIsNone(get_leaderboard_page('all', self.USER_COUNT + 1))
+
+    def test_snapshot_hides_pages_cached_on_miss(self):
+        get_leaderboard_page('all', self.USER_COUNT)
+        UserStats.objects.filter(user__in=self.users[:10]).delete()
+        build_leaderboard('all')
+        self.assertIsNone(get_leaderboard_page('all', self.USER_COUNT))
+
+    def test_miss_matches_snapshot(self):
+        PointsEntry.objects.bulk_create([PointsEntry(user=user, points=5) for user in self.users[:3]])
+        live = [get_leaderboard_page('week', page) for page in (1, 2, 3)]
+        build_leaderboard('week')
+        built = [get_leaderboard_page('week', page) for page in (1, 2, 3)]
+        for leaderboard_page in live + built:
+            leaderboard_page.pop('built_at')
+        self.assertEqual(live, built)
+        self.assertIsNone(get_leaderboard_page('week', 4))
+
+
+class UserRankTests(TestCase):
+    """Ранг пользователя по индексу совпадает с порядком полного рейтинга"""
+
+    def setUp(self):
+        cache.clear()
+        self.users = User.objects.bulk_create([User(username=f'user{number}', password='!') for number in range(30)])
+        # Много равенств: при одинаковых очках выше меньший id
+        UserStats.objects.bulk_create([
+            UserStats(user=user, total_points=(number * 7) % 5 * 100) for number, user in enumerate(self.users)
+        ])
+
+    def test_rank_matches_full_ordering(self):
+        ordered = list(UserStats.objects.order_by('-total_points', 'user_id').values_list('user_id', flat=True))
+        for user in self.users:
+            with self.subTest(user=user.username):
+                self.assertEqual(get_user_rank(user), ordered.index(user.id) + 1)
+
+    def test_rank_matches_leaderboard(self):
+        rows = get_leaderboard_page('all', 1)['rows']
+        for row in rows:
+            self.assertEqual(get_user_rank(User(id=row['user_id'])), row['rank'])
+
+    def test_single_query_with_known_stats(self):
+        user = self.users[5]
+        stats = UserStats.objects.get(user=user)
+        with self.assertNumQueries(1):
+            get_user_rank(user, stats)
+
+    def test_user_without_stats(self):
+        self.assertEqual(get_user_rank(User.objects.create_user(username='new', password='password')), 0)
@@ -9,6 +9,13 @@ urlpatterns = [
     path('my-quizzes/', views.my_quizzes, name='my_quizzes'),
     path('api/generate_quiz/', views.generate_quiz, name='generate_quiz'),
     path('api/generate_quiz_from_file/', views.generate_quiz_from_file, name='generate_quiz_from_file'),
+    path('api/generate_quiz/stream/', views.generate_quiz_stream, name='generate_quiz_stream'),
+    path('api/jobs/<uuid:job_id>/', views.generation_job_status, name='generation_job_status'),
+    path('api/cache-stats/', views.cache_stats, name='cache_stats'),
+    path('api/leaderboard/', views.leaderboard, name='leaderboard'),
+    path('api/async/generate_quiz/', views.generate_quiz_async, name='generate_quiz_async'),
+    path('api/async/generate_quiz_from_file/', views.generate_quiz_from_file_async, name='generate_quiz_from_file_async'),
+    path('api/quiz/<int:quiz_id>/grade/', views.grade_quiz_answers, name='grade_quiz_answers'),
     path('api/quiz/<int:quiz_id>/toggle-public/', views.toggle_quiz_public, name='toggle_quiz_public'),
     path('api/quiz/<int:quiz_id>/delete/', views.delete_quiz, name='delete_quiz'),
     path('profile/', views.profile_view, name='profile'),
@@ -1,20 +1,48 @@
+import asyncio
+import hashlib
 import json
-import requests
+import logging
 import string
 import random
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control, quote_etag
+from django.utils.http import http_date
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
-from .models import Quiz, Question, Answer, UserAnswer, UserStats, Achievement, UserAchievement
-from .file_utils import process_uploaded_file, clean_text_for_ai
+from django.core.paginator import Paginator
+from django.db.models import Count
+from .models import Quiz, UserAchievement, GenerationJob
+from .file_utils import extract_document_text
+from .ai_utils import (
+    QuizGenerationError, ensure_llm_configured, request_file_quiz_data, arequest_file_quiz_data,
+    get_cached_topic_quiz_data, agenerate_topic_quiz_data, astream_topic_quiz, save_generated_quiz,
+)
+from .cache_utils import get_llm_cache_stats, get_document_cache_stats
+from .quiz_parser import get_parser_stats
+from .quiz_utils import (
+    get_quiz_with_questions, get_user_answers, get_last_attempt, render_quiz_questions,
+)
+from .grading_utils import (
+    clear_checked_answers, filter_answers, get_answer_key, get_checked_answers, grade_answers, grade_submission,
+    lock_checked_answers,
+)
+from .job_utils import enqueue_generation_job, get_owner_key
 from .forms import UserProfileForm, CustomPasswordChangeForm
-from .stats_utils import get_or_create_user_stats, update_user_stats, get_user_rank, get_top_users, create_default_achievements, sync_user_stats, force_check_all_achievements, update_stats_after_quiz_deletion, check_achievements
+from .stats_utils import (
+    get_user_stats, get_quiz_answer_counts, record_quiz_attempt, record_quiz_completion, get_user_rank,
+)
+from .leaderboard_utils import LEADERBOARD_PERIODS, get_leaderboard_page, get_top_users
+
+
+logger = logging.getLogger(__name__)
 
 
 def generate_share_code():
@@ -22,6 +50,35 @@ def generate_share_code():
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
 
 
+def render_quiz_page(request, quiz, **context):
+    """Страница прохождения теста с кэшированным блоком вопросов и условным GET.
+
+    ETag строится из версии содержимого теста (Quiz.content_version, общая для всех
+    процессов), пользователя (от него зависит шапка) и секрета CSRF, который
+    меняется при входе: форма сохраненной страницы должна проходить проверку
+    CSRF. При совпадении отдается 304 без отрисовки.
+    """
+    get_token(request)
+    csrf_hash = hashlib.sha256(request.META['CSRF_COOKIE'].encode()).hexdigest()[:12]
+    etag = quote_etag(f'{quiz.id}.{quiz.content_version}-{request.user.pk or 0}-{csrf_hash}')
+    last_modified = int(quiz.content_modified.timestamp())
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        questions_html, question_count = render_quiz_questions(quiz)
+        response = render(request, 'quiz.html', dict(
+            context,
+            quiz=quiz,
+            questions_html=questions_html,
+            question_count=question_count
+        ))
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = http_date(last_modified)
+    # Браузер хранит страницу, но перепроверяет ее при каждом переходе по ссылке
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
 def index(request):
     """Главная страница с формой создания теста"""
     return render(request, 'index.html')
@@ -29,390 +86,364 @@ def index(request):
 
 def quiz_detail(request, quiz_id):
     """Страница прохождения теста"""
-    quiz = get_object_or_404(Quiz, id=quiz_id)
-    questions = quiz.questions.all()
-    
     if request.method == 'POST':
+        quiz = get_object_or_404(Quiz, id=quiz_id)
         # Обработка ответов пользователя
         user = request.user if request.user.is_authenticated else None
-        correct_answers = 0
-        total_questions = questions.count()
-        session_answers = {}
-        
-        for question in questions:
-            answer_id = request.POST.get(f'question_{question.id}')
-            if answer_id:
-                try:
-                    selected_answer = Answer.objects.get(id=answer_id)
-                    is_correct = selected_answer.is_correct
-                    
-                    if is_correct:
-                        correct_answers += 1
-                    
-                    # Сохраняем ответ пользователя, если он авторизован
-                    if user:
-                        UserAnswer.objects.update_or_create(
-                            user=user,
-                            question=question,
-                            defaults={
-                                'answer': selected_answer,
-                                'is_correct': is_correct
-                            }
-                        )
-                    else:
-                        # Сохраняем в сессии для неавторизованных пользователей
-                        session_answers[str(question.id)] = answer_id
-                        
-                except Answer.DoesNotExist:
-                    pass
+        previous_answers = get_quiz_answer_counts(user, quiz.id) if user else None
+        checked = get_checked_answers(request.session, quiz.id, quiz.content_version)
+        correct_answers, total_questions, accepted = grade_submission(quiz, request.POST, user, checked)
+        clear_checked_answers(request.session, quiz.id)
         
         # Сохраняем ответы в сессии для неавторизованных пользователей
-        if not user and session_answers:
-            request.session[f'quiz_{quiz.id}_answers'] = session_answers
+        if not user and accepted:
+            request.session[f'quiz_{quiz.id}_answers'] = {
+                str(question_id): str(answer_id) for question_id, answer_id in accepted.items()
+            }
         
-        # Вычисляем процент правильных ответов
-        score = (correct_answers / total_questions * 100) if total_questions > 0 else 0
-        
-        # Обновляем результат теста
-        quiz.score = score
-        quiz.save()
+        # Записываем попытку в журнал; результат теста меняет только попытка автора
+        attempt = record_quiz_attempt(quiz, user, correct_answers, len(accepted), total_questions)
+        if not user:
+            request.session[f'quiz_{quiz.id}_attempt'] = attempt.id
         
-        # Обновляем статистику пользователя
-        if request.user.is_authenticated:
-            update_user_stats(
-                request.user, 
-                quiz_completed=True, 
-                questions_answered=total_questions, 
-                correct_answers=correct_answers,
-                quiz_score=score
+        # Обновляем статистику пользователя: вклад прошлой попытки заменяется новым
+        if user:
+            record_quiz_completion(
+                user, total_questions, previous_answers, get_quiz_answer_counts(user, quiz.id), attempt
             )
         
         return redirect('quiz_results', quiz_id=quiz.id)
     
-    return render(request, 'quiz.html', {'quiz': quiz, 'questions': questions})
+    quiz = get_object_or_404(Quiz, id=quiz_id)
+    return render_quiz_page(request, quiz)
 
 
 def quiz_results(request, quiz_id):
     """Страница результатов теста"""
-    quiz = get_object_or_404(Quiz, id=quiz_id)
-    questions = quiz.questions.all()
-    
-    # Получаем ответы пользователя, если он авторизован
-    user_answers = {}
-    if request.user.is_authenticated:
-        user_answers = {
-            ua.question.id: ua for ua in UserAnswer.objects.filter(
-                user=request.user, 
-                question__in=questions
-            )
-        }
-    else:
-        # Если пользователь не авторизован, попробуем получить ответы из сессии
-        session_answers = request.session.get(f'quiz_{quiz_id}_answers', {})
-        if session_answers:
-            # Создаем mock объекты для отображения
-            for question_id, answer_id in session_answers.items():
-                try:
-                    answer = Answer.objects.get(id=answer_id)
-                    user_answers[int(question_id)] = type('MockUserAnswer', (), {
-                        'answer': answer,
-                        'is_correct': answer.is_correct
-                    })()
-                except Answer.DoesNotExist:
-                    pass
+    quiz, questions = get_quiz_with_questions(id=quiz_id)
+    user_answers = get_user_answers(request, quiz, questions)
+    attempt = get_last_attempt(request, quiz)
     
     return render(request, 'results.html', {
         'quiz': quiz, 
         'questions': questions,
-        'user_answers': user_answers
+        'user_answers': user_answers,
+        'score': attempt.score if attempt else None
     })
 
 
 @login_required
 def my_quizzes(request):
     """Список созданных пользователем тестов"""
-    quizzes = Quiz.objects.filter(user=request.user).order_by('-created_at')
-    return render(request, 'my_quizzes.html', {'quizzes': quizzes})
+    quizzes = (
+        Quiz.objects.filter(user=request.user)
+        .annotate(question_count=Count('questions'))
+        .order_by('-created_at', '-id')
+    )
+    page = Paginator(quizzes, settings.MY_QUIZZES_PAGE_SIZE).get_page(request.GET.get('page'))
+    return render(request, 'my_quizzes.html', {'quizzes': page, 'page_obj': page})
+
+
+def _read_topic_request(request):
+    """Читает и проверяет параметры генерации теста по теме"""
+    data = json.loads(request.body)
+    topic = data.get('topic', '').strip()
+    question_count = data.get('questionCount', 5)
+
+    if not topic:
+        raise QuizGenerationError('Тема теста не может быть пустой', status=400)
+
+    # Валидация количества вопросов
+    if not isinstance(question_count, int) or question_count < 1 or question_count > 50:
+        raise QuizGenerationError('Количество вопросов должно быть от 1 до 50', status=400)
+
+    return topic, question_count
+
+
+def _read_file_request(request):
+    """Читает и проверяет параметры генерации теста из файла"""
+    if 'file' not in request.FILES:
+        raise QuizGenerationError('Файл не был загружен', status=400)
+
+    uploaded_file = request.FILES['file']
+    question_count = int(request.POST.get('questionCount', 5))
+
+    # Валидация количества вопросов
+    if question_count < 1 or question_count > 50:
+        raise QuizGenerationError('Количество вопросов должно быть от 1 до 50', status=400)
+
+    return uploaded_file, question_count
+
+
+def _extract_file_text(uploaded_file):
+    """Извлекает из файла весь текст, пригодный для отправки в AI"""
+    try:
+        cleaned_text = extract_document_text(uploaded_file)
+    except Exception as e:
+        raise QuizGenerationError(f'Ошибка при обработке файла: {str(e)}', status=400)
+
+    if not cleaned_text or len(cleaned_text.strip()) < 100:
+        raise QuizGenerationError('Файл содержит слишком мало текста для создания теста', status=400)
+
+    return cleaned_text
+
+
+def _quiz_created_response(quiz, cached=False):
+    return JsonResponse({
+        'success': True,
+        'quiz_id': quiz.id,
+        'redirect_url': f'/quiz/{quiz.id}/',
+        'cached': cached
+    })
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
 def generate_quiz(request):
-    """API эндпоинт для генерации теста через DeepSeek"""
+    """API эндпоинт для постановки генерации теста через DeepSeek в очередь"""
     try:
-        data = json.loads(request.body)
-        topic = data.get('topic', '').strip()
-        question_count = data.get('questionCount', 5)
-        
-        if not topic:
-            return JsonResponse({'error': 'Тема теста не может быть пустой'}, status=400)
-        
-        # Валидация количества вопросов
-        if not isinstance(question_count, int) or question_count < 1 or question_count > 50:
-            return JsonResponse({'error': 'Количество вопросов должно быть от 1 до 50'}, status=400)
-        
-        # Настройка DeepSeek API
-        deepseek_api_key = settings.DEEPSEEK_API_KEY
-        
-        if not deepseek_api_key:
-            return JsonResponse({'error': 'DeepSeek API ключ не настроен'}, status=500)
-        
-        # Промпт для генерации теста
-        prompt = f'''Создай JSON с викториной по теме "{topic}". 
-
-ВАЖНО: Верни ТОЛЬКО валидный JSON без дополнительного текста, комментариев или markdown разметки.
-
-Формат:
-{{
-"title": "Название теста",
-"questions": [
-{{
-"question": "Текст вопроса",
-"answers": [
-{{"text": "Вариант ответа 1", "is_correct": true}},
-{{"text": "Вариант ответа 2", "is_correct": false}},
-{{"text": "Вариант ответа 3", "is_correct": false}},
-{{"text": "Вариант ответа 4", "is_correct": false}}
-]
-}}
-]
-}}
-
-Создай ровно {question_count} вопросов с 4 вариантами ответов каждый. Только один ответ должен быть правильным на каждый вопрос.'''
-        
-        # Вызов DeepSeek API
-        headers = {
-            'Authorization': f'Bearer {deepseek_api_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {"role": "system", "content": "Ты эксперт по созданию образовательных тестов. Создавай качественные вопросы с четкими вариантами ответов."},
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 2000,
-            "temperature": 0.7
-        }
-        
-        response = requests.post(
-            'https://api.deepseek.com/v1/chat/completions',
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            return JsonResponse({'error': f'Ошибка API DeepSeek: {response.status_code}'}, status=500)
-        
-        response_data = response.json()
-        quiz_content = response_data['choices'][0]['message']['content']
-        
-        # Очистка ответа от возможных markdown блоков
-        if '```json' in quiz_content:
-            quiz_content = quiz_content.split('```json')[1].split('```')[0].strip()
-        elif '```' in quiz_content:
-            quiz_content = quiz_content.split('```')[1].split('```')[0].strip()
-        
-        # Парсинг JSON ответа
-        try:
-            quiz_data = json.loads(quiz_content)
-        except json.JSONDecodeError as e:
-            # Если JSON невалидный, попробуем извлечь JSON из текста
-            import re
-            json_match = re.search(r'\{.*\}', quiz_content, re.DOTALL)
-            if json_match:
-                quiz_data = json.loads(json_match.group())
-            else:
-                return JsonResponse({'error': f'Не удалось распарсить JSON от DeepSeek: {str(e)}'}, status=500)
-        
-        # Создание теста в базе данных
+        topic, question_count = _read_topic_request(request)
+        ensure_llm_configured()
+
         user = request.user if request.user.is_authenticated else None
-        quiz = Quiz.objects.create(
-            title=quiz_data['title'],
-            user=user
-        )
-        
-        # Создание вопросов и ответов
-        for question_data in quiz_data['questions']:
-            question = Question.objects.create(
-                quiz=quiz,
-                text=question_data['question']
-            )
-            
-            for answer_data in question_data['answers']:
-                Answer.objects.create(
-                    question=question,
-                    text=answer_data['text'],
-                    is_correct=answer_data['is_correct']
-                )
-        
-        # Обновляем статистику пользователя при создании теста
-        if user:
-            stats = get_or_create_user_stats(user)
-            stats.total_quizzes_created += 1
-            stats.save()
-            check_achievements(user)
-        
+
+        # Популярные темы отдаем из кэша сразу, без очереди и обращения к DeepSeek.
+        # Промах учтет воркер, который проверит кэш еще раз перед запросом.
+        quiz_data = get_cached_topic_quiz_data(topic, question_count, record_miss=False)
+        if quiz_data is not None:
+            quiz = save_generated_quiz(quiz_data, user)
+            return _quiz_created_response(quiz, cached=True)
+
+        job = enqueue_generation_job(topic, question_count, user, owner_key=get_owner_key(request))
+
         return JsonResponse({
             'success': True,
-            'quiz_id': quiz.id,
-            'redirect_url': f'/quiz/{quiz.id}/'
-        })
-        
+            'job_id': str(job.id),
+            'status': job.status,
+            'status_url': f'/api/jobs/{job.id}/'
+        }, status=202)
+
+    except QuizGenerationError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
     except json.JSONDecodeError as e:
         return JsonResponse({'error': f'Неверный формат JSON в запросе: {str(e)}'}, status=400)
-    except requests.exceptions.RequestException as e:
-        return JsonResponse({'error': f'Ошибка сети при обращении к DeepSeek API: {str(e)}'}, status=500)
     except Exception as e:
         return JsonResponse({'error': f'Ошибка при генерации теста: {str(e)}'}, status=500)
 
 
+@require_http_methods(["GET"])
+def cache_stats(request):
+    """Счетчики кэшей и исправлений ответов модели (только для персонала)"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Нет прав для просмотра статистики'}, status=403)
+
+    return JsonResponse({
+        'llm': get_llm_cache_stats(),
+        'documents': get_document_cache_stats(),
+        'parser_repairs': get_parser_stats(),
+    })
+
+
+@require_http_methods(["GET"])
+def leaderboard(request):
+    """Страница рейтинга пользователей за все время, неделю или месяц"""
+    period = request.GET.get('period', 'all')
+    if period not in LEADERBOARD_PERIODS:
+        return JsonResponse({'error': f'Неизвестный период, допустимые: {", ".join(LEADERBOARD_PERIODS)}'}, status=400)
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        return JsonResponse({'error': 'Номер страницы должен быть числом'}, status=400)
+    if page < 1:
+        return JsonResponse({'error': 'Номер страницы должен быть положительным'}, status=400)
+
+    leaderboard_page = get_leaderboard_page(period, page)
+    if leaderboard_page is None:
+        return JsonResponse({'error': 'Такой страницы рейтинга нет'}, status=404)
+    return JsonResponse(leaderboard_page)
+
+
+@require_http_methods(["GET"])
+def generation_job_status(request, job_id):
+    """API эндпоинт для проверки статуса задания на генерацию"""
+    job = GenerationJob.objects.filter(id=job_id).values('status', 'quiz_id', 'error', 'from_cache').first()
+    if job is None:
+        return JsonResponse({'error': 'Задание не найдено'}, status=404)
+
+    data = {'job_id': str(job_id), 'status': job['status']}
+    if job['status'] == GenerationJob.STATUS_DONE and job['quiz_id']:
+        data['quiz_id'] = job['quiz_id']
+        data['redirect_url'] = f"/quiz/{job['quiz_id']}/"
+        data['cached'] = job['from_cache']
+    elif job['status'] == GenerationJob.STATUS_FAILED:
+        data['error'] = job['error']
+
+    return JsonResponse(data)
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def generate_quiz_from_file(request):
     """API эндпоинт для генерации теста из загруженного файла"""
     try:
-        if 'file' not in request.FILES:
-            return JsonResponse({'error': 'Файл не был загружен'}, status=400)
-        
-        uploaded_file = request.FILES['file']
-        question_count = int(request.POST.get('questionCount', 5))
-        
-        # Валидация количества вопросов
-        if question_count < 1 or question_count > 50:
-            return JsonResponse({'error': 'Количество вопросов должно быть от 1 до 50'}, status=400)
-        
-        # Настройка DeepSeek API
-        deepseek_api_key = settings.DEEPSEEK_API_KEY
-        
-        if not deepseek_api_key:
-            return JsonResponse({'error': 'DeepSeek API ключ не настроен'}, status=500)
-        
-        # Обрабатываем загруженный файл
-        try:
-            file_text = process_uploaded_file(uploaded_file)
-            cleaned_text = clean_text_for_ai(file_text)
-        except Exception as e:
-            return JsonResponse({'error': f'Ошибка при обработке файла: {str(e)}'}, status=400)
-        
-        if not cleaned_text or len(cleaned_text.strip()) < 100:
-            return JsonResponse({'error': 'Файл содержит слишком мало текста для создания теста'}, status=400)
-        
-        # Промпт для генерации теста на основе файла
-        prompt = f'''Проанализируй следующий текст и создай JSON с викториной на его основе.
-
-ТЕКСТ ДЛЯ АНАЛИЗА:
-{cleaned_text}
-
-ВАЖНО: Верни ТОЛЬКО валидный JSON без дополнительного текста, комментариев или markdown разметки.
-
-Формат:
-{{
-"title": "Название теста на основе текста",
-"questions": [
-{{
-"question": "Текст вопроса",
-"answers": [
-{{"text": "Вариант ответа 1", "is_correct": true}},
-{{"text": "Вариант ответа 2", "is_correct": false}},
-{{"text": "Вариант ответа 3", "is_correct": false}},
-{{"text": "Вариант ответа 4", "is_correct": false}}
-]
-}}
-]
-}}
-
-Создай ровно {question_count} вопросов с 4 вариантами ответов каждый на основе предоставленного текста. Только один ответ должен быть правильным на каждый вопрос.'''
-        
-        # Вызов DeepSeek API
-        headers = {
-            'Authorization': f'Bearer {deepseek_api_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [
-                {"role": "system", "content": "Ты эксперт по созданию образовательных тестов. Анализируй предоставленный текст и создавай качественные вопросы с четкими вариантами ответов на основе содержания."},
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 3000,
-            "temperature": 0.7
-        }
-        
-        response = requests.post(
-            'https://api.deepseek.com/v1/chat/completions',
-            headers=headers,
-            json=payload,
-            timeout=60
-        )
-        
-        if response.status_code != 200:
-            return JsonResponse({'error': f'Ошибка API DeepSeek: {response.status_code}'}, status=500)
-        
-        response_data = response.json()
-        quiz_content = response_data['choices'][0]['message']['content']
-        
-        # Очистка ответа от возможных markdown блоков
-        if '```json' in quiz_content:
-            quiz_content = quiz_content.split('```json')[1].split('```')[0].strip()
-        elif '```' in quiz_content:
-            quiz_content = quiz_content.split('```')[1].split('```')[0].strip()
-        
-        # Парсинг JSON ответа
-        try:
-            quiz_data = json.loads(quiz_content)
-        except json.JSONDecodeError as e:
-            # Если JSON невалидный, попробуем извлечь JSON из текста
-            import re
-            json_match = re.search(r'\{.*\}', quiz_content, re.DOTALL)
-            if json_match:
-                quiz_data = json.loads(json_match.group())
-            else:
-                return JsonResponse({'error': f'Не удалось распарсить JSON от DeepSeek: {str(e)}'}, status=500)
-        
-        # Создание теста в базе данных
+        uploaded_file, question_count = _read_file_request(request)
+        ensure_llm_configured()
+
+        cleaned_text = _extract_file_text(uploaded_file)
+
+        quiz_data = request_file_quiz_data(cleaned_text, question_count, timeout=60)
+
         user = request.user if request.user.is_authenticated else None
-        quiz = Quiz.objects.create(
-            title=quiz_data['title'],
-            user=user
-        )
-        
-        # Создание вопросов и ответов
-        for question_data in quiz_data['questions']:
-            question = Question.objects.create(
-                quiz=quiz,
-                text=question_data['question']
-            )
-            
-            for answer_data in question_data['answers']:
-                Answer.objects.create(
-                    question=question,
-                    text=answer_data['text'],
-                    is_correct=answer_data['is_correct']
-                )
-        
-        # Обновляем статистику пользователя при создании теста
-        if user:
-            stats = get_or_create_user_stats(user)
-            stats.total_quizzes_created += 1
-            stats.save()
-            check_achievements(user)
-        
-        return JsonResponse({
-            'success': True,
-            'quiz_id': quiz.id,
-            'redirect_url': f'/quiz/{quiz.id}/'
-        })
-        
-    except requests.exceptions.RequestException as e:
-        return JsonResponse({'error': f'Ошибка сети при обращении к DeepSeek API: {str(e)}'}, status=500)
+        quiz = save_generated_quiz(quiz_data, user)
+
+        return _quiz_created_response(quiz)
+
+    except QuizGenerationError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
     except Exception as e:
         return JsonResponse({'error': f'Ошибка при генерации теста: {str(e)}'}, status=500)
 
 
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_quiz_async(request):
+    """Асинхронный API эндпоинт для генерации теста через DeepSeek.
+
+    Не занимает поток на время ответа модели; при отключении клиента
+    запрос к DeepSeek отменяется и тест не сохраняется.
+    """
+    try:
+        topic, question_count = _read_topic_request(request)
+        ensure_llm_configured()
+
+        quiz_data, cached = await agenerate_topic_quiz_data(topic, question_count)
+
+        user = await request.auser()
+        user = user if user.is_authenticated else None
+        quiz = await sync_to_async(save_generated_quiz)(quiz_data, user)
+
+        return _quiz_created_response(quiz, cached=cached)
+
+    except asyncio.CancelledError:
+        logger.info('Клиент отключился, генерация теста по теме отменена')
+        raise
+    except QuizGenerationError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+    except json.JSONDecodeError as e:
+        return JsonResponse({'error': f'Неверный формат JSON в запросе: {str(e)}'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': f'Ошибка при генерации теста: {str(e)}'}, status=500)
+
+
+def _sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+async def _quiz_stream_events(topic, question_count, user):
+    """Превращает ход потоковой генерации в события Server-Sent Events"""
+    try:
+        async for event, data in astream_topic_quiz(topic, question_count, user):
+            yield _sse_event(event, data)
+    except asyncio.CancelledError:
+        logger.info('Клиент отключился, потоковая генерация теста отменена')
+        raise
+    except QuizGenerationError as e:
+        yield _sse_event('error', {'error': e.message})
+    except Exception as e:
+        yield _sse_event('error', {'error': f'Ошибка при генерации теста: {str(e)}'})
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_quiz_stream(request):
+    """Потоковая генерация теста: вопросы сохраняются и отправляются клиенту по мере готовности"""
+    try:
+        topic, question_count = _read_topic_request(request)
+        ensure_llm_configured()
+    except QuizGenerationError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+    except json.JSONDecodeError as e:
+        return JsonResponse({'error': f'Неверный формат JSON в запросе: {str(e)}'}, status=400)
+
+    user = await request.auser()
+    user = user if user.is_authenticated else None
+
+    response = StreamingHttpResponse(
+        _quiz_stream_events(topic, question_count, user),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def generate_quiz_from_file_async(request):
+    """Асинхронный API эндпоинт для генерации теста из загруженного файла"""
+    try:
+        uploaded_file, question_count = _read_file_request(request)
+        ensure_llm_configured()
+
+        # Разбор PDF/Word нагружает CPU, поэтому выполняется в отдельном потоке
+        cleaned_text = await sync_to_async(_extract_file_text, thread_sensitive=False)(uploaded_file)
+
+        quiz_data = await arequest_file_quiz_data(cleaned_text, question_count, timeout=60)
+
+        user = await request.auser()
+        user = user if user.is_authenticated else None
+        quiz = await sync_to_async(save_generated_quiz)(quiz_data, user)
+
+        return _quiz_created_response(quiz)
+
+    except asyncio.CancelledError:
+        logger.info('Клиент отключился, генерация теста из файла отменена')
+        raise
+    except QuizGenerationError as e:
+        return JsonResponse({'error': e.message}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': f'Ошибка при генерации теста: {str(e)}'}, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def grade_quiz_answers(request, quiz_id):
+    """API эндпоинт для мгновенной проверки ответа на вопрос или всей попытки.
+
+    Принимает {"question_id": ..., "answer_id": ...} или {"answers": {id вопроса: id ответа}}.
+    Проверка идет по кэшированному ключу ответов, ответы не сохраняются. Проверенный
+    ответ закрепляется в сессии: сменить его после того, как показан правильный, нельзя.
+    """
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError as e:
+        return JsonResponse({'error': f'Неверный формат JSON в запросе: {str(e)}'}, status=400)
+
+    if isinstance(data, dict) and isinstance(data.get('answers'), dict):
+        selected = data['answers']
+    elif isinstance(data, dict) and 'question_id' in data and 'answer_id' in data:
+        selected = {data['question_id']: data['answer_id']}
+    else:
+        return JsonResponse({'error': 'Передайте question_id и answer_id или словарь answers'}, status=400)
+
+    content_version = Quiz.objects.filter(id=quiz_id).values_list('content_version', flat=True).first()
+    if content_version is None:
+        return JsonResponse({'error': 'Тест не найден'}, status=404)
+    answer_key = get_answer_key(quiz_id, content_version)
+    answers = lock_checked_answers(request.session, quiz_id, content_version, filter_answers(answer_key, selected))
+
+    results = grade_answers(answer_key, answers)
+    return JsonResponse({
+        'results': {
+            str(question_id): {'is_correct': is_correct, 'answer_id': answers[question_id], 'correct_answer_id': correct_id}
+            for question_id, (is_correct, correct_id) in results.items()
+        },
+        'correct_answers': sum(1 for is_correct, _ in results.values() if is_correct),
+        'answered': len(results),
+        'total_questions': len(answer_key)
+    })
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def toggle_quiz_public(request, quiz_id):
@@ -451,15 +482,7 @@ def shared_quiz(request, share_code):
     """Показывает публичный тест по коду"""
     try:
         quiz = get_object_or_404(Quiz, share_code=share_code, is_public=True)
-        questions = quiz.questions.all()
-        
-        context = {
-            'quiz': quiz,
-            'questions': questions,
-            'is_shared': True
-        }
-        
-        return render(request, 'quiz.html', context)
+        return render_quiz_page(request, quiz, is_shared=True)
         
     except Exception as e:
         messages.error(request, f'Ошибка при загрузке теста: {str(e)}')
@@ -477,12 +500,9 @@ def delete_quiz(request, quiz_id):
         if request.user != quiz.user:
             return JsonResponse({'error': 'Нет прав для удаления этого теста'}, status=403)
         
-        # Удаляем тест (каскадное удаление удалит все связанные объекты)
+        # Каскадное удаление удалит все связанные объекты, статистику обновит сигнал pre_delete
         quiz.delete()
         
-        # Обновляем статистику пользователя после удаления
-        update_stats_after_quiz_deletion(request.user)
-        
         return JsonResponse({
             'success': True,
             'message': 'Тест успешно удален'
@@ -504,14 +524,12 @@ def profile_view(request):
     else:
         form = UserProfileForm(instance=request.user)
     
-    # Синхронизируем статистику пользователя
-    stats = sync_user_stats(request.user)
-    
-    # Принудительно проверяем все достижения
-    force_check_all_achievements(request.user)
+    # Статистика и достижения обновляются при создании, прохождении и удалении тестов,
+    # здесь они только читаются
+    stats = get_user_stats(request.user)
     
-    user_achievements = UserAchievement.objects.filter(user=request.user).order_by('-unlocked_at')
-    user_rank = get_user_rank(request.user)
+    user_achievements = UserAchievement.objects.filter(user=request.user).select_related('achievement').order_by('-unlocked_at')
+    user_rank = get_user_rank(request.user, stats)
     top_users = get_top_users(5)
     
     context = {